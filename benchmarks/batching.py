@@ -0,0 +1,59 @@
+"""Frames and bytes sent per chat, one event per chat against chat_batch events.
+
+--chats chats are emitted to a room of --users users through RoomManager,
+without network: eio.send only counts what it is given. One event per chat
+sends a frame per chat and user; batches of BATCH_SIZE send a frame per
+batch and user.
+
+Usage: python -m benchmarks.batching [--chats 10000] [--users 100]
+"""
+from argparse import ArgumentParser
+from time import perf_counter
+
+import socketio
+
+from src.server.Batcher import BATCH_SIZE, Batcher
+from src.server.RoomManager import RoomManager
+
+parser = ArgumentParser()
+parser.add_argument("--chats", default=10_000, help="Chats emitted", type=int)
+parser.add_argument("--users", default=100, help="Users in the room", type=int)
+
+
+def main():
+    args = parser.parse_args()
+    n = args.chats
+    manager = RoomManager()
+    server = socketio.Server(client_manager=manager)
+    sent = {"frames": 0, "bytes": 0}
+
+    def send(sid, data):
+        sent["frames"] += 1
+        sent["bytes"] += len(data)
+
+    server.eio.send = send
+    manager.initialize()
+    for i in range(args.users):
+        manager.enter_room(manager.connect(f"eio{i}", "/"), "/", "chat")
+
+    msg = {"message": "hola", "broadcast_count": 12345, "sender_id": "server", "username": "someone", "index": 1}
+    for size in (1, BATCH_SIZE):
+        sent.update(frames=0, bytes=0)
+        if size == 1:
+            add = lambda m: server.emit("chat", m, room="chat")
+        else:
+            # Only full batches, never waiting for max_delay
+            batcher = Batcher(lambda msgs: server.emit("chat_batch", msgs, room="chat"), size, max_delay=60)
+            add = batcher.add
+        start = perf_counter()
+        for _ in range(n):
+            add(msg)
+        elapsed = perf_counter() - start
+        print(
+            f"batches of {size:>3}: {elapsed / n * 1e6:>6.1f} us per chat,"
+            f" {sent['frames'] / n:>6.1f} frames and {sent['bytes'] / n:>6.0f} bytes per chat"
+        )
+
+
+if __name__ == "__main__":
+    main()
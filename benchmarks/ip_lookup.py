@@ -0,0 +1,154 @@
+"""Lookup cost of the name server's longest prefix match index.
+
+The reference is the scan the name server did before the index, kept here
+as baseline_find_closest_ip: for every lookup it compares the requesting IP
+against every address at every mask from /24 down to /1. It is timed on a
+few IPv4 lookups only, as it takes hundreds of milliseconds per lookup with
+thousands of addresses.
+
+Before timing, --checks randomized runs add, replace and remove addresses
+(IPv4, IPv6 and plain hosts, many on the same IP) and assert that every
+lookup returns what a scan of the addresses in registry order does: the
+first address with the longest prefix in common with the requesting IP. In
+particular, servers on the same host resolve in registry order, also after
+one of them was replaced by a migration.
+
+Usage: python -m benchmarks.ip_lookup [-n 10000] [--lookups 100000] [--checks 200]
+"""
+import random
+import re
+from argparse import ArgumentParser
+from ipaddress import IPv4Network, IPv6Address
+from time import perf_counter
+from typing import List, Optional
+
+from src.name_server.ip_lookup import PrefixIndex, clean_ip, parse_ip
+from src.name_server.registry import Shard
+
+parser = ArgumentParser()
+parser.add_argument("-n", "--addresses", default=10_000, help="Registered addresses", type=int)
+parser.add_argument("--lookups", default=100_000, help="Lookups to time per family", type=int)
+parser.add_argument("--baseline_lookups", default=5, help="Lookups to time with the baseline scan", type=int)
+parser.add_argument("--checks", default=200, help="Randomized runs of the lookup checks", type=int)
+parser.add_argument("--seed", default=0, type=int)
+
+
+def random_ipv4(rng: random.Random) -> str:
+    return ".".join(str(rng.randint(1, 254)) for _ in range(4))
+
+
+def random_ipv6(rng: random.Random) -> str:
+    return str(IPv6Address(rng.getrandbits(128)))
+
+
+def timed(label: str, ops: int, fn):
+    start = perf_counter()
+    fn()
+    elapsed = perf_counter() - start
+    print(f"{label:<40} {elapsed / ops * 1e6:>10.2f} us/op {ops / elapsed:>14,.0f} ops/s")
+
+
+def baseline_find_closest_ip(self_ip: str, ips: List[str]) -> Optional[str]:
+    """find_closest_ip as the name server ran it before PrefixIndex, without its logs"""
+
+    def clean(ip: str) -> str:
+        return re.sub(r":\d+", "", re.sub(r"https?://", "", ip))
+
+    clean_self_ip = clean(self_ip)
+    clean_ips = list(map(clean, ips))
+    if clean_self_ip in clean_ips:
+        return ips[clean_ips.index(clean_self_ip)]
+
+    mask = 24
+    while mask:
+        self_net = IPv4Network(f"{clean_self_ip}/{mask}", strict=False)
+        for i, other_ip in enumerate(clean_ips):
+            if self_net == IPv4Network(f"{other_ip}/{mask}", strict=False):
+                return ips[i]
+        mask -= 1
+    return None
+
+
+def scan_closest(self_ip: str, addresses: List[str]) -> Optional[str]:
+    """The first of addresses with the longest prefix in common with self_ip"""
+    ip = parse_ip(self_ip)
+    if ip is None:
+        return next((a for a in addresses if parse_ip(a) is None and clean_ip(a) == clean_ip(self_ip)), None)
+
+    best, best_length = None, 0
+    for address in addresses:
+        other = parse_ip(address)
+        if other is None or other.version != ip.version:
+            continue
+        length = ip.max_prefixlen - (int(ip) ^ int(other)).bit_length()
+        if length > best_length:
+            best, best_length = address, length
+    return best
+
+
+def check_lookups(rng: random.Random):
+    hosts = [random_ipv4(rng) for _ in range(4)] + [f"[{random_ipv6(rng)}]" for _ in range(2)] + ["localhost"]
+    ports = iter(range(1024, 65535))
+    index = PrefixIndex()
+    # In registry order: new addresses go last, replaced ones keep their place
+    addresses: List[str] = []
+    for _ in range(rng.randint(1, 60)):
+        new = f"http://{rng.choice(hosts)}:{next(ports)}"
+        op = rng.random()
+        if not addresses or op < 0.5:
+            index.add(new)
+            addresses.append(new)
+        elif op < 0.8:
+            i = rng.randrange(len(addresses))
+            assert index.replace(addresses[i], new)
+            addresses[i] = new
+        else:
+            assert index.remove(addresses.pop(rng.randrange(len(addresses))))
+
+        assert len(index) == len(addresses)
+        for query in [h.strip("[]") for h in hosts] + [random_ipv4(rng), random_ipv6(rng)]:
+            assert index.closest(query) == scan_closest(query, addresses), (query, addresses)
+
+
+def check_same_host_migration():
+    # Two servers of a chat on the same host, and the first one migrates to another port of it
+    shard = Shard(active_set_size=2)
+    shard.register("chat", "http://10.0.0.1:5000")
+    shard.register("chat", "http://10.0.0.1:5001")
+    assert shard.closest("chat", "10.0.0.1") == "http://10.0.0.1:5000"
+    shard.set_current("chat", "http://10.0.0.1:5002", "http://10.0.0.1:5000")
+    assert shard.addresses("chat") == ["http://10.0.0.1:5002", "http://10.0.0.1:5001"]
+    assert shard.closest("chat", "10.0.0.1") == "http://10.0.0.1:5002", "closest returned the replica"
+
+
+def main():
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    check_same_host_migration()
+    for _ in range(args.checks):
+        check_lookups(rng)
+    print(f"{args.checks} lookup checks passed")
+
+    v4 = [f"http://{random_ipv4(rng)}:{rng.randint(1024, 65535)}" for _ in range(args.addresses)]
+    v6 = [f"http://[{random_ipv6(rng)}]:{rng.randint(1024, 65535)}" for _ in range(args.addresses)]
+    v4_queries = [random_ipv4(rng) for _ in range(args.lookups)]
+    v6_queries = [random_ipv6(rng) for _ in range(args.lookups)]
+
+    print(f"{args.addresses} registered addresses per family")
+
+    index = PrefixIndex()
+    timed("add (IPv4 + IPv6)", 2 * args.addresses, lambda: [index.add(a) for a in v4 + v6])
+    timed("closest IPv4", args.lookups, lambda: [index.closest(q) for q in v4_queries])
+    timed("closest IPv6", args.lookups, lambda: [index.closest(q) for q in v6_queries])
+    timed(
+        "baseline scan IPv4",
+        args.baseline_lookups,
+        lambda: [baseline_find_closest_ip(q, v4) for q in v4_queries[: args.baseline_lookups]],
+    )
+
+    timed("remove (IPv4 + IPv6)", 2 * args.addresses, lambda: [index.remove(a) for a in v4 + v6])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""Login cost, memory and migration checks of MessageLog.
+
+A login used to get the whole history sorted from a dict of index -> chat.
+It compares that against the first page of a MessageLog of --messages
+chats, and then measures the memory of the log with every chat in memory
+and with all but the last HOT_SIZE on disk (MessageStore), and the time to
+read an uncached page from the middle of the history in both cases.
+
+Before any of that, --checks randomized runs check the migration of the
+history. A server sends its history to the next one a page at a time, one
+"migrate_history" event of socket.io per page (see
+MigrationManager.request_migration). Each run sends a history through
+socket.io packets that way, and asserts that every packet stays under the
+size engineio accepts and that the history built on the other side is the
+same, in order, keeps taking chats after the migrated ones and pages like
+the original, with the history in memory and with a MessageStore on disk.
+Run it after touching the history or the migration.
+
+Usage: python -m benchmarks.message_log [-m 100000] [--checks 50]
+"""
+import tracemalloc
+from argparse import ArgumentParser
+from random import Random
+from tempfile import TemporaryDirectory
+from timeit import timeit
+
+from engineio.server import Server as EngineServer
+from socketio import packet
+
+from src.server.MessageLog import HOT_SIZE, PAGE_SIZE, MessageLog
+from src.server.MessageStore import MessageStore
+
+parser = ArgumentParser()
+parser.add_argument("-m", "--messages", default=100_000, help="Chats in the history", type=int)
+parser.add_argument("--runs", default=100, help="Timed runs per operation", type=int)
+parser.add_argument("--checks", default=50, help="Randomized runs of the migration checks", type=int)
+parser.add_argument("--seed", default=0, type=int)
+
+
+# engineio's default max_http_buffer_size
+MAX_PACKET_SIZE = EngineServer().max_http_buffer_size
+
+
+def migrate(source: MessageLog, log: MessageLog):
+    """Sends the history of source to log as MigrationManager and Server.on_migrate_history do"""
+    log.clear()
+    since_index = 0
+    while since_index is not None:
+        page = source.page(since_index)
+        encoded = packet.Packet(packet.EVENT, data=["migrate_history", page["messages"]]).encode()
+        assert len(encoded) < MAX_PACKET_SIZE, f"migration packet of {len(encoded)} bytes"
+        for entry in packet.Packet(encoded_packet=encoded).data[1]:
+            log.append(entry["index"], entry["username"], entry["message"])
+        since_index = page["next_index"]
+
+
+def pages(log: MessageLog) -> list:
+    result, since_index = [], 0
+    while since_index is not None:
+        page = log.page(since_index)
+        result += page["messages"]
+        since_index = page["next_index"]
+    return result
+
+
+def check_migration(rng: Random, data_dir: str):
+    page_size = rng.randint(1, 20)
+    hot_size = rng.randint(1, 50)
+    # Indexes with gaps, and some chats arriving late
+    indexes = sorted(rng.sample(range(1000), rng.randint(0, 300)))
+    late = indexes[-10:]
+    rng.shuffle(late)
+
+    source = MessageLog(page_size)
+    for index in indexes[:-10] + late:
+        source.append(index, f"user{index % 7}", f"chat {index}")
+
+    for store in (None, MessageStore(data_dir, segment_size=rng.randint(1, 100))):
+        log = MessageLog(page_size, store=store, hot_size=hot_size)
+        migrate(source, log)
+        assert list(log) == list(source), "migrated history differs"
+        assert log.last_index == source.last_index
+        assert pages(log) == pages(source), "migrated history pages differ"
+
+        # As Server.on_migrate_end, the new chats go after the migrated ones
+        next_index = 0 if log.last_index is None else log.last_index + 1
+        for index in range(next_index, next_index + hot_size + 2 * page_size):
+            log.append(index, "someone", f"chat {index}")
+        assert [e["index"] for e in log] == sorted(set(indexes) | set(range(next_index, index + 1)))
+        if store is not None:
+            store.clear()
+
+
+def login(n: int, runs: int):
+    messages = {i: {"username": "someone", "message": f"chat {i}"} for i in range(n)}
+    log = MessageLog().load(messages)
+    sort_us = timeit(lambda: [x for x in sorted(messages.items())], number=runs) / runs * 1e6
+    page_us = timeit(log.page, number=runs) / runs * 1e6
+    print(f"{n} chats, history on login: sorted dict {sort_us:.0f} us, first page {page_us:.2f} us")
+
+
+def on_disk(n: int, runs: int):
+    with TemporaryDirectory() as data_dir:
+        for store in (None, MessageStore(data_dir)):
+            tracemalloc.start()
+            log = MessageLog(store=store)
+            for i in range(n):
+                log.append(i, "someone", f"chat {i}")
+            memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            # A limit under page_size skips the cache
+            old_us = timeit(lambda: log.page(n // 2, PAGE_SIZE - 1), number=runs) / runs * 1e6
+            where = "in memory" if store is None else f"{HOT_SIZE} in memory, rest on disk"
+            print(f"{n} chats {where}: {memory / 2**20:.1f} MiB, uncached page from the middle {old_us:.0f} us")
+            if store is not None:
+                store.close()
+
+
+def main():
+    args = parser.parse_args()
+    rng = Random(args.seed)
+    with TemporaryDirectory() as data_dir:
+        for _ in range(args.checks):
+            check_migration(rng, data_dir)
+    print(f"{args.checks} migration checks passed")
+
+    login(args.messages, args.runs)
+    on_disk(args.messages, args.runs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""Load generator and latency benchmark of the name server.
+
+Starts a NameServer on loopback in its own process and drives it with
+concurrent synthetic clients (threads spread over several processes, so the
+clients don't compete with the server for the GIL). Every client sends
+requests drawn from a weighted mix over a persistent framed connection, or a
+new connection per request with --reconnect.
+
+Prints a JSON report with throughput and p50/p99/p999 latencies, overall and
+per request type.
+
+Usage: python -m benchmarks.name_server [-c 64] [-d 10] [--mix addr_request=90,update_server=10]
+"""
+import json
+import logging
+import random
+from argparse import ArgumentParser
+from multiprocessing import Process, Queue
+from threading import Thread
+from time import perf_counter
+from typing import Dict, List
+
+from src.name_server.main import ASYNC_MODE, THREAD_MODE, NameServer
+from src.utils.networking import DNSClient
+
+parser = ArgumentParser()
+parser.add_argument("-c", "--clients", default=64, help="Concurrent clients", type=int)
+parser.add_argument("-p", "--procs", default=4, help="Processes to spread the clients over", type=int)
+parser.add_argument("-d", "--duration", default=10.0, help="Seconds to run after warmup", type=float)
+parser.add_argument("--warmup", default=1.0, help="Seconds to run before measuring", type=float)
+parser.add_argument(
+    "--mix",
+    default="addr_request=90,update_server=5,get_random_server=3,get_replica_addr=2",
+    help="Weighted request mix, name=weight separated by commas",
+    type=str,
+)
+parser.add_argument("--uris", default=10, help="Number of URIs in the registry", type=int)
+parser.add_argument("--mode", default=ASYNC_MODE, choices=[ASYNC_MODE, THREAD_MODE], type=str)
+parser.add_argument("--reconnect", action="store_true", help="Open a new connection per request")
+parser.add_argument("--log", action="store_true", help="Keep the name server DEBUG logs on")
+parser.add_argument("-o", "--output", default=None, help="Also write the report to this file", type=str)
+
+
+def random_addr(rng: random.Random) -> str:
+    return f"http://10.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}:{rng.randint(1024, 65535)}"
+
+
+def make_request(name: str, uri: str, rng: random.Random) -> dict:
+    if name == "addr_request":
+        return {"name": name, "uri": uri}
+    if name == "update_server":
+        return {"name": name, "uri": uri, "addr": random_addr(rng)}
+    if name == "get_random_server":
+        return {"name": name, "uri": uri}
+    if name == "get_replica_addr":
+        return {"name": name, "uri": uri, "my_addr": random_addr(rng)}
+    if name == "server_beacon":
+        return {"name": name, "addr": random_addr(rng), "load": rng.random(), "rtt": 0.001}
+    raise ValueError(f"Unknown request type {name}")
+
+
+def run_server(mode: str, log: bool, ports: Queue):
+    if not log:
+        logging.disable(logging.CRITICAL)
+    ns = NameServer(0, n=1024, max_connections=100_000, host="127.0.0.1")
+    ports.put(ns.port)
+    if mode == THREAD_MODE:
+        ns.run()
+    else:
+        ns.run_async()
+
+
+def run_clients(port: int, n_clients: int, args, seed: int, results: Queue):
+    mix = parse_mix(args.mix)
+    names, weights = list(mix), list(mix.values())
+    uris = [f"uri{i}.com" for i in range(args.uris)]
+    start_at = perf_counter() + args.warmup
+    stop_at = start_at + args.duration
+
+    # name -> latencies in seconds
+    latencies: Dict[str, List[float]] = {name: [] for name in names}
+    errors = [0]
+
+    def client(idx: int):
+        rng = random.Random(seed * 100_000 + idx)
+        dns = DNSClient("127.0.0.1", port, pool_size=0 if args.reconnect else 1, retries=0)
+        while True:
+            name = rng.choices(names, weights)[0]
+            req = make_request(name, rng.choice(uris), rng)
+            start = perf_counter()
+            if start > stop_at:
+                break
+            try:
+                dns.request(req)
+            except OSError:
+                errors[0] += 1
+                continue
+            if start >= start_at:
+                latencies[name].append(perf_counter() - start)
+        dns.close()
+
+    threads = [Thread(target=client, args=[i]) for i in range(n_clients)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    results.put((latencies, errors[0]))
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    parsed = {}
+    for item in mix.split(","):
+        name, weight = item.split("=")
+        parsed[name.strip()] = float(weight)
+    return parsed
+
+
+def percentiles(values: List[float]) -> dict:
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+
+    def pct(p: float) -> float:
+        return values[min(len(values) - 1, int(p * len(values)))] * 1000
+
+    return {
+        "count": len(values),
+        "mean_ms": sum(values) / len(values) * 1000,
+        "p50_ms": pct(0.50),
+        "p99_ms": pct(0.99),
+        "p999_ms": pct(0.999),
+        "max_ms": values[-1] * 1000,
+    }
+
+
+def main():
+    args = parser.parse_args()
+    parse_mix(args.mix)  # Fail early on a bad mix
+
+    ports = Queue()
+    server = Process(target=run_server, args=[args.mode, args.log, ports], daemon=True)
+    server.start()
+    port = ports.get(timeout=10)
+
+    # Every URI starts with its two active servers registered
+    dns = DNSClient("127.0.0.1", port)
+    rng = random.Random(0)
+    for i in range(args.uris):
+        for _ in range(2):
+            dns.send_server_addr(f"uri{i}.com", random_addr(rng))
+    dns.close()
+
+    results = Queue()
+    procs = []
+    for i in range(args.procs):
+        n_clients = args.clients // args.procs + (1 if i < args.clients % args.procs else 0)
+        if n_clients:
+            procs.append(Process(target=run_clients, args=[port, n_clients, args, i, results]))
+    for proc in procs:
+        proc.start()
+
+    latencies: Dict[str, List[float]] = {}
+    errors = 0
+    for _ in procs:
+        proc_latencies, proc_errors = results.get()
+        errors += proc_errors
+        for name, values in proc_latencies.items():
+            latencies.setdefault(name, []).extend(values)
+    for proc in procs:
+        proc.join()
+    server.terminate()
+
+    every = [x for values in latencies.values() for x in values]
+    report = {
+        "config": {
+            "clients": args.clients,
+            "procs": args.procs,
+            "duration_s": args.duration,
+            "mix": parse_mix(args.mix),
+            "uris": args.uris,
+            "mode": args.mode,
+            "reconnect": args.reconnect,
+        },
+        "requests": len(every),
+        "errors": errors,
+        "throughput_rps": len(every) / args.duration,
+        "latency": percentiles(every),
+        "per_type": {name: percentiles(values) for name, values in latencies.items()},
+    }
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Lookup throughput of the name server registry against its number of shards.
+
+Reader threads resolve random URIs (get_closest_server) while writer threads
+keep migrating random URIs between two servers (set_current_host), with the
+write-ahead log on so every write holds its shard lock during a log append,
+as it does in production. With a single shard every write stalls every
+lookup; with more shards a write only stalls the lookups of its own shard.
+
+Usage: python -m benchmarks.registry [--shards 1,4,16,64] [--uris 5000] [-d 2]
+"""
+import logging
+import random
+from argparse import ArgumentParser
+from tempfile import TemporaryDirectory
+from threading import Event, Thread
+from time import perf_counter, sleep
+
+from src.name_server.main import NameServer
+
+parser = ArgumentParser()
+parser.add_argument("--shards", default="1,2,4,16,64", help="Shard counts to compare, separated by commas", type=str)
+parser.add_argument("--uris", default=5000, help="Registered URIs", type=int)
+parser.add_argument("--readers", default=8, help="Threads doing lookups", type=int)
+parser.add_argument("--writers", default=2, help="Threads migrating URIs", type=int)
+parser.add_argument("--fsync", action="store_true", help="fsync every log record, as RegistryStore(fsync=True)")
+parser.add_argument("-d", "--duration", default=2.0, help="Seconds to run per shard count", type=float)
+parser.add_argument("--seed", default=0, type=int)
+
+
+def run(shards: int, args) -> dict:
+    with TemporaryDirectory() as data_dir:
+        ns = NameServer(0, host="127.0.0.1", data_dir=data_dir, snapshot_every=10**9, shards=shards)
+        ns.store.fsync = args.fsync
+        uris = [f"chat{i}.com" for i in range(args.uris)]
+        # uri -> its two active servers, plus the one to migrate to
+        servers = {uri: [f"http://10.0.{i % 256}.{j}:8000" for j in (1, 2, 3)] for i, uri in enumerate(uris)}
+        for uri in uris:
+            ns.register_address(uri, servers[uri][0])
+            ns.register_address(uri, servers[uri][1])
+
+        stop = Event()
+        lookups = [0] * args.readers
+        writes = [0] * args.writers
+
+        def reader(i: int):
+            rng = random.Random(args.seed + i)
+            n = 0
+            while not stop.is_set():
+                ns.get_closest_server("10.0.0.9", rng.choice(uris))
+                n += 1
+            lookups[i] = n
+
+        def writer(i: int):
+            rng = random.Random(-args.seed - i - 1)
+            n = 0
+            while not stop.is_set():
+                uri = rng.choice(uris)
+                # Always one of the three is latent
+                active, _ = ns.registry.get(uri)
+                latent = next(s for s in servers[uri] if s not in active)
+                ns.set_current_host(uri, latent, active[0])
+                n += 1
+            writes[i] = n
+
+        threads = [Thread(target=reader, args=(i,)) for i in range(args.readers)]
+        threads += [Thread(target=writer, args=(i,)) for i in range(args.writers)]
+        start = perf_counter()
+        for t in threads:
+            t.start()
+        sleep(args.duration)
+        stop.set()
+        for t in threads:
+            t.join()
+        elapsed = perf_counter() - start
+
+        stats = ns.registry.lock_stats()
+        ns.s.close()
+        ns.store.close()
+        return {
+            "lookups": sum(lookups) / elapsed,
+            "writes": sum(writes) / elapsed,
+            "read_wait_avg": stats["read"]["wait_avg"],
+        }
+
+
+def main():
+    args = parser.parse_args()
+    # set_current_host logs every migration
+    logging.disable(logging.CRITICAL)
+
+    print(f"{args.uris} URIs, {args.readers} readers, {args.writers} writers, {args.duration}s per run")
+    print(f"{'shards':>6} {'lookups/s':>14} {'writes/s':>12} {'avg read wait':>16}")
+    for shards in map(int, args.shards.split(",")):
+        result = run(shards, args)
+        print(
+            f"{shards:>6} {result['lookups']:>14,.0f} {result['writes']:>12,.0f}"
+            f" {result['read_wait_avg'] * 1e6:>13.1f} us"
+        )
+
+
+if __name__ == "__main__":
+    main()
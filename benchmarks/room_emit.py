@@ -0,0 +1,37 @@
+"""Cost of emitting a chat to the chat room, without network.
+
+The managers of python-socketio build and encode the packet again for
+every participant of the room. RoomManager encodes it once and sends the
+same text to all of them. eio.send does nothing, so only the emit itself
+is timed.
+
+Usage: python -m benchmarks.room_emit [--users 1000] [--runs 100]
+"""
+from argparse import ArgumentParser
+from timeit import timeit
+
+import socketio
+
+from src.server.RoomManager import RoomManager
+
+parser = ArgumentParser()
+parser.add_argument("--users", default=1000, help="Users in the room", type=int)
+parser.add_argument("--runs", default=100, help="Timed emits per manager", type=int)
+
+
+def main():
+    args = parser.parse_args()
+    msg = {"message": "hola " * 20, "broadcast_count": 12345, "sender_id": "server", "username": "someone"}
+    for manager in (socketio.BaseManager(), RoomManager()):
+        server = socketio.Server(client_manager=manager)
+        server.eio.send = lambda sid, data: None
+        manager.initialize()
+        for i in range(args.users):
+            sid = manager.connect(f"eio{i}", "/")
+            manager.enter_room(sid, "/", "chat")
+        us = timeit(lambda: server.emit("chat", msg, room="chat"), number=args.runs) / args.runs * 1e6
+        print(f"{type(manager).__name__}: {us:.0f} us per chat to {args.users} users")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+"""Throughput, memory and ordering checks of VectorClock.
+
+--messages messages are spread over every count of --senders, and sent to
+one receiver, which gets them in order, in reverse order (all but the last
+one of a sender are delayed, and the last one received unblocks the whole
+stream of its sender at once) and in a random order, shuffled across
+senders. Besides the time per message, it reports the peak memory of each
+receive, taken in a separate run since tracing allocations slows it down.
+
+The threaded case splits the senders over --threads receiving threads, as
+the threaded socket.io server does, with a delivery callback that blocks
+for --deliver_us (like emitting to a socket). It compares one lock stripe,
+where every delivery waits for the others, against the default striping.
+
+The fan-out case sends one chat to --fanout users, with a send_message per
+user as the server used to, and with a single broadcast_message.
+
+Last, it measures the memory and the migration payload (the pickled dump)
+of the counters of a server clock that talked with --users users (uuid
+strings excluded), against the two dicts of uuid -> counter used before,
+and the dump after --users users came and went with only 1% still online,
+with and without compacting the retired ones.
+
+Before any of that, --checks randomized runs assert the ordering invariants:
+every message delivered exactly once and in the sending order of its
+sender, whatever the arrival order, with duplicated messages, mixed unicast
+and broadcast messages, lost messages recovered by retransmission, and
+receiving threads. A fixed check covers retired ids: one revived within
+the grace period keeps its counters, one retired for longer is forgotten by
+compact, with its delayed messages, and its slot goes to the next new id.
+Run it after touching the clock.
+
+Usage: python -m benchmarks.vector_clock [-m 100000] [--senders 1,100,10000] [--checks 200] [--users 100000]
+"""
+import pickle
+import tracemalloc
+from argparse import ArgumentParser
+from random import Random
+from threading import Lock, Thread
+from time import perf_counter, sleep
+from uuid import uuid4
+
+from src.utils.vectorClock import FIRST_COUNT, LAST_COUNT, MESSAGE, SENDER_ID, VectorClock
+
+parser = ArgumentParser()
+parser.add_argument("-m", "--messages", default=100_000, help="Messages per sender count", type=int)
+parser.add_argument("--senders", default="1,100,10000", help="Sender counts to compare, separated by commas", type=str)
+parser.add_argument("--checks", default=200, help="Randomized runs of the ordering checks", type=int)
+parser.add_argument("--seed", default=0, type=int)
+parser.add_argument("--threads", default=8, help="Receiving threads of the threaded case", type=int)
+parser.add_argument("--deliver_us", default=50, help="Microseconds blocked per delivery, threaded case", type=int)
+parser.add_argument("--fanout", default=1000, help="Destinations of every chat in the fan-out case", type=int)
+parser.add_argument("--users", default=100_000, help="Users known by the clock of the memory case", type=int)
+
+
+def timed(label: str, ops: int, fn):
+    start = perf_counter()
+    fn()
+    elapsed = perf_counter() - start
+    print(f"{label:<40} {elapsed / ops * 1e6:>10.2f} us/op {ops / elapsed:>14,.0f} ops/s")
+
+
+def make_messages(senders: int, messages: int):
+    """Messages of every sender to "receiver", grouped by sender in sending order"""
+    clocks = [VectorClock(f"sender{i}", lambda m: None) for i in range(senders)]
+    return [[clock.send_message(f"m{j}", "receiver") for j in range(messages)] for clock in clocks]
+
+
+def make_receiver(deliver, messages: int, **kwargs) -> VectorClock:
+    # Large enough to never give up on a gap, every message arrives eventually
+    return VectorClock("receiver", deliver, max_delayed=messages, **kwargs)
+
+
+def peak_memory(fn) -> int:
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def throughput(senders: int, messages: int, rng: Random):
+    per_sender = max(1, messages // senders)
+    total = senders * per_sender
+
+    sender = VectorClock("server", lambda m: None)
+    dests = [f"user{i}" for i in range(senders)]
+    timed(f"send, {senders} destinations", total, lambda: [sender.send_message("hi", d) for d in dests * per_sender])
+
+    streams = make_messages(senders, per_sender)
+    in_order = [m for stream in streams for m in stream]
+    shuffled = list(in_order)
+    rng.shuffle(shuffled)
+    orders = {
+        "in order": in_order,
+        "reversed": [m for stream in streams for m in reversed(stream)],
+        "random": shuffled,
+    }
+    for name, arrivals in orders.items():
+        delivered = []
+        receiver = make_receiver(delivered.append, per_sender)
+        timed(f"{name}, {senders} senders", total, lambda: [receiver.receive_message(m) for m in arrivals])
+        assert len(delivered) == total
+
+        receiver = make_receiver(lambda m: None, per_sender)
+        peak = peak_memory(lambda: [receiver.receive_message(m) for m in arrivals])
+        print(f"{'':<40} {peak / total:>10.1f} B/msg {peak / 1024:>11,.0f} KiB peak")
+
+
+def threaded(streams, threads: int, deliver_us: int, stripes: int):
+    receiver = make_receiver(lambda m: sleep(deliver_us / 1e6), max(map(len, streams)), stripes=stripes)
+
+    def receive(i: int):
+        for stream in streams[i::threads]:
+            for m in reversed(stream):
+                receiver.receive_message(m)
+
+    workers = [Thread(target=receive, args=(i,)) for i in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+
+
+def fanout(users: int, chats: int = 100):
+    dests = [f"user{i}" for i in range(users)]
+    clock = VectorClock("server", lambda m: None)
+
+    def per_destination():
+        for _ in range(chats):
+            for dest in dests:
+                msg = clock.send_message("hi", dest)
+                msg["username"] = "someone"
+                msg["index"] = 0
+
+    def broadcast():
+        for _ in range(chats):
+            msg = clock.broadcast_message("hi", dests)
+            msg["username"] = "someone"
+            msg["index"] = 0
+
+    timed(f"fan-out to {users}, send_message each", chats, per_destination)
+    timed(f"fan-out to {users}, broadcast_message", chats, broadcast)
+
+
+def memory(users: int):
+    ids = [str(uuid4()) for _ in range(users)]
+    rng = Random(0)
+
+    tracemalloc.start()
+    # Users that joined earlier got more messages
+    legacy = [
+        {idx: 1000 + (users - i) * 50_000 // users for i, idx in enumerate(ids)},
+        {idx: rng.randint(0, 2000) for idx in ids},
+    ]
+    legacy_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    clock = VectorClock("server", lambda m: None).load_from(legacy)
+    clock_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    dump_size = len(pickle.dumps(clock.dump()))
+    legacy_size = len(pickle.dumps(legacy))
+    print(f"{users} users")
+    print(f"{'memory, dicts by uuid':<40} {legacy_bytes / users:>10.1f} B/user")
+    print(f"{'memory, interned slots':<40} {clock_bytes / users:>10.1f} B/user")
+    print(f"{'dump, dicts by uuid':<40} {legacy_size / users:>10.1f} B/user")
+    print(f"{'dump, delta encoded':<40} {dump_size / users:>10.1f} B/user")
+
+
+def churn(users: int, online: int):
+    clock = VectorClock("server", lambda m: None)
+    ids = [str(uuid4()) for _ in range(users)]
+    for i, idx in enumerate(ids):
+        clock.send_message("hi", idx)
+        if i < users - online:
+            clock.retire(idx)
+
+    before = len(pickle.dumps(clock.dump()))
+    forgotten = clock.compact(0)
+    after = len(pickle.dumps(clock.dump()))
+    print(f"{'dump, all-time users':<40} {before:>10,} B")
+    print(f"{'dump, online users only':<40} {after:>10,} B ({forgotten:,} users forgotten)")
+
+
+def check_run(rng: Random):
+    """One randomized run of the ordering checks, asserts on any violation"""
+    senders = [VectorClock(f"sender{i}", lambda m: None) for i in range(rng.randint(1, 8))]
+    by_sender = {clock.idx: clock for clock in senders}
+    others = [f"other{i}" for i in range(rng.randint(0, 3))]
+
+    delivered = []
+    lock = Lock()
+
+    def deliver(message):
+        with lock:
+            delivered.append(message)
+
+    receiver = VectorClock("receiver", deliver, stripes=rng.choice((1, 4, 64)), gap_timeout=0, max_delayed=10**6)
+
+    # Every sender sends unicast and broadcast messages, some only to others
+    sent = {clock.idx: [] for clock in senders}
+    arrivals = []
+    for clock in senders:
+        if rng.random() < 0.5:
+            # Its messages to "receiver" go through broadcasts from now on
+            receiver.set_broadcast_base(clock.idx, clock.broadcast_base("receiver"))
+            dests = ["receiver"] + others
+            for j in range(rng.randint(1, 40)):
+                message = clock.broadcast_message(f"{clock.idx}-{j}", dests)
+                sent[clock.idx].append(message[MESSAGE])
+                arrivals.append(message)
+        else:
+            for j in range(rng.randint(1, 40)):
+                if others and rng.random() < 0.3:
+                    clock.send_message("not for receiver", rng.choice(others))
+                message = clock.send_message(f"{clock.idx}-{j}", "receiver")
+                sent[clock.idx].append(message[MESSAGE])
+                arrivals.append(message)
+
+    # Lose some, but never the last one of a sender: nothing would tell the
+    # receiver it is missing
+    last = {m[SENDER_ID]: m for m in arrivals}
+    lost = [m for m in arrivals if m is not last[m[SENDER_ID]] and rng.random() < 0.1]
+    arrivals = [m for m in arrivals if not any(m is l for l in lost)]
+    duplicates = rng.choices(arrivals, k=rng.randint(0, 5))
+    arrivals += duplicates
+    rng.shuffle(arrivals)
+
+    threads = rng.choice((1, 1, 4))
+    workers = [
+        Thread(target=lambda part: [receiver.receive_message(m) for m in part], args=(arrivals[i::threads],))
+        for i in range(threads)
+    ]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+
+    for _ in range(len(lost) + 1):
+        requests = receiver.check_gaps()
+        if not requests:
+            break
+        for request in requests:
+            clock = by_sender[request[SENDER_ID]]
+            for m in clock.retransmit("receiver", request[FIRST_COUNT], request[LAST_COUNT]):
+                receiver.receive_message(m)
+
+    got = {idx: [] for idx in sent}
+    for m in delivered:
+        got[m[SENDER_ID]].append(m[MESSAGE])
+    assert got == sent, (got, sent)
+    assert receiver.received_messages == {idx: len(messages) for idx, messages in sent.items()}
+    assert not any(receiver.delayed_messages.values()) and not receiver.gaps
+    # A lost message retransmitted more than once is a duplicate too
+    assert receiver.stats.duplicates >= len(duplicates)
+    assert receiver.stats.messages_lost == 0
+
+
+def check_retirement():
+    delivered = []
+    receiver = VectorClock("receiver", lambda m: delivered.append(m[MESSAGE]))
+    alice, bob = VectorClock("alice", lambda m: None), VectorClock("bob", lambda m: None)
+    for i in range(3):
+        receiver.receive_message(alice.send_message(f"alice-{i}", "receiver"))
+    bob_messages = [bob.send_message(f"bob-{i}", "receiver") for i in range(3)]
+    receiver.receive_message(bob_messages[0])
+    # Waits for the one before it
+    receiver.receive_message(bob_messages[2])
+
+    # Both leave, alice comes back within the grace period
+    receiver.retire("alice")
+    receiver.retire("bob")
+    receiver.revive("alice")
+    assert receiver.compact(60) == 0, "compact forgot an id within the grace period"
+    assert receiver.received_messages["bob"] == 1 and receiver.delayed_messages["bob"]
+    bob_slot = receiver.slots["bob"]
+
+    # After it, only bob is forgotten, with his delayed message
+    assert receiver.compact(0) == 1
+    assert "bob" not in receiver.slots and not receiver.delayed_messages.get("bob")
+    assert receiver.received_messages["alice"] == 3
+    receiver.receive_message(alice.send_message("alice-3", "receiver"))
+    assert delivered == ["alice-0", "alice-1", "alice-2", "bob-0", "alice-3"], delivered
+
+    # His slot goes to the next new id, from zero
+    receiver.receive_message(VectorClock("carol", lambda m: None).send_message("carol-0", "receiver"))
+    assert receiver.slots["carol"] == bob_slot
+    assert receiver.received_messages["carol"] == 1 and delivered[-1] == "carol-0"
+
+
+def main():
+    args = parser.parse_args()
+    rng = Random(args.seed)
+
+    check_retirement()
+    for _ in range(args.checks):
+        check_run(rng)
+    print(f"{args.checks} randomized ordering checks passed")
+
+    for senders in map(int, args.senders.split(",")):
+        throughput(senders, args.messages, rng)
+
+    # Fewer messages, each delivery blocks
+    streams = make_messages(args.threads * 4, max(1, args.messages // 1000))
+    total = sum(map(len, streams))
+    for stripes in (1, 64):
+        timed(
+            f"{args.threads} threads, {stripes} stripes",
+            total,
+            lambda: threaded(streams, args.threads, args.deliver_us, stripes),
+        )
+
+    fanout(args.fanout)
+    memory(args.users)
+    churn(args.users, max(1, args.users // 100))
+
+
+if __name__ == "__main__":
+    main()
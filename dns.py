@@ -1,3 +1,70 @@
-from src.name_server.main import serve
+from argparse import ArgumentParser
 
-serve()
+from src.name_server.main import ASYNC_MODE, THREAD_MODE, serve
+
+parser = ArgumentParser()
+
+parser.add_argument(
+    "-p",
+    "--port",
+    default=8000,
+    help="Port to listen on",
+    type=int,
+)
+parser.add_argument(
+    "--backlog",
+    default=128,
+    help="Maximum number of pending connections queued by the kernel",
+    type=int,
+)
+parser.add_argument(
+    "--max_connections",
+    default=1024,
+    help="Maximum number of connections served at the same time",
+    type=int,
+)
+parser.add_argument(
+    "--mode",
+    default=ASYNC_MODE,
+    choices=[ASYNC_MODE, THREAD_MODE],
+    help="Serve every connection on one event loop (async) or one thread per connection (thread)",
+    type=str,
+)
+parser.add_argument(
+    "--data_dir",
+    default=None,
+    help="Directory to persist the registry in, so it survives restarts",
+    type=str,
+)
+parser.add_argument(
+    "--metrics_port",
+    default=None,
+    help="Serve metrics on http://127.0.0.1:METRICS_PORT/metrics",
+    type=int,
+)
+parser.add_argument(
+    "--shards",
+    default=16,
+    help="Number of independently locked shards the registry is split into",
+    type=int,
+)
+parser.add_argument(
+    "--active_set_size",
+    default=2,
+    help="Maximum number of active servers per URI",
+    type=int,
+)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    serve(
+        args.port,
+        args.backlog,
+        args.max_connections,
+        args.mode,
+        args.data_dir,
+        args.metrics_port,
+        args.shards,
+        args.active_set_size,
+    )
@@ -1,7 +1,9 @@
 from argparse import ArgumentParser
 import socket
 from src.client.client_socket import ClientSockets
+from src.server.Batcher import BATCH_DELAY, BATCH_SIZE
 from src.server.MigrationManager import MigrationManager
+from src.server.Server import ASYNC_MODE, THREAD_MODE
 from threading import Thread
 import logging
 
@@ -35,12 +37,54 @@ parser.add_argument(
     help="Minimum number of clients before starting the connection.",
     type=int,
 )
+parser.add_argument(
+    "--server_mode",
+    default=THREAD_MODE,
+    choices=[THREAD_MODE, ASYNC_MODE],
+    help="Serve every connection on one thread (thread) or all of them on one event loop (async)",
+    type=str,
+)
+parser.add_argument(
+    "--history_dir",
+    default=None,
+    help="Directory where the server keeps the chat history older than the last ones, instead of memory. "
+    "Deleted when the server exits, history is not kept across restarts",
+    type=str,
+)
+parser.add_argument(
+    "--history_retention",
+    default=None,
+    help="Seconds the chat history is kept in --history_dir. Forever if not given",
+    type=float,
+)
+parser.add_argument(
+    "--batch_size",
+    default=BATCH_SIZE,
+    help="Maximum chats the server sends in one event. 1 sends every chat on its own",
+    type=int,
+)
+parser.add_argument(
+    "--batch_ms",
+    default=BATCH_DELAY * 1000,
+    help="Maximum milliseconds the server holds a chat to send it with the next ones",
+    type=float,
+)
 
 if __name__ == "__main__":
     args = parser.parse_args()
 
     # Server en otro thread
-    server = MigrationManager(args.dns_ip, args.dns_port, args.server_uri, args.min_n)
+    server = MigrationManager(
+        args.dns_ip,
+        args.dns_port,
+        args.server_uri,
+        args.min_n,
+        args.server_mode,
+        args.history_dir,
+        args.history_retention,
+        args.batch_size,
+        args.batch_ms / 1000,
+    )
     server_th = Thread(target=server.start)
     server_th.start()
 
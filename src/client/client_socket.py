@@ -1,12 +1,13 @@
 import logging
 from collections import deque
-from src.utils.networking import request_server_adrr
+from time import monotonic
+from src.utils.networking import DNSClient, get_dns_client
 
 import socketio
 from colorama import Fore as Color
 
 from src.client.p2p import P2P
-from src.utils.vectorClock import VectorClock
+from src.utils.vectorClock import FIRST_COUNT, GAP_CHECK_INTERVAL, LAST_COUNT, SENDER_ID, VectorClock
 
 from .gui_socketio import GUI
 
@@ -17,6 +18,7 @@ class ClientSockets:
     def __init__(self, dns_ip: str, dns_port: int, server_uri: str) -> None:
         self.dns_host = dns_ip
         self.dns_port = dns_port
+        self.dns: DNSClient = get_dns_client(dns_ip, dns_port)
         self.server_uri = server_uri
         self.gui = GUI(
             self.server_connect, self.send_private_message, self.send_message
@@ -28,12 +30,17 @@ class ClientSockets:
         self.__outbound = deque()
         self.__sendNext = False
         self.__pauseMessages = False
+        # Index of the next history page to ask for, if any
+        self.__history_cursor = None
 
         self.clock = None
         self.flag = True
         self.reconnecting = False
 
     def initialize(self):
+        # Keep the cached server address fresh: the DNS pushes every change
+        self.dns.watch(self.server_uri)
+
         # Initialize connection to server
         self.initialize_server_connection()
 
@@ -55,9 +62,11 @@ class ClientSockets:
         self.server_io.on("send_uuid", self.receive_uuid)
         self.server_io.on("server_message", self.server_message)
         self.server_io.on("chat", self.chat_message)
+        self.server_io.on("chat_batch", self.chat_message)
         self.server_io.on("message_history", self.chat_message_history)
         self.server_io.on("pause_messaging", self.receive_pause_messages_signal)
         self.server_io.on("reconnect", self.reconnect)
+        self.server_io.on("retransmit", self.retransmit)
 
     def connect(self):
         logger.debug("Initializing chat GUI")
@@ -70,14 +79,18 @@ class ClientSockets:
             self.flag = False
 
     def reconnect(self):
+        # The server only asks to reconnect after announcing the new one to the DNS
+        self.dns.cache.invalidate(self.server_uri)
         self.reconnecting = True
         self.server_io.disconnect()
         self.initialize_server_connection()
         self.server_connect(self.gui.name, self.reconnecting)
         return True
 
-    def receive_uuid(self, uuid: str):
+    def receive_uuid(self, uuid: str, broadcast_base: int = 0):
         self.clock = VectorClock(uuid, self.__on_deliver_message)
+        # Chats from the server are broadcasts, see VectorClock.broadcast_message
+        self.clock.set_broadcast_base("server", broadcast_base)
         self.p2p.clock = self.clock
 
     def receive_pause_messages_signal(self, pause: bool):
@@ -90,9 +103,23 @@ class ClientSockets:
 
     def chat_message(self, data):
         # Cuando llega un mensaje de un usuario, formatearlo
-        # y agregarlo en la gui
+        # y agregarlo en la gui. A "chat_batch" brings a list of them
         logger.debug(f"Chat received {data}")
-        self.clock.receive_message(data)
+        for msg in data if isinstance(data, list) else (data,):
+            self.clock.receive_message(msg)
+
+    def retransmit(self, data):
+        # The server lost some of our chats, send them again
+        for msg in self.clock.retransmit("server", data[FIRST_COUNT], data[LAST_COUNT]):
+            self.server_io.emit("chat", msg)
+
+    def __check_gaps(self):
+        # Ask the server again for the chats missing before the delayed ones.
+        # Private messages can't be asked again, check_gaps gives up on them.
+        for request in self.clock.check_gaps():
+            if request[SENDER_ID] == "server":
+                logger.debug(f"Asking the server to retransmit {request}")
+                self.server_io.emit("retransmit", request)
 
     def __on_deliver_message(self, message: dict):
         self.gui.addMessage(f"<{message['username']}> {message['message']}")
@@ -103,6 +130,10 @@ class ClientSockets:
         for msg in data["messages"]:
             self.gui.addMessage(f"<{msg['username']}> {msg['message']}")
 
+        # History comes in pages, __run asks for the next one. The first page
+        # may arrive before the connection is done, when it can't emit yet
+        self.__history_cursor = data.get("next_index")
+
     def __setSendNext(self, val: bool):
         # Utility function
         logger.debug("Send next")
@@ -113,7 +144,20 @@ class ClientSockets:
         # Only sends a message if the previous one has been
         # acknowledged by the server.
         self.__sendNext = True
+        next_gap_check = monotonic() + GAP_CHECK_INTERVAL
         while True:
+            if self.clock is not None and monotonic() >= next_gap_check:
+                next_gap_check = monotonic() + GAP_CHECK_INTERVAL
+                self.__check_gaps()
+
+            if self.__history_cursor is not None:
+                cursor, self.__history_cursor = self.__history_cursor, None
+                self.server_io.emit(
+                    "history",
+                    {"since_index": cursor},
+                    callback=self.chat_message_history,
+                )
+
             if self.__outbound and self.__sendNext and not self.__pauseMessages:
                 logger.debug(f"Outbound length: {len(self.__outbound)}")
                 # Prevent other messages from being sent
@@ -139,21 +183,24 @@ class ClientSockets:
 
     def server_connect(self, name, reconnecting=False):
         # Get server address
-        server_address = request_server_adrr(
-            self.dns_host, self.dns_port, self.server_uri
-        )
+        server_address = self.dns.request_server_addr(self.server_uri)
         logger.debug(f"Obtained server address: {server_address}")
         # Connect to the server.
         # Sends session information, such as name, port and p2p server url.
         logger.debug(f"Connecting to server {self.server_uri}")
-        self.server_io.connect(
-            server_address,
-            auth={
-                "username": name,
-                "publicUri": f"http://{self.public_ip}:{self.port}",
-                "reconnecting": reconnecting
-            },
-        )
+        try:
+            self.server_io.connect(
+                server_address,
+                auth={
+                    "username": name,
+                    "publicUri": f"http://{self.public_ip}:{self.port}",
+                    "reconnecting": reconnecting
+                },
+            )
+        except Exception:
+            # The cached address may be stale, ask the DNS again next time
+            self.dns.cache.invalidate(self.server_uri)
+            raise
         self.__pauseMessages = False
 
     def send_message(self, message: str):
@@ -1,6 +1,6 @@
-from ipaddress import IPv4Network
-from typing import List, Set, Union
-import re
+from ipaddress import IPv4Address, IPv6Address, ip_address
+from typing import Dict, List, Optional, Set, Union
+from urllib.parse import urlsplit
 from colorama.ansi import Fore
 import logging
 
@@ -10,52 +10,186 @@ logger = logging.getLogger(f"{Fore.GREEN}[DNS]{Fore.RESET}")
 
 
 def clean_ip(ip: str) -> str:
-    http_pattern = r"https?://"
-    port_pattern = r":\d+"
-    return re.sub(port_pattern, "", re.sub(http_pattern, "", ip))
+    """Removes the scheme and port from an address (http://ip:port -> ip)"""
+    if "//" not in ip:
+        ip = f"//{ip}"
+    host = urlsplit(ip).hostname
+    return host or ""
 
 
-def find_closest_ip(self_ip: str, ips: Union[List[str], Set[str]]) -> str:
-    """Selects the closest IP from a list of IPs.
+def parse_ip(address: str) -> Optional[Union[IPv4Address, IPv6Address]]:
+    """Parses the IP of an address like http://ip:port, ip:port or ip. None if it isn't an IP"""
+    try:
+        return ip_address(address)
+    except ValueError:
+        pass
+    try:
+        return ip_address(clean_ip(address))
+    except ValueError:
+        return None
+
+
+# Rank of an empty subtree
+_NO_RANK = float("inf")
 
-    Args:
-        self_ip: The ip to make the lookup for
-        ips: An iterable of ips to select the closest one to self_ip
 
-    Returns:
-        An IP address which has the largest matching sub network of self_ip
+class _Node:
+    __slots__ = ("children", "count", "first", "addresses")
+
+    def __init__(self) -> None:
+        self.children: List[Optional[_Node]] = [None, None]
+        # Number of addresses stored in this subtree
+        self.count = 0
+        # Lowest rank of the addresses stored in this subtree
+        self.first = _NO_RANK
+        # Addresses with exactly this IP, by rank. Only used on leaves
+        self.addresses: Optional[List[str]] = None
+
+
+class PrefixIndex:
+    """Longest prefix match index of server addresses.
+
+    Addresses are stored in a binary radix trie keyed by the bits of their IP
+    as an integer (one trie for IPv4 and one for IPv6). A lookup walks the bits
+    of the requesting IP once, so its cost depends on the IP length and not on
+    the number of registered addresses. Addresses whose host is not an IP
+    (e.g. localhost) only match an identical host.
+
+    Every address has a rank, the order in which it was added unless given.
+    When several addresses share the longest prefix (e.g. servers on the same
+    host), the one with the lowest rank wins. The registry adds addresses in
+    its own order and replaces them in place (see replace), so ties resolve
+    as they did scanning its list of addresses.
     """
-    logger.debug(f"Finding closest server to {self_ip} from {ips}")
-    # Clean ips (remove https y :port)
-    clean_self_ip = clean_ip(self_ip)
-    clean_ips = list(map(clean_ip, ips))
 
-    try:
-        # If the same IP has a server. Return that IP
-        ip_index = clean_ips.index(clean_self_ip)
-        logger.debug(f"Closest server to {self_ip} is {ips[ip_index]}")
-        return ips[ip_index]
-    except ValueError:
-        pass
+    def __init__(self, addresses: Union[List[str], Set[str]] = ()) -> None:
+        self._roots: Dict[int, _Node] = {4: _Node(), 6: _Node()}
+        self._others: Dict[str, List[str]] = {}  # host -> [address1, address2, ...]
+        self._ranks: Dict[str, int] = {}  # address -> rank
+        self._next_rank = 0
+        for address in addresses:
+            self.add(address)
+
+    def __len__(self) -> int:
+        return self._roots[4].count + self._roots[6].count + sum(map(len, self._others.values()))
+
+    def add(self, address: str, rank: Optional[int] = None):
+        if rank is None:
+            rank = self._next_rank
+        self._next_rank = max(self._next_rank, rank + 1)
+        self._ranks[address] = rank
+
+        ip = parse_ip(address)
+        if ip is None:
+            same_host = self._others.setdefault(clean_ip(address), [])
+            same_host.append(address)
+            same_host.sort(key=self._ranks.__getitem__)
+            return
+
+        key, bits = int(ip), ip.max_prefixlen
+        node = self._roots[ip.version]
+        node.count += 1
+        node.first = min(node.first, rank)
+        for depth in range(bits):
+            bit = (key >> (bits - 1 - depth)) & 1
+            child = node.children[bit]
+            if child is None:
+                child = node.children[bit] = _Node()
+            node = child
+            node.count += 1
+            node.first = min(node.first, rank)
+
+        if node.addresses is None:
+            node.addresses = []
+        node.addresses.append(address)
+        if len(node.addresses) > 1:
+            node.addresses.sort(key=self._ranks.__getitem__)
+
+    def replace(self, old_address: str, address: str) -> bool:
+        """Replaces old_address by address, which takes its rank. Returns
+        False if old_address wasn't in the index"""
+        rank = self._ranks.get(old_address)
+        if not self.remove(old_address):
+            return False
+        self.add(address, rank)
+        return True
+
+    def remove(self, address: str) -> bool:
+        """Removes an address. Returns False if it wasn't in the index"""
+        ip = parse_ip(address)
+        if ip is None:
+            same_host = self._others.get(clean_ip(address), [])
+            if address not in same_host:
+                return False
+            same_host.remove(address)
+            if not same_host:
+                del self._others[clean_ip(address)]
+            del self._ranks[address]
+            return True
+
+        key, bits = int(ip), ip.max_prefixlen
+        path = [self._roots[ip.version]]
+        for depth in range(bits):
+            node = path[-1].children[(key >> (bits - 1 - depth)) & 1]
+            if node is None:
+                return False
+            path.append(node)
+
+        leaf = path[-1]
+        if not leaf.addresses or address not in leaf.addresses:
+            return False
+        leaf.addresses.remove(address)
+        del self._ranks[address]
+
+        for node in reversed(path):
+            node.count -= 1
+            left, right = node.children
+            node.first = self._ranks[node.addresses[0]] if node.addresses else _NO_RANK
+            if left is not None and left.first < node.first:
+                node.first = left.first
+            if right is not None and right.first < node.first:
+                node.first = right.first
+
+        # Prune the branch that was left empty
+        for depth in range(1, len(path)):
+            if path[depth].count == 0:
+                path[depth - 1].children[(key >> (bits - depth)) & 1] = None
+                break
+        return True
+
+    def closest(self, self_ip: str) -> Optional[str]:
+        """Selects the address which has the longest matching prefix with self_ip.
+
+        Returns None if no address shares at least one bit of prefix with self_ip.
+        """
+        ip = parse_ip(self_ip)
+        if ip is None:
+            same_host = self._others.get(clean_ip(self_ip))
+            return same_host[0] if same_host else None
 
-    # Start with the largest posible subnet mask
-    mask = 24
-    while mask:
-        self_net = IPv4Network(f"{clean_self_ip}/{mask}", strict=False)
+        key, bits = int(ip), ip.max_prefixlen
+        node = self._roots[ip.version]
+        depth = 0
+        # Follow self_ip down the trie as far as possible
+        while depth < bits:
+            child = node.children[(key >> (bits - 1 - depth)) & 1]
+            if child is None:
+                break
+            node = child
+            depth += 1
 
-        # Check if any IP has the same subnet as self_ip
-        for i, other_ip in enumerate(clean_ips):
-            other_net = IPv4Network(f"{other_ip}/{mask}", strict=False)
-            if self_net == other_net:
-                logger.debug(f"Closest server to {self_ip} is {ips[i]}")
-                return ips[i]
+        if depth == 0:
+            return None
 
-        mask -= 1
-    logger.error(f"No server found closest to {self_ip}")
+        # Any address under this node shares the longest prefix. Go down to the lowest ranked
+        while node.addresses is None:
+            left, right = node.children
+            node = left if left is not None and left.first == node.first else right
+        return node.addresses[0]
 
 
 if __name__ == "__main__":
 
     ips = ["192.168.2.124", "http://127.0.0.1:3000", "http://192.168.2.168:5000"]
     self_ip = "192.168.1.0:3030"
-    print(find_closest_ip(self_ip, ips))
+    print(PrefixIndex(ips).closest(self_ip))
@@ -6,21 +6,63 @@ applicable to local-area networks.
 
 
 """
+import asyncio
 import logging
 import pickle as pkl
 from datetime import datetime
+from queue import Full, Queue
 import socket
-from threading import Thread
-from random import choice
+from threading import BoundedSemaphore, Lock, Thread
+from time import perf_counter
+from typing import Callable, List, Optional, Set
 
 from colorama.ansi import Fore
 
-from .ip_lookup import find_closest_ip
-from .rw_lock import get_rwlock
+from ..utils import protocol
+from .metrics import MetricsRegistry, serve_metrics
+from .persistence import RegistryStore
+from .registry import Registry
+from .server_pool import ServerPool
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(f"{Fore.GREEN}[DNS]{Fore.RESET}")
 
+THREAD_MODE = "thread"
+ASYNC_MODE = "async"
+
+# Changes waiting to be sent to a watcher. One that falls this far behind is dropped
+WATCH_QUEUE_SIZE = 256
+
+# Read only requests that may come in a datagram, see handle_datagram. Not
+# get_random_server: every pick counts a migration to the server, so a resent
+# datagram would count it twice
+DATAGRAM_REQUESTS = frozenset({"addr_request", "get_replica_addr", "batch"})
+
+_NUMBER = (int, float)
+# request name -> { field: type } of the fields its handler reads, see valid_request.
+# Optional fields allow None
+REQUEST_FIELDS = {
+    "update_server": {"uri": str, "addr": str},
+    "addr_request": {"uri": str},
+    "get_random_server": {"uri": str},
+    "set_current_server": {"uri": str, "addr": str, "self_addr": str},
+    "get_replica_addr": {"uri": str, "my_addr": str},
+    "server_beacon": {"addr": str, "load": _NUMBER, "rtt": (*_NUMBER, type(None))},
+    "report_failure": {"addr": str},
+    "batch": {"requests": list},
+    "lock_stats": {},
+    "watch": {"uri": str},
+    "unwatch": {"uri": str},
+}
+
+
+def valid_request(req) -> bool:
+    """Whether req is a request with a known name and the fields its handler reads"""
+    if not isinstance(req, dict) or not isinstance(req.get("name"), str):
+        return False
+    fields = REQUEST_FIELDS.get(req["name"])
+    return fields is not None and all(isinstance(req.get(field), types) for field, types in fields.items())
+
 
 def ctime():
     now = datetime.now()
@@ -28,8 +70,43 @@ def ctime():
     return current_time
 
 
+class _DatagramProtocol(asyncio.DatagramProtocol):
+    """Answers datagrams on the event loop, see NameServer.handle_datagram"""
+
+    def __init__(self, ns: "NameServer") -> None:
+        self.ns = ns
+        self.transport = None
+
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr):
+        try:
+            response = self.ns.handle_datagram(data, addr)
+        except Exception as e:
+            logger.error(f"[{ctime()}] Dropping datagram from {addr[0]}: {e!r}")
+            return
+        if response is not None:
+            self.transport.sendto(response, addr)
+
+    def error_received(self, exc: Exception):
+        logger.debug(exc)
+
+
 class NameServer:
-    def __init__(self, port=8000, n=10):
+    def __init__(
+        self,
+        port=8000,
+        n=10,
+        max_connections=1024,
+        host=None,
+        idle_timeout=60,
+        data_dir=None,
+        snapshot_every=1000,
+        metrics_port=None,
+        shards=16,
+        active_set_size=2,
+    ):
         """Initializes a name server with forwarding pointers of the form
         (stub, scion) for clients stubs and server stubs.
 
@@ -45,36 +122,181 @@ class NameServer:
         port : int
             Port on which the server will be listening for requests
         n : int
-            Maximum number of processes to listen
+            Listen backlog, i.e. pending connections queued by the kernel
+        max_connections : int
+            Maximum number of connections served at the same time. With run,
+            extra connections wait in the backlog until a slot is released.
+            With run_async they are accepted right away, and wait on the
+            event loop for a slot before their requests are read.
+            Connections that watch a URI give their slot back, see
+            accept_connection
+        host : str
+            IP to bind to. Defaults to the IP of this machine
+        idle_timeout : float
+            Seconds a connection may stay idle before it is closed
+        data_dir : str
+            Directory where the registry is persisted. When given, the
+            registry of the previous run is restored at startup
+        snapshot_every : int
+            Registry mutations logged before compacting them into a snapshot
+        metrics_port : int
+            When given, metrics are served on http://127.0.0.1:metrics_port/metrics
+        shards : int
+            Number of independently locked shards of the registry, see Registry
+        active_set_size : int
+            Maximum number of active servers per URI
         """
-        self.host = socket.gethostbyname(socket.gethostname())
+        self.host = host or socket.gethostbyname(socket.gethostname())
         self.port = port
         self.n = n
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.active_connections = 0
 
-        self.server_reader, self.server_writer = get_rwlock()
-
+        self.registry = Registry(shards, active_set_size)  # uri -> active servers
         self.addresses = set()  # set(http://ip:port)
-        self.uri2address = dict()  # uri -> [address1, address2, ...]
+        self.pool = ServerPool()  # load and health of every server in addresses
+
+        self.watchers = dict()  # uri -> set(push), see watch
+        self._watchers_lock = Lock()
+
+        self.store = None
+        # Appends to the log come from every shard
+        self._store_lock = Lock()
+        if data_dir:
+            self.store = RegistryStore(data_dir, snapshot_every)
+            self._restore()
+            self.store.open()
+
+        # request name -> handler(req, client_addr) -> response
+        self.handlers = {
+            "update_server": self.on_update_server,
+            "addr_request": self.on_addr_request,
+            "get_random_server": self.on_get_random_server,
+            "set_current_server": self.on_set_current_server,
+            "get_replica_addr": self.on_get_replica_addr,
+            "server_beacon": self.on_server_beacon,
+            "report_failure": self.on_report_failure,
+            "batch": self.on_batch,
+            "lock_stats": self.on_lock_stats,
+        }
+
+        self.metrics = MetricsRegistry()
+        self._setup_metrics()
+        if metrics_port is not None:
+            serve_metrics(self.metrics, metrics_port)
 
         # initialize NS
         self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Allow restarting on the same port right away
+        self.s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.s.bind((self.host, self.port))
+        # The OS picks the port when port is 0
+        self.port = self.s.getsockname()[1]
         self.s.listen(n)
 
+        # Resolution queries over UDP, on the same port
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.bind((self.host, self.port))
+
         logger.debug(f"[{ctime()}] Name Server up and running on" f" IP: {self.host}, PORT: {self.port}")
 
     def run(self):
-        """Runs the Name Server"""
+        """Runs the Name Server, with one thread per connection"""
 
+        Thread(target=self._serve_datagrams, daemon=True).start()
         logger.debug(f"[{ctime()}] Accepting connections")
+        slots = BoundedSemaphore(self.max_connections)
         while True:
+            # Don't accept more than max_connections at once, the rest wait in the backlog
+            slots.acquire()
             logger.debug(f"[{ctime()}] Waiting for next connection")
             (conn, addr) = self.s.accept()
             if conn:
-                client_th = Thread(target=self.accept_connection, args=[conn, addr])
+                client_th = Thread(target=self.accept_connection, args=[conn, addr, slots], daemon=True)
                 client_th.start()
+            else:
+                slots.release()
+
+    def run_async(self):
+        """Runs the Name Server on a single asyncio event loop"""
+        asyncio.run(self._serve_async())
+
+    async def _serve_async(self):
+        slots = asyncio.Semaphore(self.max_connections)
+
+        async def on_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            # Already accepted, waits here (not in the backlog) for a slot
+            await slots.acquire()
+            await self.accept_async_connection(reader, writer, slots)
+
+        self.udp.setblocking(False)
+        await asyncio.get_running_loop().create_datagram_endpoint(lambda: _DatagramProtocol(self), sock=self.udp)
 
-    def accept_connection(self, conn: socket.socket, addr):
+        self.s.setblocking(False)
+        server = await asyncio.start_server(on_connection, sock=self.s)
+        logger.debug(f"[{ctime()}] Accepting connections on event loop")
+        async with server:
+            await server.serve_forever()
+
+    def _serve_datagrams(self):
+        while True:
+            try:
+                data, addr = self.udp.recvfrom(65535)
+                response = self.handle_datagram(data, addr)
+                if response is not None:
+                    self.udp.sendto(response, addr)
+            except OSError as e:
+                logger.debug(e)
+            except Exception as e:
+                # One bad datagram must not stop the listener
+                logger.error(f"[{ctime()}] Dropping datagram from {addr[0]}: {e!r}")
+
+    def handle_datagram(self, data: bytes, addr) -> Optional[bytes]:
+        """Answers a request that came in a datagram. None if it must be dropped
+
+        Datagrams hold a single frame whose request has an "id", echoed in the
+        response. Requests not in DATAGRAM_REQUESTS and responses larger than
+        a datagram are answered with {"name": "tcp_required"}, so the client
+        repeats them over a connection.
+        """
+        try:
+            req = protocol.unpack_frame(data)
+        except protocol.ProtocolError as e:
+            logger.debug(f"[{ctime()}] Dropping datagram from {addr[0]}: {e}")
+            return None
+        if not isinstance(req, dict) or "id" not in req:
+            return None
+
+        self._datagrams.inc()
+        if not isinstance(req.get("name"), str):
+            return protocol.pack_frame({"name": "empty", "id": req["id"]})
+        if not self._fits_datagram(req):
+            return self._tcp_required(req["id"])
+
+        frame = protocol.pack_frame({**self.handle_request(req, addr), "id": req["id"]})
+        if len(frame) > protocol.MAX_DATAGRAM_SIZE:
+            return self._tcp_required(req["id"])
+        return frame
+
+    def _tcp_required(self, req_id) -> bytes:
+        self._datagram_fallbacks.inc()
+        return protocol.pack_frame({"name": "tcp_required", "id": req_id})
+
+    @staticmethod
+    def _fits_datagram(req: dict) -> bool:
+        if req.get("name") == "batch":
+            requests = req.get("requests")
+            return isinstance(requests, list) and all(
+                isinstance(r, dict)
+                and isinstance(r.get("name"), str)
+                and r["name"] in DATAGRAM_REQUESTS
+                and r["name"] != "batch"
+                for r in requests
+            )
+        return req.get("name") in DATAGRAM_REQUESTS
+
+    def accept_connection(self, conn: socket.socket, addr, slot: Optional[BoundedSemaphore] = None):
         """Manages a connection
 
         Incoming requests must come with the following structure:
@@ -83,66 +305,387 @@ class NameServer:
             name: The type of request
             ...other_data: Data relevant to the request type
         }
+
+        Framed connections (see src/utils/protocol.py) may carry any number
+        of requests, answered in order, and watch URIs. Legacy connections
+        carry a single pickled request.
+
+        slot is the max_connections slot taken for the connection, released
+        when it closes. A watching connection stays open for good waiting for
+        changes, so it releases its slot as soon as it watches a URI, and
+        doesn't take one again until it closes.
+
+        Changes of the watched URIs are queued (see push) and sent by a thread
+        of the connection, so a watcher that stops reading never blocks the
+        request that made the change. Once WATCH_QUEUE_SIZE changes are
+        waiting, or a send takes longer than idle_timeout, the connection is
+        closed and the client has to watch again.
         """
 
         logger.debug(f"[{ctime()}] Accepted connection from " f"IP: {addr[0]}, PORT: {addr[1]}")
+        self.active_connections += 1
+        self._accepted_connections.inc()
+        conn.settimeout(self.idle_timeout)
+
+        # Responses and pushed changes share the connection
+        send_lock = Lock()
+
+        def send(msg: dict):
+            with send_lock:
+                conn.sendall(protocol.pack_frame(msg))
+
+        pushes = Queue(WATCH_QUEUE_SIZE)
+
+        def drop(reason: str):
+            logger.debug(f"[{ctime()}] Dropping watcher {addr[0]}, PORT: {addr[1]}: {reason}")
+            self.unwatch(push, set(watched))
+            # Wakes up the threads of the connection, which then closes
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
 
+        def push(msg: dict):
+            try:
+                pushes.put_nowait(msg)
+            except Full:
+                drop("too far behind")
+
+        def send_pushes():
+            while True:
+                msg = pushes.get()
+                if msg is None:
+                    return
+                try:
+                    send(msg)
+                except OSError as e:
+                    drop(repr(e))
+                    return
+
+        watched = set()
+        sender = None
+
+        try:
+            first = conn.recv(1)
+            if protocol.is_framed(first):
+                while True:
+                    req = protocol.recv_frame(conn, prefix=first)
+                    send(self.handle_framed_request(req, addr, push, watched))
+                    if watched:
+                        slot = self._release_slot(slot)
+                        if sender is None:
+                            sender = Thread(target=send_pushes, daemon=True)
+                            sender.start()
+                    first = self._recv_next(conn, watched)
+                    if not first:
+                        break
+            elif first:
+                data = first + conn.recv(1024)
+                msj = self.handle_request(pkl.loads(data), addr)
+                conn.send(pkl.dumps(msj))
+        except (pkl.UnpicklingError, protocol.ProtocolError, EOFError, OSError) as e:
+            logger.debug(e)
+        finally:
+            self.unwatch(push, watched)
+            if sender is not None:
+                try:
+                    pushes.put_nowait(None)
+                except Full:
+                    # Busy sending, fails once the connection is closed
+                    pass
+            self._release_slot(slot)
+            self.active_connections -= 1
+            logger.debug(f"[{ctime()}] Closing connection from " f"IP: {addr[0]}, PORT: {addr[1]}")
+            conn.close()
+
+    @staticmethod
+    def _recv_next(conn: socket.socket, watched: Set[str]) -> bytes:
+        """First byte of the next request. Watching connections stay open until
+        the client closes them, but keep the timeout for sends"""
         while True:
             try:
-                data = conn.recv(1024)
-                req = pkl.loads(data)
-
-                if req["name"] == "update_server":  # nuevo proceso latente
-                    active_server = self.register_address(req["uri"], req["addr"])
-                    msj = {"name": "update_server_response", "addr": req["addr"], "active_server": active_server}
-                    conn.send(pkl.dumps(msj))
-                    logger.debug(f"[{ctime()}] Added new server location:" f" {req['addr']}")
-
-                elif req["name"] == "addr_request":
-                    msj = {
-                        "name": "addr_response",
-                        "req_uri": req["uri"],
-                        "addr": self.get_closest_server(addr[0], req["uri"]),
-                    }
-                    conn.send(pkl.dumps(msj))
-                    logger.debug(f"[{ctime()}] Last known location sent to client: {req['uri']} -> {msj['addr']}")
-
-                elif req["name"] == "get_random_server":
-                    msj = {
-                        "name": "random_server_response",
-                        "addr": self.get_random_server(req["uri"]),
-                    }
-                    conn.send(pkl.dumps(msj))
-
-                elif req["name"] == "set_current_server":
-                    self.set_current_host(req["uri"], req["addr"], req["self_addr"])
-                    msj = {"name": "set_current_server_response"}
-                    conn.send(pkl.dumps(msj))
-
-                elif req["name"] == "get_replica_addr":
-                    logger.debug(f"[{ctime()}] Send replica address")
-                    msj = {
-                        "name": "get_replica_addr_response",
-                        "addr": self.get_replica_address(req["my_addr"], req["uri"])
-                    }
-                    conn.send(pkl.dumps(msj))
-
-                else:
-                    logger.debug(f"[{ctime()}] Message didnt match")
-                    msj = {"name": "empty"}
-                    conn.send(pkl.dumps(msj))
-
-                break
-            except pkl.UnpicklingError as e:
-                logger.debug(e)
-        logger.debug(f"[{ctime()}] Closing connection from " f"IP: {addr[0]}, PORT: {addr[1]}")
+                return conn.recv(1)
+            except socket.timeout:
+                if not watched:
+                    raise
+
+    async def accept_async_connection(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        slot: Optional[asyncio.Semaphore] = None,
+    ):
+        """Same as accept_connection, but for a connection served by the event
+        loop. Pushed changes are sent by a task of the connection"""
+        addr = writer.get_extra_info("peername")
+        logger.debug(f"[{ctime()}] Accepted connection from " f"IP: {addr[0]}, PORT: {addr[1]}")
+        self.active_connections += 1
+        self._accepted_connections.inc()
+        loop = asyncio.get_running_loop()
+
+        # Responses and pushed changes share the connection
+        send_lock = asyncio.Lock()
 
-        conn.close()
+        async def send(msg: dict):
+            async with send_lock:
+                writer.write(protocol.pack_frame(msg))
+                await writer.drain()
+
+        pushes = asyncio.Queue(WATCH_QUEUE_SIZE)
+
+        def drop(reason: str):
+            logger.debug(f"[{ctime()}] Dropping watcher {addr[0]}, PORT: {addr[1]}: {reason}")
+            self.unwatch(push, watched)
+            # close() would wait to send what is buffered, which the watcher doesn't read
+            writer.transport.abort()
+
+        def enqueue(msg: dict):
+            try:
+                pushes.put_nowait(msg)
+            except asyncio.QueueFull:
+                drop("too far behind")
+
+        def push(msg: dict):
+            loop.call_soon_threadsafe(enqueue, msg)
+
+        async def send_pushes():
+            while True:
+                msg = await pushes.get()
+                try:
+                    await asyncio.wait_for(send(msg), self.idle_timeout)
+                except (asyncio.TimeoutError, OSError) as e:
+                    drop(repr(e))
+                    return
+
+        watched = set()
+        sender = None
+
+        try:
+            first = await asyncio.wait_for(reader.read(1), self.idle_timeout)
+            if protocol.is_framed(first):
+                while True:
+                    # The rest of the frame comes right away, unlike the next request
+                    req = await asyncio.wait_for(protocol.read_frame(reader, prefix=first), self.idle_timeout)
+                    await send(self.handle_framed_request(req, addr, push, watched))
+                    if watched:
+                        slot = self._release_slot(slot)
+                        if sender is None:
+                            sender = asyncio.ensure_future(send_pushes())
+                    # Watching connections stay open until the client closes them
+                    first = await asyncio.wait_for(reader.read(1), None if watched else self.idle_timeout)
+                    if not first:
+                        break
+            elif first:
+                data = first + await asyncio.wait_for(reader.read(1024), self.idle_timeout)
+                msj = self.handle_request(pkl.loads(data), addr)
+                writer.write(pkl.dumps(msj))
+                await writer.drain()
+        except (
+            pkl.UnpicklingError,
+            protocol.ProtocolError,
+            asyncio.IncompleteReadError,
+            asyncio.TimeoutError,
+            EOFError,
+            OSError,
+        ) as e:
+            logger.debug(e)
+        finally:
+            self.unwatch(push, watched)
+            if sender is not None:
+                sender.cancel()
+            self._release_slot(slot)
+            self.active_connections -= 1
+            logger.debug(f"[{ctime()}] Closing connection from " f"IP: {addr[0]}, PORT: {addr[1]}")
+            writer.close()
+
+    @staticmethod
+    def _release_slot(slot) -> None:
+        """Releases the max_connections slot of a connection, if it still holds it"""
+        if slot is not None:
+            slot.release()
+        return None
+
+    def handle_framed_request(self, req: dict, addr, push: Callable[[dict], None], watched: Set[str]) -> dict:
+        """Same as handle_request, plus the requests that need a persistent connection.
+
+        watch: {"uri"} subscribes the connection to changes of the servers of uri.
+        Answers with the current servers, and then every change is pushed on the
+        connection as a "uri_changed" message (see _notify).
+
+        unwatch: {"uri"} cancels a watch.
+        """
+        name = req.get("name") if isinstance(req, dict) else None
+        if name in ("watch", "unwatch") and not valid_request(req):
+            logger.debug(f"[{ctime()}] Malformed {name} request")
+            return {"name": "empty"}
+
+        if name == "watch":
+            with self._watchers_lock:
+                self.watchers.setdefault(req["uri"], set()).add(push)
+            watched.add(req["uri"])
+            addresses, generation = self.registry.get(req["uri"])
+            logger.debug(f"[{ctime()}] {addr[0]} watching {req['uri']}")
+            return {"name": "watch_response", "uri": req["uri"], "addresses": addresses, "generation": generation}
+
+        if name == "unwatch":
+            self.unwatch(push, {req["uri"]})
+            watched.discard(req["uri"])
+            return {"name": "unwatch_response", "uri": req["uri"]}
+
+        return self.handle_request(req, addr)
+
+    def unwatch(self, push: Callable[[dict], None], uris: Set[str]):
+        with self._watchers_lock:
+            for uri in uris:
+                self.watchers.get(uri, set()).discard(push)
+                if not self.watchers.get(uri, True):
+                    del self.watchers[uri]
+
+    def _notify(self, uri: str, before: List[str], after: List[str], generation: int):
+        """Pushes a change of the servers of uri to its watchers. Only queues it
+        on every watching connection, see accept_connection"""
+        with self._watchers_lock:
+            watchers = list(self.watchers.get(uri, ()))
+        if not watchers:
+            return
+
+        msg = {
+            "name": "uri_changed",
+            "uri": uri,
+            "addresses": after,
+            "added": [a for a in after if a not in before],
+            "removed": [a for a in before if a not in after],
+            "generation": generation,
+        }
+        for push in watchers:
+            push(msg)
+
+    def handle_request(self, req: dict, addr) -> dict:
+        """Dispatches a request to its handler and returns the response to send.
+        Requests without the fields their handler reads (see REQUEST_FIELDS)
+        are answered with {"name": "empty"}"""
+        name = req.get("name") if isinstance(req, dict) else None
+        handler = self.handlers.get(name) if isinstance(name, str) else None
+        if handler is None:
+            self._unknown_requests.inc()
+            logger.debug(f"[{ctime()}] Message didnt match")
+            return {"name": "empty"}
+
+        latency, errors = self._request_metrics[name]
+        if not valid_request(req):
+            errors.inc()
+            logger.debug(f"[{ctime()}] Malformed {name} request")
+            return {"name": "empty"}
+
+        start = perf_counter()
+        try:
+            return handler(req, addr)
+        except (KeyError, TypeError, ValueError) as e:
+            errors.inc()
+            logger.debug(f"[{ctime()}] Malformed {req['name']} request: {e!r}")
+            return {"name": "empty"}
+        finally:
+            latency.observe(perf_counter() - start)
+
+    def _setup_metrics(self):
+        m = self.metrics
+
+        # request name -> (latency histogram, malformed requests counter)
+        self._request_metrics = {
+            name: (
+                m.histogram("dns_request_seconds", "Time to handle a request", request=name),
+                m.counter("dns_request_errors_total", "Malformed requests", request=name),
+            )
+            for name in self.handlers
+        }
+        self._unknown_requests = m.counter("dns_unknown_requests_total", "Requests with an unknown name")
+        self._accepted_connections = m.counter("dns_connections_total", "Accepted connections")
+        self._datagrams = m.counter("dns_datagrams_total", "Requests received over UDP")
+        self._datagram_fallbacks = m.counter("dns_datagram_fallbacks_total", "UDP requests answered with tcp_required")
+
+        m.gauge("dns_active_connections", "Connections being served", lambda: self.active_connections)
+        m.gauge("dns_registry_uris", "Registered URIs", lambda: len(self.registry))
+        m.gauge("dns_registry_addresses", "Known server addresses", lambda: len(self.addresses))
+        m.gauge("dns_watchers", "Watch subscriptions", lambda: sum(map(len, list(self.watchers.values()))))
+
+        lock_metrics = (
+            ("dns_registry_lock_acquired", "Registry lock acquisitions", "acquired"),
+            ("dns_registry_lock_timeouts", "Registry lock acquisitions that timed out", "timeouts"),
+            ("dns_registry_lock_wait_seconds", "Total time waited for the registry lock", "wait_total"),
+            ("dns_registry_lock_wait_max_seconds", "Longest wait for the registry lock", "wait_max"),
+            ("dns_registry_lock_hold_seconds", "Total time the registry lock was held", "hold_total"),
+        )
+        # Combined over the shards of the registry
+        for side, stats in (("read", self.registry.read_stats), ("write", self.registry.write_stats)):
+            for name, help, attr in lock_metrics:
+                m.gauge(name, help, lambda stats=stats, attr=attr: getattr(stats(), attr), side=side)
+
+    def on_update_server(self, req: dict, addr) -> dict:
+        # nuevo proceso latente
+        active_server = self.register_address(req["uri"], req["addr"])
+        logger.debug(f"[{ctime()}] Added new server location:" f" {req['addr']}")
+        return {"name": "update_server_response", "addr": req["addr"], "active_server": active_server}
+
+    def on_addr_request(self, req: dict, addr) -> dict:
+        # Read the generation first, so a concurrent change can't be cached as up to date
+        generation = self.registry.generation(req["uri"])
+        msj = {
+            "name": "addr_response",
+            "req_uri": req["uri"],
+            "addr": self.get_closest_server(addr[0], req["uri"]),
+            "generation": generation,
+        }
+        logger.debug(f"[{ctime()}] Last known location sent to client: {req['uri']} -> {msj['addr']}")
+        return msj
+
+    def on_get_random_server(self, req: dict, addr) -> dict:
+        return {
+            "name": "random_server_response",
+            "addr": self.get_random_server(req["uri"]),
+        }
+
+    def on_set_current_server(self, req: dict, addr) -> dict:
+        self.set_current_host(req["uri"], req["addr"], req["self_addr"])
+        return {"name": "set_current_server_response", "generation": self.registry.generation(req["uri"])}
+
+    def on_get_replica_addr(self, req: dict, addr) -> dict:
+        logger.debug(f"[{ctime()}] Send replica address")
+        generation = self.registry.generation(req["uri"])
+        return {
+            "name": "get_replica_addr_response",
+            "addr": self.get_replica_address(req["my_addr"], req["uri"]),
+            "generation": generation,
+        }
+
+    def on_server_beacon(self, req: dict, addr) -> dict:
+        known = self.pool.beacon(req["addr"], float(req["load"]), float(req.get("rtt", 0.0)))
+        return {"name": "server_beacon_response", "known": known}
+
+    def on_report_failure(self, req: dict, addr) -> dict:
+        logger.debug(f"[{ctime()}] Reported failure of {req['addr']}")
+        self.pool.report_failure(req["addr"])
+        return {"name": "report_failure_response"}
+
+    def on_batch(self, req: dict, addr) -> dict:
+        """Handles several requests in one round trip. Responses keep the order of the requests"""
+        responses = []
+        for sub_req in req["requests"]:
+            if isinstance(sub_req, dict) and sub_req.get("name") == "batch":
+                responses.append({"name": "empty"})
+            else:
+                responses.append(self.handle_request(sub_req, addr))
+        return {"name": "batch_response", "responses": responses}
+
+    def on_lock_stats(self, req: dict, addr) -> dict:
+        """Wait and hold times of the registry locks, to see their contention"""
+        return {"name": "lock_stats_response", "stats": self.registry.lock_stats()}
 
     def get_closest_server(self, ip: str, uri: str) -> str:
-        with self.server_reader:
-            servers = self.uri2address.get(uri)
-            return find_closest_ip(ip, servers)
+        closest = self.registry.closest(uri, ip)
+
+        if closest is None:
+            logger.error(f"No server found closest to {ip} for {uri}")
+        return closest
 
     def register_address(self, uri: str, address: str) -> bool:
         """Receives a new host:port from the server host and update the list
@@ -157,53 +700,123 @@ class NameServer:
         ----------
         Bool -> True if set as active server
         """
-        self.addresses.add(address)
-
-        is_active_server = False
-
-        with self.server_writer:
-            if not self.uri2address.get(uri):
-                self.uri2address[uri] = []
-
-            if len(self.uri2address[uri]) < 2:
-                self.uri2address[uri].append(address)
-                is_active_server = True
-
+        shard = self.registry.shard(uri)
+        with shard.writer:
+            before = shard.addresses(uri)
+            is_new = address not in self.addresses
+            self.addresses.add(address)
+            is_active_server, changed = shard.register(uri, address)
+            if address:
+                self.pool.add(address)
+
+            if is_new or changed:
+                self._persist({"op": "register", "uri": uri, "address": address})
+            after = shard.addresses(uri)
+            generation = shard.generation(uri)
+
+        self._compact()
+        if changed:
+            self._notify(uri, before, after, generation)
         return is_active_server
-    
+
     def get_replica_address(self, request_address: str, uri: str) -> str:
-        for address in self.uri2address[uri]:
-            if address != request_address:
-                return address
-        return ""
+        return self.registry.replica(uri, request_address)
 
     def set_current_host(self, uri: str, address: str, old_address: str):
-        with self.server_writer:
-            try:
-                i = self.uri2address[uri].index(old_address)
-                self.uri2address[uri][i] = address
-                logger.debug(f"Set current host addr: {address}")
-            except ValueError as e:
-                logger.error(
-                    f"Trying to update address from {old_address} to {address}, but there's no {old_address} in the registry."
-                )
+        shard = self.registry.shard(uri)
+        with shard.writer:
+            before = shard.addresses(uri)
+            changed = shard.set_current(uri, address, old_address)
+            if changed:
+                self._persist({"op": "set_current_host", "uri": uri, "address": address, "old_address": old_address})
+                after = shard.addresses(uri)
+                generation = shard.generation(uri)
+
+        self._compact()
+        if changed:
+            logger.debug(f"Set current host addr: {address}")
+            self._notify(uri, before, after, generation)
+        else:
+            logger.error(
+                f"Trying to update address from {old_address} to {address}, but there's no {old_address} in the registry."
+            )
+
+    def _restore(self):
+        """Loads the registry from the snapshot and log of self.store"""
+        records = 0
+        for record in self.store.load():
+            records += 1
+            if record["op"] == "uri":
+                self.registry.shard(record["uri"]).load(record["uri"], record["addresses"], record["generation"])
+            elif record["op"] == "addresses":
+                self.addresses.update(record["addresses"])
+            elif record["op"] == "register":
+                self.addresses.add(record["address"])
+                self.registry.shard(record["uri"]).register(record["uri"], record["address"])
+            elif record["op"] == "set_current_host":
+                shard = self.registry.shard(record["uri"])
+                shard.set_current(record["uri"], record["address"], record["old_address"])
+
+        for address in self.addresses:
+            if address:
+                self.pool.add(address)
+
+        logger.debug(
+            f"[{ctime()}] Restored {len(self.registry)} URIs and {len(self.addresses)} addresses"
+            f" from {records} records"
+        )
+
+    def _persist(self, record: dict):
+        """Appends a registry mutation to the log. Must hold the writer lock
+        of the shard of the mutated URI"""
+        if self.store is None:
+            return
+
+        with self._store_lock:
+            self.store.append(record)
+
+    def _compact(self):
+        """Snapshots the registry if the log is due. Must not hold any shard lock"""
+        if self.store is None or not self.store.should_compact():
+            return
+
+        with self.registry.locked():
+            # Another thread may have compacted while this one waited
+            if self.store.should_compact():
+                self.store.write_snapshot(self.registry.dump(), list(self.addresses))
 
     def get_random_server(self, uri: str):
-        with self.server_reader:
-            servers = [addr for addr in self.addresses if (addr and addr not in self.uri2address[uri])]
-
-            if len(servers) == 0:
-                return None
-
-            return choice(servers)
-
-
-def serve():
-    PORT = 8000
-    n = 10
-    ns = NameServer(PORT, n)
-
-    ns.run()
+        """Selects the migration target of uri: the latent server with the best
+        score, see ServerPool. Ties are broken at random, and every pick raises
+        the score of the chosen server until its next beacon"""
+        active, _ = self.registry.get(uri)
+        return self.pool.best(exclude=set(active))
+
+
+def serve(
+    port=8000,
+    n=10,
+    max_connections=1024,
+    mode=ASYNC_MODE,
+    data_dir=None,
+    metrics_port=None,
+    shards=16,
+    active_set_size=2,
+):
+    ns = NameServer(
+        port,
+        n,
+        max_connections,
+        data_dir=data_dir,
+        metrics_port=metrics_port,
+        shards=shards,
+        active_set_size=active_set_size,
+    )
+
+    if mode == THREAD_MODE:
+        ns.run()
+    else:
+        ns.run_async()
 
 
 if __name__ == "__main__":
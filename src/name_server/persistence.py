@@ -0,0 +1,129 @@
+"""Persistence of the name server registry.
+
+Every mutation of the registry is appended to a write-ahead log before the
+name server answers it. Once the log holds snapshot_every records, the whole
+registry is written to a compact snapshot and the log starts over. At startup
+the snapshot and then the log are memory mapped and replayed.
+
+Both files are sequences of frames (see src/utils/protocol.py). The snapshot
+holds one frame per URI and one frame per chunk of known addresses, so no
+frame gets near MAX_FRAME_SIZE. Log records carry a sequence number and the
+snapshot the last one it includes, so records already in the snapshot are
+skipped if the name server stopped between writing it and emptying the log.
+"""
+import logging
+import mmap
+import os
+from typing import Iterator, List
+
+from colorama.ansi import Fore
+
+from ..utils.protocol import iter_frames, pack_frame
+
+logger = logging.getLogger(f"{Fore.GREEN}[DNS]{Fore.RESET}")
+
+SNAPSHOT_FILE = "registry.snapshot"
+LOG_FILE = "registry.log"
+ADDRESSES_CHUNK = 1000
+
+
+def _read_frames(path: str) -> Iterator[dict]:
+    """Yields the frames of a file, via mmap. Truncates a torn record at the end"""
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return
+
+    with open(path, "r+b") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            end = 0
+            for msg, end in iter_frames(buf):
+                yield msg
+            size = len(buf)
+
+        if end < size:
+            logger.error(f"Dropping {size - end} bytes of incomplete records at the end of {path}")
+            f.truncate(end)
+
+
+class RegistryStore:
+    def __init__(self, data_dir: str, snapshot_every: int = 1000, fsync: bool = False) -> None:
+        """Snapshot and write-ahead log of a NameServer registry
+
+        Parameters
+        ----------
+        data_dir : str
+            Directory for the snapshot and log files. Created if missing
+        snapshot_every : int
+            Number of log records after which the registry is compacted
+        fsync : bool
+            Whether to fsync every log record. Survives power loss instead of
+            only crashes, at the cost of a disk flush per mutation
+        """
+        os.makedirs(data_dir, exist_ok=True)
+        self.snapshot_path = os.path.join(data_dir, SNAPSHOT_FILE)
+        self.log_path = os.path.join(data_dir, LOG_FILE)
+        self.snapshot_every = snapshot_every
+        self.fsync = fsync
+
+        self.log_records = 0
+        self.seq = 0
+        self._log = None
+
+    def load(self) -> Iterator[dict]:
+        """Yields the records to replay: first the snapshot, then the log.
+
+        Snapshot records look like {"op": "uri", ...} and {"op": "addresses", ...},
+        log records are the ones given to append.
+        """
+        for record in _read_frames(self.snapshot_path):
+            if record["op"] == "header":
+                self.seq = record["seq"]
+            else:
+                yield record
+
+        for record in _read_frames(self.log_path):
+            if record["seq"] <= self.seq:
+                continue
+            self.seq = record["seq"]
+            self.log_records += 1
+            yield record
+
+    def open(self):
+        self._log = open(self.log_path, "ab")
+
+    def append(self, record: dict):
+        self.seq += 1
+        self._log.write(pack_frame({**record, "seq": self.seq}))
+        self._log.flush()
+        if self.fsync:
+            os.fsync(self._log.fileno())
+        self.log_records += 1
+
+    def should_compact(self) -> bool:
+        return self.log_records >= self.snapshot_every
+
+    def write_snapshot(self, uris: List[dict], addresses: List[str]):
+        """Replaces the snapshot with the given state and empties the log.
+
+        The new snapshot is written next to the old one and renamed over it,
+        so a crash leaves either the old snapshot plus the log or the new one.
+        """
+        tmp_path = f"{self.snapshot_path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(pack_frame({"op": "header", "seq": self.seq}))
+            for uri in uris:
+                f.write(pack_frame({"op": "uri", **uri}))
+            for i in range(0, len(addresses), ADDRESSES_CHUNK):
+                f.write(pack_frame({"op": "addresses", "addresses": addresses[i : i + ADDRESSES_CHUNK]}))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+
+        if self._log is not None:
+            self._log.close()
+        self._log = open(self.log_path, "wb")
+        self.log_records = 0
+
+    def close(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
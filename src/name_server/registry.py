@@ -0,0 +1,160 @@
+"""URI registry of the name server, sharded by URI.
+
+Every URI lives in one of a fixed number of shards, picked by the hash of the
+URI, and every shard has its own readers-writer lock. Lookups and updates of
+URIs in different shards never wait for each other, so one busy chat (or a
+slow write-ahead log append while updating it) doesn't stall the rest.
+
+Operations that need a consistent view of the whole registry, like writing a
+snapshot, take the writer lock of every shard in order (see Registry.locked).
+"""
+from contextlib import ExitStack, contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from .ip_lookup import PrefixIndex
+from .rw_lock import LockStats, get_rwlock
+
+
+class Shard:
+    """Servers of a subset of the URIs. Methods don't lock: callers must hold
+    self.reader (lookups) or self.writer (mutations)"""
+
+    def __init__(self, active_set_size: int) -> None:
+        self.active_set_size = active_set_size
+        self.reader, self.writer = get_rwlock()
+
+        self.uri2address: Dict[str, List[str]] = {}  # uri -> [address1, address2, ...]
+        self.uri2index: Dict[str, PrefixIndex] = {}  # uri -> PrefixIndex of uri2address[uri]
+        self.uri2generation: Dict[str, int] = {}  # uri -> number of changes to uri2address[uri]
+
+    def addresses(self, uri: str) -> List[str]:
+        return list(self.uri2address.get(uri, ()))
+
+    def generation(self, uri: str) -> int:
+        return self.uri2generation.get(uri, 0)
+
+    def closest(self, uri: str, ip: str) -> Optional[str]:
+        index = self.uri2index.get(uri)
+        return index.closest(ip) if index else None
+
+    def replica(self, uri: str, request_address: str) -> str:
+        for address in self.uri2address.get(uri, ()):
+            if address != request_address:
+                return address
+        return ""
+
+    def register(self, uri: str, address: str) -> Tuple[bool, bool]:
+        """Adds address to the active servers of uri if there's room.
+        Returns whether it is an active server and whether the registry changed"""
+        if not self.uri2address.get(uri):
+            self.uri2address[uri] = []
+            self.uri2index[uri] = PrefixIndex()
+
+        if address in self.uri2address[uri]:
+            # Retried request, it was already registered
+            return True, False
+
+        if len(self.uri2address[uri]) < self.active_set_size:
+            self.uri2address[uri].append(address)
+            self.uri2index[uri].add(address)
+            self.uri2generation[uri] = self.uri2generation.get(uri, 0) + 1
+            return True, True
+
+        return False, False
+
+    def set_current(self, uri: str, address: str, old_address: str) -> bool:
+        """Replaces old_address by address. False if old_address isn't active for uri"""
+        try:
+            i = self.uri2address[uri].index(old_address)
+        except (KeyError, ValueError):
+            return False
+
+        self.uri2address[uri][i] = address
+        # Takes the place of old_address, also when breaking ties in closest
+        self.uri2index[uri].replace(old_address, address)
+        self.uri2generation[uri] += 1
+        return True
+
+    def load(self, uri: str, addresses: List[str], generation: int):
+        self.uri2address[uri] = addresses
+        self.uri2index[uri] = PrefixIndex(addresses)
+        self.uri2generation[uri] = generation
+
+
+class Registry:
+    def __init__(self, shards: int = 16, active_set_size: int = 2) -> None:
+        """Active servers of every URI
+
+        Parameters
+        ----------
+        shards : int
+            Number of independently locked shards the URIs are spread over
+        active_set_size : int
+            Maximum number of active servers per URI. Servers registered
+            once a URI is full stay latent, as migration targets
+        """
+        if shards < 1:
+            raise ValueError(f"A registry needs at least one shard, got {shards}")
+        if active_set_size < 1:
+            raise ValueError(f"The active set size must be at least 1, got {active_set_size}")
+
+        self.active_set_size = active_set_size
+        self.shards = [Shard(active_set_size) for _ in range(shards)]
+
+    def __len__(self) -> int:
+        return sum(len(shard.uri2address) for shard in self.shards)
+
+    def shard(self, uri: str) -> Shard:
+        return self.shards[hash(uri) % len(self.shards)]
+
+    def get(self, uri: str) -> Tuple[List[str], int]:
+        """Active servers of uri and their generation"""
+        shard = self.shard(uri)
+        with shard.reader:
+            return shard.addresses(uri), shard.generation(uri)
+
+    def generation(self, uri: str) -> int:
+        # A single dict read, consistent without the lock
+        return self.shard(uri).generation(uri)
+
+    def closest(self, uri: str, ip: str) -> Optional[str]:
+        shard = self.shard(uri)
+        with shard.reader:
+            return shard.closest(uri, ip)
+
+    def replica(self, uri: str, request_address: str) -> str:
+        shard = self.shard(uri)
+        with shard.reader:
+            return shard.replica(uri, request_address)
+
+    @contextmanager
+    def locked(self) -> Iterator[None]:
+        """Holds the writer lock of every shard. Always taken in the same
+        order, so two callers can't deadlock"""
+        with ExitStack() as stack:
+            for shard in self.shards:
+                stack.enter_context(shard.writer)
+            yield
+
+    def dump(self) -> List[dict]:
+        """Every URI as {"uri", "addresses", "generation"}. Must hold locked()"""
+        return [
+            {"uri": uri, "addresses": addresses, "generation": shard.generation(uri)}
+            for shard in self.shards
+            for uri, addresses in shard.uri2address.items()
+        ]
+
+    def lock_stats(self) -> dict:
+        """Wait and hold times of the shard locks, combined and per shard"""
+        shards = [shard.reader.rwlock.stats() for shard in self.shards]
+        return {
+            "read": self.read_stats().snapshot(),
+            "write": self.write_stats().snapshot(),
+            "shards": shards,
+        }
+
+    def read_stats(self) -> LockStats:
+        return LockStats.merge(shard.reader.rwlock.read_stats for shard in self.shards)
+
+    def write_stats(self) -> LockStats:
+        return LockStats.merge(shard.reader.rwlock.write_stats for shard in self.shards)
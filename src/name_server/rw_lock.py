@@ -1,57 +1,152 @@
-from threading import Semaphore
-from typing import Tuple
+from threading import Condition, Lock, local
+from time import perf_counter
+from typing import Iterable, Optional, Tuple
 
 
-class RWLock:
+class LockStats:
+    """Wait and hold times (in seconds) of one side of a RWLock"""
+
     def __init__(self) -> None:
-        self.rw = Semaphore(1)
-        self.mutex = Semaphore(1)
+        self.acquired = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.hold_total = 0.0
+        self.hold_max = 0.0
+
+    def record_wait(self, wait: float):
+        self.acquired += 1
+        self.wait_total += wait
+        if wait > self.wait_max:
+            self.wait_max = wait
+
+    def record_hold(self, hold: float):
+        self.hold_total += hold
+        if hold > self.hold_max:
+            self.hold_max = hold
+
+    def snapshot(self) -> dict:
+        return {
+            "acquired": self.acquired,
+            "timeouts": self.timeouts,
+            "wait_total": self.wait_total,
+            "wait_max": self.wait_max,
+            "wait_avg": self.wait_total / self.acquired if self.acquired else 0.0,
+            "hold_total": self.hold_total,
+            "hold_max": self.hold_max,
+            "hold_avg": self.hold_total / self.acquired if self.acquired else 0.0,
+        }
+
+    @classmethod
+    def merge(cls, all_stats: Iterable["LockStats"]) -> "LockStats":
+        """Combined stats of several locks, e.g. the shards of a registry"""
+        merged = cls()
+        for stats in all_stats:
+            merged.acquired += stats.acquired
+            merged.timeouts += stats.timeouts
+            merged.wait_total += stats.wait_total
+            merged.wait_max = max(merged.wait_max, stats.wait_max)
+            merged.hold_total += stats.hold_total
+            merged.hold_max = max(merged.hold_max, stats.hold_max)
+        return merged
 
-        self.readers = 0
 
-    def enter_write(self):
-        self.rw.acquire()
+class RWLock:
+    """Writer preferring readers-writer lock.
 
-    def exit_write(self):
-        self.rw.release()
+    Once a writer is waiting, new readers wait behind it, so a steady stream
+    of readers can't starve writers. Not reentrant: a thread holding the lock
+    must not acquire it again.
+    """
 
-    def enter_read(self):
-        self.mutex.acquire()
-        self.readers += 1
-        if self.readers == 1:
-            self.rw.acquire()
-        self.mutex.release()
+    def __init__(self) -> None:
+        self._cond = Condition(Lock())
+        self.readers = 0
+        self.writing = False
+        self.waiting_writers = 0
+
+        self.read_stats = LockStats()
+        self.write_stats = LockStats()
+        self._read_start = local()
+        self._write_start = 0.0
+
+    def enter_write(self, timeout: Optional[float] = None) -> bool:
+        start = perf_counter()
+        with self._cond:
+            self.waiting_writers += 1
+            try:
+                acquired = self._cond.wait_for(lambda: not self.writing and self.readers == 0, timeout)
+            finally:
+                self.waiting_writers -= 1
+
+            if not acquired:
+                self.write_stats.timeouts += 1
+                # Readers waiting behind this writer may go now
+                self._cond.notify_all()
+                return False
+
+            self.writing = True
+            self._write_start = perf_counter()
+            self.write_stats.record_wait(self._write_start - start)
+        return True
+
+    def exit_write(self):
+        with self._cond:
+            self.write_stats.record_hold(perf_counter() - self._write_start)
+            self.writing = False
+            self._cond.notify_all()
+
+    def enter_read(self, timeout: Optional[float] = None) -> bool:
+        start = perf_counter()
+        with self._cond:
+            acquired = self._cond.wait_for(lambda: not self.writing and self.waiting_writers == 0, timeout)
+            if not acquired:
+                self.read_stats.timeouts += 1
+                return False
+
+            self.readers += 1
+            self._read_start.value = perf_counter()
+            self.read_stats.record_wait(self._read_start.value - start)
+        return True
 
     def exit_read(self):
-        self.mutex.acquire()
-        self.readers -= 1
-        if self.readers == 0:
-            self.rw.release()
-        self.mutex.release()
+        with self._cond:
+            self.read_stats.record_hold(perf_counter() - self._read_start.value)
+            self.readers -= 1
+            if self.readers == 0:
+                self._cond.notify_all()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {"read": self.read_stats.snapshot(), "write": self.write_stats.snapshot()}
 
 
 class Reader:
-    def __init__(self, rwlock: RWLock) -> None:
+    def __init__(self, rwlock: RWLock, timeout: Optional[float] = None) -> None:
         self.rwlock = rwlock
+        self.timeout = timeout
 
     def __enter__(self):
-        self.rwlock.enter_read()
+        if not self.rwlock.enter_read(self.timeout):
+            raise TimeoutError(f"Could not acquire read lock in {self.timeout}s")
 
     def __exit__(self, exc_type, exc_value, exc_traceback):
         self.rwlock.exit_read()
 
 
 class Writer:
-    def __init__(self, rwlock: RWLock) -> None:
+    def __init__(self, rwlock: RWLock, timeout: Optional[float] = None) -> None:
         self.rwlock = rwlock
+        self.timeout = timeout
 
     def __enter__(self):
-        self.rwlock.enter_write()
+        if not self.rwlock.enter_write(self.timeout):
+            raise TimeoutError(f"Could not acquire write lock in {self.timeout}s")
 
     def __exit__(self, exc_type, exc_value, exc_traceback):
         self.rwlock.exit_write()
 
 
-def get_rwlock() -> Tuple[Reader, Writer]:
+def get_rwlock(timeout: Optional[float] = None) -> Tuple[Reader, Writer]:
     rwlock = RWLock()
-    return Reader(rwlock), Writer(rwlock)
+    return Reader(rwlock, timeout), Writer(rwlock, timeout)
@@ -0,0 +1,164 @@
+from heapq import heapify, heappop, heappush
+from random import choice
+from threading import Lock
+from time import monotonic
+from typing import Dict, List, Optional, Set
+
+
+class ServerHealth:
+    __slots__ = ("addr", "load", "rtt", "failures", "pending", "last_update", "last_beacon", "version")
+
+    def __init__(self, addr: str, load: float) -> None:
+        self.addr = addr
+        self.load = load
+        self.rtt = 0.0
+        self.failures = 0.0
+        # Migrations sent to it that its load doesn't reflect yet
+        self.pending = 0.0
+        self.last_update = monotonic()
+        # None until the server sends its first beacon
+        self.last_beacon: Optional[float] = None
+        self.version = 0
+
+
+class ServerPool:
+    """Scored pool of the servers that can be chosen as migration targets.
+
+    Servers report their load and RTT to the name server with beacons, and
+    failed migrations to a server are reported too. The score of a server is
+
+        load + failure_penalty * recent_failures + rtt_weight * rtt + pending_penalty * pending
+
+    where recent_failures decays by half every failure_halflife seconds, and
+    pending counts the times the server was picked since its last beacon
+    (decaying the same way for servers that don't send beacons). Lower is
+    better. Picking a server raises its score, so consecutive picks spread
+    over equally good servers instead of all going to the same one until it
+    reports its new load.
+
+    Servers are kept in a min-heap by score. Updating a server pushes a new
+    entry and leaves the old one behind, which is dropped when it reaches the
+    top, so picking the best server only looks at the top of the heap (plus
+    the few servers excluded by the caller, and the ones tied with the best).
+    Servers whose last beacon is older than beacon_ttl are considered down
+    until they send another one. Servers that never sent a beacon (older
+    clients) stay eligible with default_load.
+    """
+
+    def __init__(
+        self,
+        beacon_ttl: float = 15.0,
+        default_load: float = 1.0,
+        failure_penalty: float = 1.0,
+        failure_halflife: float = 60.0,
+        rtt_weight: float = 10.0,
+        pending_penalty: float = 0.25,
+    ) -> None:
+        self.beacon_ttl = beacon_ttl
+        self.default_load = default_load
+        self.failure_penalty = failure_penalty
+        self.failure_halflife = failure_halflife
+        self.rtt_weight = rtt_weight
+        self.pending_penalty = pending_penalty
+
+        self.servers: Dict[str, ServerHealth] = {}
+        # (score, version, addr)
+        self._heap: List[tuple] = []
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self.servers)
+
+    def add(self, addr: str):
+        """Adds a server that hasn't reported its load yet"""
+        with self._lock:
+            if addr not in self.servers:
+                self.servers[addr] = ServerHealth(addr, self.default_load)
+                self._push(self.servers[addr])
+
+    def beacon(self, addr: str, load: float, rtt: float = 0.0) -> bool:
+        """Updates the load and RTT of a server. False if the server is unknown"""
+        with self._lock:
+            server = self.servers.get(addr)
+            if server is None:
+                return False
+            self._decay(server)
+            server.load = load
+            server.rtt = rtt
+            # The reported load already includes the migrations it got
+            server.pending = 0.0
+            server.last_beacon = server.last_update
+            self._push(server)
+            return True
+
+    def report_failure(self, addr: str):
+        with self._lock:
+            server = self.servers.get(addr)
+            if server is None:
+                return
+            self._decay(server)
+            server.failures += 1
+            self._push(server)
+
+    def score(self, server: ServerHealth) -> float:
+        return (
+            server.load
+            + self.failure_penalty * server.failures
+            + self.rtt_weight * server.rtt
+            + self.pending_penalty * server.pending
+        )
+
+    def best(self, exclude: Set[str] = frozenset()) -> Optional[str]:
+        """Picks the eligible server with the lowest score that isn't in exclude,
+        at random among the ones with the same score, and counts a pending
+        migration to it"""
+        with self._lock:
+            now = monotonic()
+            skipped = []
+            ties = []
+            while self._heap:
+                entry = self._heap[0]
+                server = self.servers.get(entry[2])
+                if server is None or server.version != entry[1]:
+                    # Outdated entry
+                    heappop(self._heap)
+                elif server.last_beacon is not None and now - server.last_beacon > self.beacon_ttl:
+                    # Down until its next beacon pushes it again
+                    heappop(self._heap)
+                elif server.addr in exclude:
+                    skipped.append(heappop(self._heap))
+                elif ties and entry[0] > ties[0][0]:
+                    break
+                else:
+                    ties.append(heappop(self._heap))
+
+            for entry in skipped + ties:
+                heappush(self._heap, entry)
+            if not ties:
+                return None
+
+            best = self.servers[choice(ties)[2]]
+            self._decay(best)
+            best.pending += 1
+            self._push(best)
+            return best.addr
+
+    def _decay(self, server: ServerHealth):
+        now = monotonic()
+        decay = 0.5 ** ((now - server.last_update) / self.failure_halflife)
+        server.failures *= decay
+        server.pending *= decay
+        server.last_update = now
+
+    def _push(self, server: ServerHealth):
+        server.version += 1
+        heappush(self._heap, (self.score(server), server.version, server.addr))
+
+        # Drop outdated entries once they outnumber the servers
+        if len(self._heap) > 2 * len(self.servers) + 16:
+            self._heap = [
+                (self.score(s), s.version, s.addr)
+                for s in self.servers.values()
+                if s.last_beacon is None or monotonic() - s.last_beacon <= self.beacon_ttl
+            ]
+            heapify(self._heap)
@@ -0,0 +1,69 @@
+"""Junta items en lotes, por tiempo o por cantidad.
+
+Cada lote se entrega a on_batch cuando junta max_size items, o max_delay
+segundos despues de que llego su primer item, lo que pase primero. Asi en un
+chat con mucho trafico se manda un evento por lote y no uno por chat, y en
+uno tranquilo cada chat espera a lo mas max_delay.
+
+Los lotes se entregan de a uno y en orden.
+"""
+from threading import Condition, Lock
+from time import monotonic
+from typing import Callable, List
+
+# Chats por lote
+BATCH_SIZE = 64
+# Segundos que espera el primer chat de un lote
+BATCH_DELAY = 0.005
+
+
+class Batcher:
+    def __init__(
+        self,
+        on_batch: Callable[[list], None],
+        max_size: int = BATCH_SIZE,
+        max_delay: float = BATCH_DELAY,
+    ) -> None:
+        self.on_batch = on_batch
+        self.max_size = max_size
+        self.max_delay = max_delay
+
+        self.__items: List = []
+        # Cuando llego el primero de __items
+        self.__first_at = 0.0
+        self.__cond = Condition()
+        # Sostenido mientras se saca y entrega un lote, para entregarlos en orden
+        self.__flush_lock = Lock()
+
+    def add(self, item):
+        with self.__cond:
+            self.__items.append(item)
+            if len(self.__items) == 1:
+                self.__first_at = monotonic()
+                self.__cond.notify()
+            full = len(self.__items) >= self.max_size
+
+        if full:
+            self.flush()
+
+    def run(self):
+        """Entrega los lotes que cumplen max_delay. Correr en un thread"""
+        while True:
+            with self.__cond:
+                while not self.__items:
+                    self.__cond.wait()
+                remaining = self.__first_at + self.max_delay - monotonic()
+            if remaining > 0:
+                # Hasta max_delay, o hasta que se entregue antes por llenarse
+                with self.__cond:
+                    self.__cond.wait_for(lambda: not self.__items, timeout=remaining)
+                continue
+            self.flush()
+
+    def flush(self):
+        """Entrega ya lo que haya juntado"""
+        with self.__flush_lock:
+            with self.__cond:
+                items, self.__items = self.__items, []
+            if items:
+                self.on_batch(items)
@@ -0,0 +1,159 @@
+"""Historial de chats del servidor, ordenado por indice.
+
+Los chats llegan casi siempre en orden de indice, asi que se agregan al
+final de dos listas paralelas (indices y entradas) sin ordenar nada. Uno
+que llega tarde (el indice lo asigna la coordinacion con la replica) se
+inserta en su lugar con bisect.
+
+La historia se entrega por paginas de page_size chats desde un cursor
+(since_index). Las paginas completas no cambian, asi que la respuesta de
+cada una se arma una sola vez y se comparte entre todos los clientes que
+la piden, en vez de ordenar y copiar el historial en cada login. Se guardan
+las MAX_CACHED_PAGES pedidas mas recientemente.
+
+Con un MessageStore, en memoria solo quedan los ultimos hot_size chats, y
+los anteriores se mueven a disco (ver MessageStore), de a page_size.
+"""
+import logging
+from bisect import bisect_left
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, Iterator, List, Optional
+
+from colorama import Fore as Color
+
+from .MessageStore import MessageStore
+
+logger = logging.getLogger(f"{Color.CYAN}[MessageLog]{Color.RESET}")
+
+# Chats por pagina de historia
+PAGE_SIZE = 100
+# Paginas completas que se reutilizan entre clientes
+MAX_CACHED_PAGES = 64
+# Chats que se mantienen en memoria si hay un MessageStore
+HOT_SIZE = 10_000
+
+
+class MessageLog:
+    def __init__(
+        self,
+        page_size: int = PAGE_SIZE,
+        store: Optional[MessageStore] = None,
+        hot_size: int = HOT_SIZE,
+    ) -> None:
+        self.page_size = page_size
+        self.store = store
+        self.hot_size = hot_size
+        # Posicion -> indice del chat, ordenados. Solo los que estan en memoria,
+        # todos posteriores a los del store
+        self.indexes: List[int] = []
+        # Posicion -> { index, username, message }
+        self.entries: List[dict] = []
+        # since_index -> respuesta de page(), solo de paginas completas
+        self.__pages: "OrderedDict[int, dict]" = OrderedDict()
+        self.__lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self.entries) + (len(self.store) if self.store else 0)
+
+    @property
+    def last_index(self) -> Optional[int]:
+        if self.indexes:
+            return self.indexes[-1]
+        return self.store.last_index if self.store else None
+
+    def append(self, index: int, username: str, message: str):
+        entry = {"index": index, "username": username, "message": message}
+        with self.__lock:
+            if not self.indexes or index > self.indexes[-1]:
+                if self.store and self.store.last_index is not None and index <= self.store.last_index:
+                    self.__late_to_store(index)
+                    return
+                self.indexes.append(index)
+                self.entries.append(entry)
+                self.__evict()
+                return
+
+            position = bisect_left(self.indexes, index)
+            if position < len(self.indexes) and self.indexes[position] == index:
+                # Ya estaba, e.g. entregado de nuevo
+                return
+            if position == 0 and self.store and self.store.last_index is not None and index <= self.store.last_index:
+                self.__late_to_store(index)
+                return
+            self.indexes.insert(position, index)
+            self.entries.insert(position, entry)
+            # Las paginas que lo incluyen cambiaron
+            for since_index, page in list(self.__pages.items()):
+                if since_index <= index < page["next_index"]:
+                    del self.__pages[since_index]
+
+    def __late_to_store(self, index: int):
+        # El disco es append-only. No pasa salvo que llegue hot_size chats tarde
+        logger.warning(f"Dropping chat {index}, older than the history kept in memory")
+
+    def __evict(self):
+        """Mueve a disco los chats mas viejos que hot_size, de a page_size"""
+        if self.store is None or len(self.entries) < self.hot_size + self.page_size:
+            return
+        count = len(self.entries) - self.hot_size
+        self.store.append(self.entries[:count])
+        del self.entries[:count]
+        del self.indexes[:count]
+
+    def page(self, since_index: int = 0, limit: Optional[int] = None) -> dict:
+        """
+        Chats con indice desde since_index, a lo mas limit (y page_size), como
+        { messages: [{ index, username, message }], next_index }. next_index
+        es el cursor de la pagina siguiente, None si no hay mas chats
+        """
+        limit = self.page_size if limit is None else max(0, min(limit, self.page_size))
+        with self.__lock:
+            cached = self.__pages.get(since_index) if limit == self.page_size else None
+            if cached is not None:
+                self.__pages.move_to_end(since_index)
+                return cached
+
+            messages: List[dict] = []
+            next_index = None
+            if self.store and self.store.last_index is not None and since_index <= self.store.last_index:
+                messages, next_index = self.store.read(since_index, limit)
+
+            if next_index is None:
+                # Sigue en memoria, donde todos son posteriores a los del store
+                start = bisect_left(self.indexes, since_index)
+                end = min(start + limit - len(messages), len(self.entries))
+                messages += self.entries[start:end]
+                next_index = self.indexes[end] if end < len(self.indexes) else None
+
+            response = {"messages": messages, "next_index": next_index}
+            # Sin next_index la pagina cambia con el proximo chat
+            if len(messages) == self.page_size and next_index is not None:
+                self.__pages[since_index] = response
+                if len(self.__pages) > MAX_CACHED_PAGES:
+                    self.__pages.popitem(last=False)
+            return response
+
+    def __iter__(self) -> Iterator[dict]:
+        """Todos los chats, del store y en memoria. Sostiene el lock"""
+        with self.__lock:
+            if self.store:
+                yield from self.store
+            yield from self.entries
+
+    def load(self, messages: Dict[int, dict]) -> "MessageLog":
+        """Reemplaza el historial por messages, { index: { username, message } }"""
+        with self.__lock:
+            if self.store:
+                self.store.clear()
+            self.indexes = []
+            self.entries = []
+            self.__pages.clear()
+            for index, entry in sorted(messages.items()):
+                self.indexes.append(index)
+                self.entries.append({"index": index, **entry})
+                self.__evict()
+        return self
+
+    def clear(self):
+        self.load({})
@@ -0,0 +1,336 @@
+"""Historial de chats en disco, en segmentos append-only.
+
+Cada segmento es un archivo con un frame por chat (ver src/utils/protocol.py),
+de a lo mas segment_size chats, nombrado por el indice de su primer chat.
+Al llenarse se sella, escribiendo a su lado su tabla de indice -> offset
+(.idx): la cantidad de chats, sus indices y los offsets de sus frames, todos
+int64.
+
+Los segmentos y sus tablas se leen por mmap: buscar un chat es una busqueda
+binaria sobre la tabla mapeada, y lo leido queda en el cache de paginas del
+sistema operativo, que lo libera cuando necesita, en vez de en la memoria
+del proceso. Solo quedan mapeados los MAX_OPEN_SEGMENTS segmentos usados
+mas recientemente. En memoria solo se guarda la tabla del segmento activo.
+
+Los segmentos sellados mas viejos que retention segundos, o los que hacen
+que el historial pase de max_bytes, se borran enteros, del mas viejo al mas
+nuevo.
+"""
+import logging
+import mmap
+import os
+import shutil
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from time import time
+from typing import Iterator, List, Optional, Tuple
+
+from colorama import Fore as Color
+
+from ..utils.protocol import iter_frames, pack_frame, unpack_frame
+
+logger = logging.getLogger(f"{Color.CYAN}[MessageStore]{Color.RESET}")
+
+# Chats por segmento
+SEGMENT_SIZE = 10_000
+# Segmentos sellados mapeados a la vez
+MAX_OPEN_SEGMENTS = 8
+SEGMENT_SUFFIX = ".seg"
+INDEX_SUFFIX = ".idx"
+
+
+class _Segment:
+    """Un archivo de chats. Su tabla esta en memoria mientras es el segmento
+    activo, y se mapea desde el .idx una vez sellado"""
+
+    def __init__(self, path: str, first_index: int) -> None:
+        self.path = path
+        self.index_path = path[: -len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+        self.first_index = first_index
+        self.last_index = first_index
+        self.count = 0
+        self.size = 0
+        # Hora de su ultimo chat, para la retencion
+        self.mtime = time()
+
+        self.sealed = False
+        self.indexes = array("q")
+        self.offsets = array("q")
+
+        self._data: Optional[mmap.mmap] = None
+        self._table: Optional[mmap.mmap] = None
+        self._views: List[memoryview] = []
+
+    def table(self) -> Tuple[array, array]:
+        """Indices y offsets de sus chats, mapeados si esta sellado"""
+        if not self.sealed:
+            return self.indexes, self.offsets
+        if self._table is None:
+            with open(self.index_path, "rb") as f:
+                self._table = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            table = memoryview(self._table).cast("q")
+            self._views = [table, table[1 : 1 + self.count], table[1 + self.count : 1 + 2 * self.count]]
+        return self._views[1], self._views[2]
+
+    def read(self, position: int) -> dict:
+        """El chat en la posicion dada del segmento"""
+        if self._data is None or len(self._data) < self.size:
+            # El segmento activo crecio desde que se mapeo
+            self.close_data()
+            with open(self.path, "rb") as f:
+                self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        _, offsets = self.table()
+        end = offsets[position + 1] if position + 1 < self.count else self.size
+        return unpack_frame(self._data[offsets[position] : end])
+
+    def seal(self):
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, "wb") as f:
+            array("q", [self.count]).tofile(f)
+            self.indexes.tofile(f)
+            self.offsets.tofile(f)
+        os.replace(tmp_path, self.index_path)
+        self.sealed = True
+        self.indexes = self.offsets = None
+
+    def close_data(self):
+        if self._data is not None:
+            self._data.close()
+            self._data = None
+
+    def close(self):
+        self.close_data()
+        # Un mmap no se puede cerrar mientras haya memoryviews sobre el
+        for view in reversed(self._views):
+            view.release()
+        self._views = []
+        if self._table is not None:
+            self._table.close()
+            self._table = None
+
+    def delete(self):
+        self.close()
+        for path in (self.path, self.index_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class MessageStore:
+    def __init__(
+        self,
+        data_dir: str,
+        segment_size: int = SEGMENT_SIZE,
+        retention: Optional[float] = None,
+        max_bytes: Optional[int] = None,
+    ) -> None:
+        """Chats en segmentos append-only bajo data_dir, ordenados por indice
+
+        Parameters
+        ----------
+        data_dir : str
+            Directorio de los segmentos. Se crea si no existe, y se recuperan
+            los segmentos que ya tenga
+        segment_size : int
+            Chats por segmento
+        retention : float
+            Segundos que se guarda un segmento sellado. None para siempre
+        max_bytes : int
+            Tamaño maximo del historial en disco. None sin limite
+        """
+        os.makedirs(data_dir, exist_ok=True)
+        self.data_dir = data_dir
+        self.segment_size = segment_size
+        self.retention = retention
+        self.max_bytes = max_bytes
+
+        self.segments: List[_Segment] = []
+        # Primer indice de cada segmento, para buscar en cual esta un chat
+        self.first_indexes: List[int] = []
+        # Segmentos sellados mapeados, del usado hace mas tiempo al mas reciente
+        self.__open: "OrderedDict[int, _Segment]" = OrderedDict()
+        self.__active_file = None
+
+        self.__recover()
+
+    def __len__(self) -> int:
+        return sum(segment.count for segment in self.segments)
+
+    @property
+    def size(self) -> int:
+        return sum(segment.size for segment in self.segments)
+
+    @property
+    def last_index(self) -> Optional[int]:
+        return self.segments[-1].last_index if self.segments else None
+
+    def append(self, entries: List[dict]):
+        """Agrega chats { index, ... } con indices crecientes, mayores a last_index"""
+        now = time()
+        for entry in entries:
+            segment = self.segments[-1] if self.segments else None
+            if segment is None or segment.sealed:
+                segment = self.__new_segment(entry["index"])
+
+            frame = pack_frame(entry)
+            self.__active_file.write(frame)
+            segment.indexes.append(entry["index"])
+            segment.offsets.append(segment.size)
+            segment.last_index = entry["index"]
+            segment.count += 1
+            segment.size += len(frame)
+            segment.mtime = now
+
+            if segment.count >= self.segment_size:
+                self.__seal(segment)
+
+        if self.__active_file is not None:
+            self.__active_file.flush()
+        self.apply_retention()
+
+    def read(self, since_index: int, limit: int) -> Tuple[List[dict], Optional[int]]:
+        """
+        Hasta limit chats con indice desde since_index, y el indice del
+        siguiente guardado (None si no hay mas)
+        """
+        entries = []
+        i = max(0, bisect_right(self.first_indexes, since_index) - 1)
+        position = None
+        while i < len(self.segments):
+            segment = self.__use(i)
+            indexes, _ = segment.table()
+            if position is None:
+                position = bisect_left(indexes, since_index)
+            while position < segment.count:
+                if len(entries) == limit:
+                    return entries, indexes[position]
+                entries.append(segment.read(position))
+                position += 1
+            i += 1
+            position = 0
+        return entries, None
+
+    def __iter__(self) -> Iterator[dict]:
+        for i in range(len(self.segments)):
+            segment = self.__use(i)
+            for position in range(segment.count):
+                yield segment.read(position)
+
+    def apply_retention(self):
+        """Borra los segmentos sellados mas viejos que retention, o que hacen
+        pasar el historial de max_bytes. Nunca el activo"""
+        now = time()
+        size = self.size
+        while len(self.segments) > 1 and self.segments[0].sealed:
+            oldest = self.segments[0]
+            expired = self.retention is not None and now - oldest.mtime > self.retention
+            if not expired and (self.max_bytes is None or size <= self.max_bytes):
+                break
+
+            logger.debug(f"Dropping {oldest.count} chats up to index {oldest.last_index}")
+            size -= oldest.size
+            self.__open.pop(id(oldest), None)
+            oldest.delete()
+            del self.segments[0]
+            del self.first_indexes[0]
+
+    def clear(self):
+        """Borra todo el historial"""
+        self.close()
+        for segment in self.segments:
+            segment.delete()
+        self.segments = []
+        self.first_indexes = []
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+        self.__open.clear()
+        if self.__active_file is not None:
+            self.__active_file.close()
+            self.__active_file = None
+
+    def delete(self):
+        """Borra el historial y data_dir"""
+        self.clear()
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+
+    def __new_segment(self, first_index: int) -> _Segment:
+        path = os.path.join(self.data_dir, f"{first_index:020d}{SEGMENT_SUFFIX}")
+        segment = _Segment(path, first_index)
+        self.__active_file = open(path, "wb")
+        self.segments.append(segment)
+        self.first_indexes.append(first_index)
+        return segment
+
+    def __seal(self, segment: _Segment):
+        self.__active_file.close()
+        self.__active_file = None
+        segment.close()
+        segment.seal()
+
+    def __use(self, i: int) -> _Segment:
+        """El segmento i, manteniendo mapeados solo los usados recientemente"""
+        segment = self.segments[i]
+        if segment.sealed:
+            self.__open[id(segment)] = segment
+            self.__open.move_to_end(id(segment))
+            while len(self.__open) > MAX_OPEN_SEGMENTS:
+                _, closed = self.__open.popitem(last=False)
+                closed.close()
+        return segment
+
+    def __recover(self):
+        """Carga los segmentos que ya estan en data_dir. Solo el ultimo puede
+        no estar sellado, y se sigue escribiendo en el"""
+        names = sorted(name for name in os.listdir(self.data_dir) if name.endswith(SEGMENT_SUFFIX))
+        for name in names:
+            segment = _Segment(os.path.join(self.data_dir, name), int(name[: -len(SEGMENT_SUFFIX)]))
+            segment.size = os.path.getsize(segment.path)
+            segment.mtime = os.path.getmtime(segment.path)
+
+            if os.path.exists(segment.index_path):
+                with open(segment.index_path, "rb") as f:
+                    header = array("q")
+                    header.fromfile(f, 1)
+                    segment.count = header[0]
+                    f.seek(8 * segment.count)
+                    header.fromfile(f, 1)
+                    segment.last_index = header[1]
+                segment.sealed = True
+                segment.indexes = segment.offsets = None
+            else:
+                self.__scan(segment)
+                if segment.count == 0:
+                    segment.delete()
+                    continue
+
+            self.segments.append(segment)
+            self.first_indexes.append(segment.first_index)
+
+        if self.segments and not self.segments[-1].sealed:
+            self.__active_file = open(self.segments[-1].path, "ab")
+            if self.segments[-1].count >= self.segment_size:
+                self.__seal(self.segments[-1])
+        if self.segments:
+            logger.debug(f"Recovered {len(self)} chats from {len(self.segments)} segments")
+
+    def __scan(self, segment: _Segment):
+        """Arma la tabla de un segmento sin sellar leyendolo. Trunca un chat
+        escrito a medias al final"""
+        if segment.size == 0:
+            return
+        with open(segment.path, "r+b") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                start = 0
+                for entry, end in iter_frames(buf):
+                    segment.indexes.append(entry["index"])
+                    segment.offsets.append(start)
+                    segment.last_index = entry["index"]
+                    start = end
+            if start < segment.size:
+                logger.error(f"Dropping {segment.size - start} bytes of incomplete chats at the end of {segment.path}")
+                f.truncate(start)
+        segment.count = len(segment.indexes)
+        segment.size = start
@@ -1,16 +1,30 @@
 import logging
+import os
 import pickle as pkl
 from threading import Thread
-from time import sleep
-from typing import Callable
+from time import perf_counter, sleep
+from typing import Callable, Optional
 
 import socketio
 from colorama import Fore as Color
-from .Server import Server
-from ..utils.networking import get_public_ip, request_random_server, request_replica_addr, send_server_addr, change_server_addr
+from .Batcher import BATCH_DELAY, BATCH_SIZE
+from .Server import THREAD_MODE, Server
+from ..utils.networking import DNSClient, get_dns_client, get_public_ip
 
 logger = logging.getLogger(f"{Color.MAGENTA}[MigrationManager]{Color.RESET}")
 
+# Segundos entre reportes de carga al DNS
+BEACON_INTERVAL = 5
+# Servidores a probar antes de dar por fallida una migracion
+MAX_MIGRATION_ATTEMPTS = 3
+
+
+def system_load() -> float:
+    """Carga del sistema por CPU. 0 si el sistema no la reporta (Windows)"""
+    if not hasattr(os, "getloadavg"):
+        return 0.0
+    return os.getloadavg()[0] / (os.cpu_count() or 1)
+
 
 class MigrationManager:
     def __init__(
@@ -19,13 +33,28 @@ class MigrationManager:
         dns_port: int,
         server_uri: str,
         min_n: int = 0,
+        server_mode: str = THREAD_MODE,
+        history_dir: Optional[str] = None,
+        history_retention: Optional[float] = None,
+        batch_size: int = BATCH_SIZE,
+        batch_delay: float = BATCH_DELAY,
     ) -> None:
+        """server_mode: THREAD_MODE o ASYNC_MODE de los Server que levanta.
+        history_dir y history_retention: donde y por cuanto guardan en disco
+        el historial. batch_size y batch_delay: como juntan los chats que
+        mandan (ver Server)"""
         self.server: Server = None
         self.server_th: Thread = None
         self.port: int = None
         self.min_n = min_n
+        self.server_mode = server_mode
+        self.history_dir = history_dir
+        self.history_retention = history_retention
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
         self.dns_host = dns_host
         self.dns_port = dns_port
+        self.dns: DNSClient = get_dns_client(dns_host, dns_port)
         self.server_uri = server_uri
 
     def _start_server(self, vector_clock_init=None, messages=None):
@@ -34,23 +63,32 @@ class MigrationManager:
             self.ip,
             self.port,
             self.min_n,
+            self.server_mode,
+            history_dir=self.history_dir,
+            history_retention=self.history_retention,
+            batch_size=self.batch_size,
+            batch_delay=self.batch_delay,
         )
         self.server.serve()
     
-    def get_replica_address(self):
-        return request_replica_addr(
-            self.dns_host,
-            self.dns_port,
-            self.addr,
-            self.server_uri,
-        )
+    def get_replica_address(self, use_cache=True):
+        return self.dns.request_replica_addr(self.addr, self.server_uri, use_cache=use_cache)
 
     def _migrate(self):
         # TODO: 1. Request random server
         selected_server = False
         new_addr = None
+        attempts = 0
         while not selected_server or new_addr == None:
-            new_addr = request_random_server(self.dns_host, self.dns_port, self.server_uri)
+            if attempts == MAX_MIGRATION_ATTEMPTS:
+                return False
+            attempts += 1
+
+            try:
+                new_addr = self.dns.request_random_server(self.server_uri)
+            except OSError as e:
+                logger.error(f"Could not reach the DNS: {e!r}")
+                return False
             print(new_addr, "_migrate")
 
             if not new_addr:
@@ -60,15 +98,25 @@ class MigrationManager:
             logger.debug(f"Selected new server {new_addr}")
             # TODO: Implementar bien esta funcion + OK
             selected_server = self.request_migration_connection(new_addr)
+            if not selected_server:
+                # Que el DNS no lo vuelva a elegir pronto
+                try:
+                    self.dns.report_failure(new_addr)
+                except OSError as e:
+                    logger.error(f"Could not reach the DNS: {e!r}")
 
         # TODO: 4. Pausar clientes
         # Avisar a clientes que paren de mandar mensajes
         self.server.send_pause_messaging_signal(pause=True)
 
         # TODO: 5. Mandar data a nuevo server
+        # Sin los relojes de usuarios que ya no estan
+        self.server.compact_clock()
         vector_clock_inits = self.server.clock.dump()
-        messages = self.server.messages
-        self.request_migration(vector_clock_inits, messages, self._on_migrate_complete, new_addr)
+        if not self.request_migration(vector_clock_inits, self._on_migrate_complete, new_addr):
+            # Los clientes siguen en este servidor
+            self.server.send_pause_messaging_signal(pause=False)
+            return False
         return True
 
         # Una vez que el nuevo server responda con su inicializacion del server:
@@ -87,26 +135,36 @@ class MigrationManager:
             logger.error(e)
             return False
 
-    def request_migration(self, vector_clock_inits, messages, callback: Callable, addr):
-        # vector = pkl.dumps(vector_clock_inits)
-        messages = messages
-        data = (vector_clock_inits, messages, self.server.min_user_count, self.server.history_sent)
-
-        def on_ack():
+    def request_migration(self, vector_clock_inits, callback: Callable, addr) -> bool:
+        """Manda el estado en un evento "migrate", la historia de a una pagina
+        por evento "migrate_history" y cierra con "migrate_end", esperando el
+        ack de cada uno. Asi no se arma el historial entero en memoria ni en un
+        solo mensaje (engineio corta los de mas de 1 MB)"""
+        data = (vector_clock_inits, self.server.min_user_count, self.server.history_sent)
+        try:
+            self.client.call("migrate", data)
+            since_index = 0
+            while since_index is not None:
+                page = self.server.messages.page(since_index)
+                self.client.call("migrate_history", page["messages"])
+                since_index = page["next_index"]
+            self.client.call("migrate_end")
+        except socketio.exceptions.SocketIOError as e:
+            logger.error(f"Migration to {addr} failed: {e!r}")
+            return False
+        finally:
             self.client.disconnect()
             self.client = None
-            callback(addr)
-            self.server.cleanup()
 
-        self.client.emit("migrate", data, callback=on_ack)
+        callback(addr)
+        self.server.cleanup()
+        return True
 
     def _on_migrate_complete(self, addr):
         # Una vez que se haya migrado los datos:
         # Comunicar para que se reconecten
         logger.debug("Sending reconnection signals")
-        change_server_addr(
-            self.dns_host,
-            self.dns_port,
+        self.dns.change_server_addr(
             self.server_uri,
             server_addr=addr,
             self_addr=self.addr,
@@ -119,12 +177,7 @@ class MigrationManager:
         # Iniciar el servidor en otro thread
         self.ip, self.port = get_public_ip()
         self.addr = f"http://{self.ip}:{self.port}"
-        _, is_active_server = send_server_addr(
-            self.dns_host,
-            self.dns_port,
-            self.server_uri,
-            self.addr,
-        )
+        _, is_active_server = self.dns.send_server_addr(self.server_uri, self.addr)
 
         self.server_th = Thread(target=self._start_server, args=[vectorClock, messages], daemon=True)
 
@@ -135,6 +188,22 @@ class MigrationManager:
         if is_active_server:
             self.cycle_th.start()
 
+        self.beacon_th = Thread(target=self._send_beacons, daemon=True)
+        self.beacon_th.start()
+
+    def _send_beacons(self):
+        """Reporta periodicamente la carga de este servidor al DNS, que la usa
+        para elegir a donde migrar"""
+        rtt = 0.0
+        while True:
+            start = perf_counter()
+            try:
+                self.dns.send_beacon(self.addr, system_load(), rtt)
+                rtt = perf_counter() - start
+            except OSError as e:
+                logger.debug(f"Could not send beacon: {e!r}")
+            sleep(BEACON_INTERVAL)
+
     def start(self):
         self._start_server_cycle()
 
@@ -0,0 +1,57 @@
+"""Client managers de socketio que codifican una sola vez lo que se emite a
+una sala.
+
+Los managers de python-socketio arman y codifican el paquete de nuevo para
+cada participante de la sala. Estos lo codifican una vez y mandan el mismo
+texto a todos. Los emits con callback necesitan un id de ack por
+participante, asi que siguen el camino de siempre.
+"""
+import socketio
+from socketio import packet
+
+
+def _encode(server, event: str, data, namespace: str) -> list:
+    """Paquetes de engineio de un evento, como los arma Server._emit_internal"""
+    if isinstance(data, tuple):
+        data = list(data)
+    elif data is not None:
+        data = [data]
+    else:
+        data = []
+    encoded = server.packet_class(packet.EVENT, namespace=namespace, data=[event] + data).encode()
+    # Con datos binarios son varios
+    return encoded if isinstance(encoded, list) else [encoded]
+
+
+class RoomManager(socketio.BaseManager):
+    def emit(self, event, data, namespace, room=None, skip_sid=None, callback=None, **kwargs):
+        if callback is not None or namespace not in self.rooms:
+            return super().emit(event, data, namespace, room, skip_sid, callback, **kwargs)
+        if not isinstance(skip_sid, list):
+            skip_sid = [skip_sid]
+
+        encoded = None
+        for sid, eio_sid in self.get_participants(namespace, room):
+            if sid in skip_sid:
+                continue
+            if encoded is None:
+                encoded = _encode(self.server, event, data, namespace)
+            for pkt in encoded:
+                self.server.eio.send(eio_sid, pkt)
+
+
+class AsyncRoomManager(socketio.AsyncManager):
+    async def emit(self, event, data, namespace, room=None, skip_sid=None, callback=None, **kwargs):
+        if callback is not None or namespace not in self.rooms or room not in self.rooms[namespace]:
+            return await super().emit(event, data, namespace, room, skip_sid, callback, **kwargs)
+        if not isinstance(skip_sid, list):
+            skip_sid = [skip_sid]
+
+        encoded = None
+        for sid, eio_sid in self.get_participants(namespace, room):
+            if sid in skip_sid:
+                continue
+            if encoded is None:
+                encoded = _encode(self.server, event, data, namespace)
+            for pkt in encoded:
+                await self.server.eio.send(eio_sid, pkt)
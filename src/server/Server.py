@@ -1,23 +1,64 @@
+import asyncio
+import atexit
 import logging
+import os
 import pickle as pkl
-from threading import Thread
-from typing import TypedDict
+import tempfile
+from threading import Lock, Thread
+from time import monotonic, sleep
+from typing import Optional, TypedDict
 
 import socketio
+from aiohttp import web
 from colorama import Fore as Color
 from werkzeug.serving import make_server
 
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+from .Batcher import BATCH_DELAY, BATCH_SIZE, Batcher
+from .MessageLog import HOT_SIZE, MessageLog
+from .MessageStore import MessageStore
+from .RoomManager import AsyncRoomManager, RoomManager
 from .ServerCoordinator import ServerCoordinator
 
-from ..utils.vectorClock import MESSAGE, SENDER_ID, VectorClock
+from ..utils.vectorClock import FIRST_COUNT, GAP_CHECK_INTERVAL, LAST_COUNT, MESSAGE, SENDER_ID, VectorClock
 
 from .Users import UserList
 from MigrationManager import MigrationManager
 
 logger = logging.getLogger(f"{Color.GREEN}[Server]{Color.RESET}")
+
+# Un thread por conexion (werkzeug) o todas en un event loop (aiohttp)
+THREAD_MODE = "thread"
+ASYNC_MODE = "async"
+# Sala de los usuarios del chat. No incluye las conexiones de otros
+# servidores (replica, migracion)
+CHAT_ROOM = "chat"
+
+# Segundos que se guarda el reloj de un usuario desconectado antes de olvidarlo
+CLOCK_RETIRE_GRACE = 300
+# Segundos entre reportes de como se entregan los chats, ver DeliveryStats
+DELIVERY_STATS_INTERVAL = 60
 authType = TypedDict("Auth", {"username": str, "publicUri": str})
 
 
+def raise_open_files_limit():
+    """Sube el limite de archivos abiertos al maximo permitido, cada conexion
+    usa uno y el limite por defecto suele ser 1024. No hace nada en Windows"""
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError) as e:
+            logger.warning(f"Could not raise the open files limit ({soft}): {e!r}")
+
+
 class Server:
     def __init__(
         self,
@@ -25,30 +66,73 @@ class Server:
         host: str,
         port: int = 3000,
         min_user_count: int = 0,
+        mode: str = THREAD_MODE,
+        history_dir: Optional[str] = None,
+        history_hot_size: int = HOT_SIZE,
+        history_retention: Optional[float] = None,
+        batch_size: int = BATCH_SIZE,
+        batch_delay: float = BATCH_DELAY,
     ) -> None:
-        self.server = socketio.Server(cors_allowed_origins="*")
-        self.app = socketio.WSGIApp(self.server)
+        """
+        Con history_dir, solo los ultimos history_hot_size chats quedan en
+        memoria y los anteriores se guardan en disco, por history_retention
+        segundos (None para siempre). Ver MessageStore. El historial en disco
+        es de este proceso: se borra al terminar (stop o salida normal) y no
+        se recupera al reiniciar
+
+        Los chats se mandan en eventos "chat_batch" de hasta batch_size chats,
+        esperando a lo mas batch_delay segundos (ver Batcher). Con batch_size
+        1 se manda un evento "chat" por chat
+        """
         self.migration_manager = migration_manager
         self.port = port
         self.host = host
+        self.mode = mode
 
-        self.__created_server = make_server(
-            host,
-            port,
-            self.app,
-            threaded=True,
-        )
+        if mode == ASYNC_MODE:
+            # Los handlers son los mismos, AsyncServer tambien llama a
+            # funciones normales. Corren en el thread del event loop
+            self.server = socketio.AsyncServer(
+                async_mode="aiohttp", cors_allowed_origins="*", client_manager=AsyncRoomManager()
+            )
+            self.app = web.Application()
+            self.server.attach(self.app)
+            self.loop = asyncio.new_event_loop()
+            self.__runner: web.AppRunner = None
+        else:
+            self.server = socketio.Server(cors_allowed_origins="*", client_manager=RoomManager())
+            self.app = socketio.WSGIApp(self.server)
+            self.__created_server = make_server(
+                host,
+                port,
+                self.app,
+                threaded=True,
+            )
         self.__created_server_th: Thread = None
         self.__migrating = False
 
         self.users = UserList()
         self.history_sent = False
         self.min_user_count = min_user_count
-        self.messages = {}
+        store = None
+        if history_dir is not None:
+            # Un directorio nuevo por servidor, puede haber varios en la misma
+            # maquina y el puerto cambia entre ejecuciones
+            os.makedirs(history_dir, exist_ok=True)
+            data_dir = tempfile.mkdtemp(prefix=f"{host}_{port}_", dir=history_dir)
+            store = MessageStore(data_dir, retention=history_retention)
+            atexit.register(store.delete)
+        self.messages = MessageLog(store=store, hot_size=history_hot_size)
 
         self.server_coord = ServerCoordinator(self.server, self)
         self.next_index = 0
 
+        # Held while users join and while chats are broadcast, so every
+        # user gets its broadcast base between two broadcasts
+        self.__broadcast_lock = Lock()
+
+        self.batcher = Batcher(self.__emit_chats, batch_size, batch_delay) if batch_size > 1 else None
+
         self.setup_handlers()
 
         self.clock: VectorClock = VectorClock("server", self._on_clock_deliver_message)
@@ -59,19 +143,59 @@ class Server:
         self.server.on("chat", self.on_chat)
         self.server.on("addr_request", self.addr_request)
         self.server.on("migrate", self.on_migrate)
+        self.server.on("migrate_history", self.on_migrate_history)
+        self.server.on("migrate_end", self.on_migrate_end)
+        self.server.on("retransmit", self.on_retransmit)
+        self.server.on("history", self.on_history)
         self.server.on("*", self.catch_all)
 
     def serve(self):
         # TODO: Registrarse en el DNS
-        logger.debug(f"Running App on http://{self.host}:{self.port}")
-        self.__created_server_th = Thread(target=self.__created_server.serve_forever, daemon=True)
+        logger.debug(f"Running App on http://{self.host}:{self.port} ({self.mode} mode)")
+        if self.mode == ASYNC_MODE:
+            raise_open_files_limit()
+            self.__created_server_th = Thread(target=self.__serve_async, daemon=True)
+        else:
+            self.__created_server_th = Thread(target=self.__created_server.serve_forever, daemon=True)
         self.__created_server_th.start()
+        Thread(target=self.__check_gaps, daemon=True).start()
+        if self.batcher:
+            Thread(target=self.batcher.run, daemon=True).start()
+
+    def __serve_async(self):
+        asyncio.set_event_loop(self.loop)
+        self.__runner = web.AppRunner(self.app)
+        self.loop.run_until_complete(self.__runner.setup())
+        self.loop.run_until_complete(web.TCPSite(self.__runner, self.host, self.port).start())
+        self.loop.run_forever()
 
     def stop(self):
-        self.__created_server.shutdown()
+        if self.mode == ASYNC_MODE:
+            asyncio.run_coroutine_threadsafe(self.__runner.cleanup(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        else:
+            self.__created_server.shutdown()
         self.__created_server_th.join()
+        if self.messages.store:
+            self.messages.store.delete()
         logger.debug("Server terminated")
 
+    def emit(self, event: str, data=None, **kwargs):
+        """
+        Emite con socketio en ambos modos, desde cualquier thread. En modo
+        async se agenda en el event loop y no espera a que se envie
+        """
+        if self.mode == ASYNC_MODE:
+            future = asyncio.run_coroutine_threadsafe(self.server.emit(event, data, **kwargs), self.loop)
+            future.add_done_callback(self.__log_emit_error)
+        else:
+            self.server.emit(event, data, **kwargs)
+
+    @staticmethod
+    def __log_emit_error(future):
+        if not future.cancelled() and future.exception():
+            logger.error(f"Emit failed: {future.exception()!r}")
+
     def on_connect(self, sid: str, environ: dict, auth: authType):
         """
         On connect, create a new user
@@ -101,46 +225,64 @@ class Server:
             raise ConnectionRefusedError()
 
         logger.debug(f"User logging in with auth: {auth}")
-        user = self.users.add_user(auth["username"], sid, auth["publicUri"])
+        with self.__broadcast_lock:
+            user = self.users.add_user(auth["username"], sid, auth["publicUri"])
 
-        if user is None:
-            logger.debug(f'Username {auth["username"]} is already taken')
-            raise ConnectionRefusedError("Username is invalid or already taken")
+            if user is None:
+                logger.debug(f'Username {auth["username"]} is already taken')
+                raise ConnectionRefusedError("Username is invalid or already taken")
+
+            # Before any chat broadcast to the user
+            self.emit("send_uuid", (user.uuid, self.clock.broadcast_base(user.uuid)), room=sid)
+            self.server.enter_room(sid, CHAT_ROOM)
 
         if not auth["reconnecting"]:
-            self.server.emit(
+            self.emit(
                 "server_message",
                 {"message": f'\u2713 {auth["username"]} has connected to the server'},
+                room=CHAT_ROOM,
             )
 
-        self.server.emit("send_uuid", user.uuid, room=sid)
-
         # Si se supero el limite inferior de usuarios conectados, mandar la historia
         if len(self.users) >= self.min_user_count and not auth["reconnecting"]:
             logger.debug(f"Sending history")
 
+            # Solo la primera pagina, el cliente pide las demas (ver on_history)
             if self.history_sent:
                 # Solo al cliente conectado si ya se mando a todos
-                self.server.emit(
-                    "message_history",
-                    {"messages": [x for x in sorted(self.messages.items())]},
-                    room=sid,
-                )
+                self.emit("message_history", self.messages.page(), room=sid)
             else:
                 # A todos si todavia no se hace
-                self.server.emit("message_history", {"messages": [x for x in sorted(self.messages.items())]})
+                self.emit("message_history", self.messages.page(), room=CHAT_ROOM)
                 self.history_sent = True
 
         logger.debug(f"{user.name} connected with sid {user.sid}")
 
-    def on_migrate(self, _, vector_clock_inits, messages, min_user_count, history_sent):
+    def on_migrate(self, _, vector_clock_inits, min_user_count, history_sent):
+        """Estado del servidor que migra. Le siguen su historia en eventos
+        "migrate_history" y un "migrate_end" (ver MigrationManager.request_migration)"""
         logger.debug("Starting on_migrate endpoint")
-        # self.clock = self.clock.load_from(vector_clock_inits[0], vector_clock_inits[1])
-        self.clock = self.clock.load_from(vector_clock_inits[0], vector_clock_inits[1])
-        self.messages = messages
-        self.__migrating = False
+        # Also takes the (sent, received) dicts of servers running an older version
+        self.clock = self.clock.load_from(vector_clock_inits)
+        # Los usuarios del server anterior se reconectan con otro uuid
+        for uuid in list(self.clock.slots):
+            if not self.users.get_user_by_uuid(uuid):
+                self.clock.retire(uuid)
+        self.compact_clock()
+        self.messages.clear()
         self.history_sent = history_sent
         self.min_user_count = min_user_count
+
+    def on_migrate_history(self, _, messages: list):
+        """Una pagina de la historia migrada, en orden, como la da MessageLog.page"""
+        for entry in messages:
+            self.messages.append(entry["index"], entry["username"], entry["message"])
+
+    def on_migrate_end(self, _):
+        if self.messages.last_index is not None:
+            # Los chats nuevos van despues de los migrados
+            self.next_index = max(self.next_index, self.messages.last_index + 1)
+        self.__migrating = False
         self.cycle_th = Thread(target=self.migration_manager._server_cycle, daemon=True)
         self.cycle_th.start()
 
@@ -154,13 +296,16 @@ class Server:
             logger.debug(f"User disconnected: {client.name}")
 
             # Notificar al resto que el usuario se desconecto
-            self.server.emit(
+            self.emit(
                 "server_message",
                 {"message": f"\u274C {client.name} has disconnected from the server"},
+                room=CHAT_ROOM,
             )
 
             # Eliminar al usuario del registro
             self.users.del_user(client.uuid)
+            self.clock.retire(client.uuid)
+            self.compact_clock()
 
     def on_chat(self, sid, data):
         """Maneja el broadcast de los chats"""
@@ -174,18 +319,77 @@ class Server:
         client = self.users.get_user_by_uuid(uuid)
 
         # Agregar mensaje al registro
-        self.messages[message_index] = {"username": client.name, "message": message[MESSAGE]}
+        self.messages.append(message_index, client.name, message[MESSAGE])
 
         # Enviar mensaje solo si se supero el limite inferior
         if client and (len(self.users) >= self.min_user_count or self.history_sent):
-            for dest_uuid, user in self.users.users.items():
-                try:
-                    msg = self.clock.send_message(message[MESSAGE], dest_uuid)
-                    msg["username"] = client.name
-                    msg["index"] = message_index
-                    self.server.emit("chat", msg, to=user.sid)
-                except Exception as e:
-                    logger.error(e)
+            try:
+                # Un solo mensaje para todos, cada cliente calcula su MESSAGE_COUNT,
+                # codificado una vez para toda la sala (ver RoomManager)
+                with self.__broadcast_lock:
+                    msg = self.clock.broadcast_message(message[MESSAGE], list(self.users.users))
+                msg["username"] = client.name
+                msg["index"] = message_index
+                if self.batcher:
+                    self.batcher.add(msg)
+                else:
+                    self.emit("chat", msg, room=CHAT_ROOM)
+            except Exception as e:
+                logger.error(e)
+
+    def __emit_chats(self, msgs: list):
+        self.emit("chat_batch", msgs, room=CHAT_ROOM)
+
+    def on_history(self, sid, data):
+        """Una pagina de la historia desde data["since_index"], ver MessageLog.page"""
+        return self.messages.page(data.get("since_index", 0), data.get("limit"))
+
+    def on_retransmit(self, sid, data):
+        """Un cliente pide de nuevo los chats que no le llegaron"""
+        user = self.users.get_user_by_sid(sid)
+        if user is None:
+            return
+        msgs = self.clock.retransmit(user.uuid, data[FIRST_COUNT], data[LAST_COUNT])
+        if self.batcher and msgs:
+            self.emit("chat_batch", msgs, to=sid)
+        else:
+            for msg in msgs:
+                self.emit("chat", msg, to=sid)
+
+    def __check_gaps(self):
+        # Pedir a los clientes los chats que faltan para entregar los siguientes
+        next_report = monotonic() + DELIVERY_STATS_INTERVAL
+        last_stats = None
+        while True:
+            sleep(GAP_CHECK_INTERVAL)
+            for request in self.clock.check_gaps():
+                user = self.users.get_user_by_uuid(request[SENDER_ID])
+                if user:
+                    logger.debug(f"Asking {user.name} to retransmit {request}")
+                    self.emit("retransmit", request, to=user.sid)
+
+            if monotonic() >= next_report:
+                next_report += DELIVERY_STATS_INTERVAL
+                stats = self.clock.stats.snapshot()
+                # Solo si cambiaron desde el ultimo reporte
+                if stats != last_stats:
+                    self.__log_delivery_stats(stats)
+                    last_stats = stats
+
+    @staticmethod
+    def __log_delivery_stats(stats: dict):
+        logger.info(
+            f"Delivery: {stats['delayed']} chats delayed (avg {stats['delay_avg'] * 1000:.1f} ms, "
+            f"max {stats['delay_max'] * 1000:.1f} ms), {stats['duplicates']} duplicates, "
+            f"{stats['retransmit_requests']} retransmissions requested, "
+            f"{stats['gaps_skipped']} gaps skipped ({stats['messages_lost']} chats lost)"
+        )
+
+    def compact_clock(self):
+        """Olvida los relojes de usuarios desconectados hace mas de CLOCK_RETIRE_GRACE segundos"""
+        forgotten = self.clock.compact(CLOCK_RETIRE_GRACE)
+        if forgotten:
+            logger.debug(f"Forgot the clocks of {forgotten} departed users")
 
     def _on_clock_deliver_message(self, message: dict):
         self.server_coord.request_next_index(message)
@@ -199,7 +403,7 @@ class Server:
             received[uuid] = True
 
         for dest_uuid, user in self.users.users.items():
-            self.server.emit(
+            self.emit(
                 "pause_messaging",
                 pause,
                 to=user.sid,
@@ -207,7 +411,10 @@ class Server:
             )
 
     def send_reconnect_signal(self):
-        self.server.emit("reconnect")
+        # Los chats pendientes antes de que se vayan
+        if self.batcher:
+            self.batcher.flush()
+        self.emit("reconnect", room=CHAT_ROOM)
         self.users = UserList()
 
     def addr_request(self, sid, data):
@@ -219,4 +426,4 @@ class Server:
 
     def cleanup(self):
         self.clock = VectorClock("server", self._on_clock_deliver_message)
-        self.messages = {}
+        self.messages.clear()
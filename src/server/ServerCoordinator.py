@@ -1,7 +1,7 @@
 from collections import deque
 from typing import TypedDict
 from socketio import Server, Client
-from threading import Lock
+from threading import Event, Lock
 from time import sleep
 from Server import Server as ClientServer
 
@@ -19,6 +19,10 @@ class ServerCoordinator:
         self._indexLock = Lock()
         self.message_queue = deque()
 
+        # Avisado por el DNS cuando cambian los servidores de la URI
+        self._servers_changed = Event()
+        self._watch = None
+
     def setupCoordinatorHandlers(self):
         # TODO: Registrar los metodos de coordinacion aca
         # e.g: self.socketio.on('event', self.event)
@@ -27,14 +31,23 @@ class ServerCoordinator:
     def on_connect_other_server(self, sid: str, auth: authType):
         self.other_server_sid = sid
 
+    def _on_servers_changed(self, change: dict):
+        self._servers_changed.set()
+
     def connect(self):
+        if self._watch is None:
+            manager = self.server.migration_manager
+            self._watch = manager.dns.watch(manager.server_uri, self._on_servers_changed)
+
+        use_cache = True
         while True:
             try:
                 if self.coordinator_client and self.coordinator_client.connected:
                     return
 
                 #  Pedir direccion a DNS
-                addr = self.server.migration_manager.get_replica_address()
+                addr = self.server.migration_manager.get_replica_address(use_cache)
+                use_cache = True
                 if addr:
                     # Intentar conectar
                     client = Client()
@@ -51,8 +64,13 @@ class ServerCoordinator:
                     self.coordinator_client = client
                     return
             except Exception:
-                pass
-            sleep(0.1)
+                # No reintentar con una direccion cacheada que fallo
+                use_cache = False
+
+            # Esperar a que el DNS avise que se unio una replica, en vez de
+            # preguntarle cada 100 ms. Si fallo la conexion, reintentar pronto
+            self._servers_changed.wait(timeout=0.5 if not use_cache else 5)
+            self._servers_changed.clear()
 
     def on_disconnect(self):
         self.coordinator_client = None
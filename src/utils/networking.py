@@ -1,10 +1,13 @@
 import socket
-import pickle
-from time import sleep
-from typing import Tuple
+from itertools import count
+from threading import Event, Lock, Thread
+from time import monotonic, sleep
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
 import logging
 from colorama import Fore as Color
 
+from .protocol import MAX_DATAGRAM_SIZE, ProtocolError, pack_frame, recv_frame, unpack_frame
+
 logger = logging.getLogger(f"{Color.LIGHTBLUE_EX}[Networking]{Color.RESET}")
 
 
@@ -16,103 +19,448 @@ def get_public_ip() -> Tuple[str, int]:
     return public_ip, port
 
 
-def request_server_adrr(dns_host: str, dns_port: int, uri: str) -> str:
-    msg = pickle.dumps({"name": "addr_request", "uri": uri})
-
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.connect((dns_host, dns_port))
-        s.send(msg)
-
+class ResolverCache:
+    """Caches DNS answers so repeated lookups don't touch the network.
+
+    Entries are grouped by URI and expire after ttl seconds. Empty answers
+    (no server or replica yet) are cached too, but only for negative_ttl
+    seconds. Every entry remembers the registry generation of its URI sent
+    by the name server; the name server increments it whenever the servers
+    of the URI change, so seeing a newer generation drops stale entries.
+    """
+
+    def __init__(self, ttl: float = 30.0, negative_ttl: float = 1.0) -> None:
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+
+        # uri -> { key: (value, expires_at) }
+        self._entries: Dict[str, Dict[Hashable, Tuple[Any, float]]] = {}
+        # uri -> last known generation
+        self._generations: Dict[str, int] = {}
+        self._lock = Lock()
+
+    def get(self, uri: str, key: Hashable) -> Tuple[bool, Any]:
+        """Returns (True, value) on a hit and (False, None) on a miss"""
+        with self._lock:
+            entry = self._entries.get(uri, {}).get(key)
+            if entry is not None and entry[1] > monotonic():
+                self.hits += 1
+                return True, entry[0]
+            self.misses += 1
+            return False, None
+
+    def put(self, uri: str, key: Hashable, value: Any, generation: Optional[int] = None):
+        ttl = self.ttl if value else self.negative_ttl
+        with self._lock:
+            # An answer older than what we already know is stale
+            if not self._observe_generation(uri, generation):
+                return
+            self._entries.setdefault(uri, {})[key] = (value, monotonic() + ttl)
+
+    def observe_generation(self, uri: str, generation: Optional[int]):
+        """Drops the entries of uri if generation is newer than the cached one"""
+        with self._lock:
+            self._observe_generation(uri, generation)
+
+    def _observe_generation(self, uri: str, generation: Optional[int]) -> bool:
+        if generation is None:
+            return True
+        known = self._generations.get(uri, -1)
+        if generation > known:
+            self._generations[uri] = generation
+            self._entries.pop(uri, None)
+        return generation >= known
+
+    def reset_generation(self, uri: str, generation: int):
+        """Drops the entries of uri and takes generation as its current one,
+        even if older than the cached one (e.g. the name server restarted
+        without its registry, so generations started over)"""
+        with self._lock:
+            self._generations[uri] = generation
+            self._entries.pop(uri, None)
+
+    def invalidate(self, uri: str):
+        with self._lock:
+            self._entries.pop(uri, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generations.clear()
+
+
+class DNSClient:
+    """Client of the name server that reuses its connections.
+
+    Keeps up to pool_size idle connections open, so consecutive requests
+    (e.g. the ones made during a migration) don't pay a TCP handshake each.
+    Every socket operation is bounded by timeout, and failed requests are
+    retried up to retries times with exponential backoff. A request that
+    fails on a pooled connection (e.g. closed by the DNS while idle) is
+    retried right away on a new one. Thread safe: each request in flight
+    uses its own connection.
+
+    With udp (the default), lookups (see resolve) are sent as datagrams,
+    without any handshake. A lost datagram is resent after udp_timeout
+    seconds, doubled on every retry. Lookups go over a connection instead
+    when the answer doesn't fit in a datagram, and for udp_down_for seconds
+    after the name server didn't answer datagrams at all (e.g. an older one,
+    or a network that drops UDP).
+    """
+
+    def __init__(
+        self,
+        dns_host: str,
+        dns_port: int,
+        pool_size: int = 2,
+        timeout: float = 2.0,
+        retries: int = 3,
+        backoff: float = 0.05,
+        udp: bool = True,
+        udp_timeout: float = 0.1,
+        udp_down_for: float = 30.0,
+    ) -> None:
+        self.dns_host = dns_host
+        self.dns_port = dns_port
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.udp = udp
+        self.udp_timeout = udp_timeout
+        self.udp_down_for = udp_down_for
+        self.cache = ResolverCache()
+
+        self._idle: List[socket.socket] = []
+        self._pool_lock = Lock()
+
+        self._idle_udp: List[socket.socket] = []
+        self._ids = count()
+        # monotonic() time before which UDP isn't tried again
+        self._udp_down_until = 0.0
+
+    def _acquire(self) -> Tuple[socket.socket, bool]:
+        """Returns a connection and whether it was reused from the pool"""
+        with self._pool_lock:
+            if self._idle:
+                return self._idle.pop(), True
+        return socket.create_connection((self.dns_host, self.dns_port), timeout=self.timeout), False
+
+    def _release(self, sock: socket.socket):
+        with self._pool_lock:
+            if len(self._idle) < self.pool_size:
+                self._idle.append(sock)
+                return
+        sock.close()
+
+    def close(self):
+        with self._pool_lock:
+            idle, self._idle = self._idle, []
+            idle_udp, self._idle_udp = self._idle_udp, []
+        for sock in idle + idle_udp:
+            sock.close()
+
+    def pipeline(self, msgs: List[dict]) -> List[dict]:
+        """Sends every request over one connection without waiting for each response.
+        Responses are returned in the same order as the requests."""
+        payload = b"".join(pack_frame(msg) for msg in msgs)
+        attempt = 0
         while True:
-            response = s.recv(2048)
-            response: dict = pickle.loads(response)
-
-            if response["name"] == "addr_response" and response.get("req_uri", "") == uri:
-                return response["addr"]
-
-
-def request_replica_addr(dns_host: str, dns_port: int, my_addr: str, uri: str) -> str:
-    msg = pickle.dumps({
-        "name": "get_replica_addr",
-        "my_addr": my_addr,
-        "uri": uri
-    })
-
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.connect((dns_host, dns_port))
-        s.send(msg)
-
+            sock, reused = None, False
+            try:
+                sock, reused = self._acquire()
+                sock.sendall(payload)
+                responses = [recv_frame(sock) for _ in msgs]
+                self._release(sock)
+                return responses
+            except (OSError, ProtocolError) as e:
+                if sock is not None:
+                    sock.close()
+                if reused:
+                    continue
+                if attempt >= self.retries:
+                    raise
+                logger.debug(f"DNS request failed ({e!r}), retrying")
+                sleep(self.backoff * 2 ** attempt)
+                attempt += 1
+
+    def request(self, msg: dict) -> dict:
+        return self.pipeline([msg])[0]
+
+    def resolve(self, msg: dict) -> dict:
+        """Same as request, for read only requests that may go in a datagram"""
+        if self.udp and monotonic() >= self._udp_down_until:
+            response = self._request_datagram(msg)
+            if response is not None:
+                return response
+        return self.request(msg)
+
+    def _request_datagram(self, msg: dict) -> Optional[dict]:
+        """Sends msg in a datagram, resending it if lost. None if it must go over TCP"""
+        req_id = next(self._ids)
+        data = pack_frame({**msg, "id": req_id})
+        if len(data) > MAX_DATAGRAM_SIZE:
+            return None
+
+        with self._pool_lock:
+            sock = self._idle_udp.pop() if self._idle_udp else None
+        try:
+            if sock is None:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                sock.connect((self.dns_host, self.dns_port))
+
+            for attempt in range(self.retries + 1):
+                sock.send(data)
+                response = self._recv_datagram(sock, req_id, monotonic() + self.udp_timeout * 2 ** attempt)
+                if response is not None:
+                    break
+                logger.debug(f"DNS datagram {req_id} lost, retrying")
+            else:
+                # Every resend lost, e.g. UDP dropped on the way. Don't wait them out on every lookup
+                logger.debug(f"No answer to DNS datagram {req_id}, using TCP for a while")
+                self._udp_down_until = monotonic() + self.udp_down_for
+                sock.close()
+                return None
+        except OSError as e:
+            # Most likely ECONNREFUSED, the name server doesn't listen on UDP
+            logger.debug(f"DNS over UDP failed ({e!r}), using TCP for a while")
+            self._udp_down_until = monotonic() + self.udp_down_for
+            if sock is not None:
+                sock.close()
+            return None
+
+        with self._pool_lock:
+            if len(self._idle_udp) < self.pool_size:
+                self._idle_udp.append(sock)
+                sock = None
+        if sock is not None:
+            sock.close()
+        return None if response.get("name") == "tcp_required" else response
+
+    @staticmethod
+    def _recv_datagram(sock: socket.socket, req_id: int, deadline: float) -> Optional[dict]:
+        """Waits until deadline for the answer to req_id. Answers to earlier,
+        already retried requests on the same socket are skipped"""
         while True:
-            response = s.recv(2048)
-            response: dict = pickle.loads(response)
-
-            if response["name"] == "get_replica_addr_response":
-                return response["addr"]
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                return None
+            sock.settimeout(remaining)
+            try:
+                response = unpack_frame(sock.recv(65535))
+            except socket.timeout:
+                return None
+            except ProtocolError:
+                continue
+            if isinstance(response, dict) and response.get("id") == req_id:
+                return response
+
+    def request_server_addr(self, uri: str, use_cache: bool = True) -> str:
+        if use_cache:
+            hit, addr = self.cache.get(uri, "addr_request")
+            if hit:
+                return addr
+
+        response = self.resolve({"name": "addr_request", "uri": uri})
+        self.cache.put(uri, "addr_request", response["addr"], response.get("generation"))
+        return response["addr"]
+
+    def request_server_addrs(self, uris: List[str], use_cache: bool = True) -> Dict[str, str]:
+        """Resolves several URIs in a single round trip. Cached URIs aren't requested"""
+        addrs = {}
+        missing = []
+        for uri in uris:
+            hit, addr = self.cache.get(uri, "addr_request") if use_cache else (False, None)
+            if hit:
+                addrs[uri] = addr
+            else:
+                missing.append(uri)
+
+        if missing:
+            msg = {"name": "batch", "requests": [{"name": "addr_request", "uri": uri} for uri in missing]}
+            response = self.resolve(msg)
+            for r in response["responses"]:
+                self.cache.put(r["req_uri"], "addr_request", r["addr"], r.get("generation"))
+                addrs[r["req_uri"]] = r["addr"]
+        return addrs
+
+    def request_replica_addr(self, my_addr: str, uri: str, use_cache: bool = True) -> str:
+        key = ("get_replica_addr", my_addr)
+        if use_cache:
+            hit, addr = self.cache.get(uri, key)
+            if hit:
+                return addr
+
+        response = self.resolve({"name": "get_replica_addr", "my_addr": my_addr, "uri": uri})
+        self.cache.put(uri, key, response["addr"], response.get("generation"))
+        return response["addr"]
+
+    def send_server_addr(self, server_uri: str, server_addr: str) -> Tuple[str, bool]:
+        response = self.request({"name": "update_server", "addr": server_addr, "uri": server_uri})
+        return response["addr"], response["active_server"]
+
+    def change_server_addr(self, server_uri: str, server_addr: str, self_addr: str, callback=None):
+        msg = {"name": "set_current_server", "addr": server_addr, "uri": server_uri, "self_addr": self_addr}
+        response = self.request(msg)
+        self.cache.invalidate(server_uri)
+        self.cache.observe_generation(server_uri, response.get("generation"))
+
+        if callback:
+            callback()
+
+    def request_random_server(self, self_uri: str) -> str:
+        # Not a lookup: the pick counts as a pending migration, and must not be repeated
+        response = self.request({"name": "get_random_server", "uri": self_uri})
+        return response["addr"]
+
+    def send_beacon(self, server_addr: str, load: float, rtt: float = 0.0) -> bool:
+        """Reports the load of a server, so the DNS can pick migration targets.
+        Returns False if the DNS doesn't know server_addr"""
+        response = self.request({"name": "server_beacon", "addr": server_addr, "load": load, "rtt": rtt})
+        return response["known"]
+
+    def report_failure(self, server_addr: str):
+        """Reports that a server couldn't be reached, so it isn't picked again soon"""
+        self.request({"name": "report_failure", "addr": server_addr})
+
+    def watch(self, uri: str, callback: Optional[Callable[[dict], None]] = None) -> "Watch":
+        """Subscribes to changes of the servers of uri. See Watch"""
+        return Watch(self, uri, callback)
+
+
+class Watch:
+    """Subscription to the changes of the servers of a URI.
+
+    Holds a dedicated connection to the name server on a background thread.
+    Every change invalidates the cached answers of the URI, and then calls
+    callback with a dict like:
+
+    {
+        uri: The watched URI
+        addresses: Current active servers of the URI
+        added: Servers that joined with this change
+        removed: Servers that left with this change
+        generation: Registry generation of the URI after the change
+    }
+
+    The callback is also called with the current servers when the watch is
+    (re)established, with every server in added. If the connection drops it
+    is reopened with backoff. The answer to a new watch is authoritative:
+    its generation replaces the known one even if older, since the name
+    server may have restarted and started counting again.
+    """
+
+    def __init__(self, client: DNSClient, uri: str, callback: Optional[Callable[[dict], None]] = None) -> None:
+        self.client = client
+        self.uri = uri
+        self.callback = callback
+        self.addresses: List[str] = []
+        self.generation = -1
+
+        self._sock: Optional[socket.socket] = None
+        self._closed = Event()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._closed.set()
+        if self._sock is not None:
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _run(self):
+        attempt = 0
+        while not self._closed.is_set():
+            try:
+                self._sock = socket.create_connection((self.client.dns_host, self.client.dns_port), self.client.timeout)
+                self._sock.sendall(pack_frame({"name": "watch", "uri": self.uri}))
+                response = recv_frame(self._sock)
+                # Changes may take any time to come
+                self._sock.settimeout(None)
+                attempt = 0
+                self._on_change({**response, "added": response["addresses"], "removed": []}, reset=True)
+
+                while not self._closed.is_set():
+                    msg = recv_frame(self._sock)
+                    if msg.get("name") == "uri_changed":
+                        self._on_change(msg)
+            except (OSError, ProtocolError) as e:
+                if self._closed.is_set():
+                    break
+                logger.debug(f"Watch of {self.uri} lost ({e!r}), reconnecting")
+            finally:
+                if self._sock is not None:
+                    self._sock.close()
+
+            self._closed.wait(min(self.client.backoff * 2 ** attempt, 5.0))
+            attempt += 1
+
+    def _on_change(self, msg: dict, reset: bool = False):
+        # Pushes of concurrent changes may arrive out of order
+        if msg["generation"] < self.generation and not reset:
+            return
+        self.generation = msg["generation"]
+        self.addresses = msg["addresses"]
+
+        if reset:
+            self.client.cache.reset_generation(self.uri, msg["generation"])
+        else:
+            self.client.cache.invalidate(self.uri)
+            self.client.cache.observe_generation(self.uri, msg["generation"])
+        if self.callback:
+            try:
+                self.callback(msg)
+            except Exception as e:
+                logger.error(f"Watch callback of {self.uri} failed: {e!r}")
+
+
+# (dns_host, dns_port) -> DNSClient
+_dns_clients: Dict[Tuple[str, int], DNSClient] = {}
+_dns_clients_lock = Lock()
+
+
+def get_dns_client(dns_host: str, dns_port: int) -> DNSClient:
+    """Returns the DNSClient shared by everything in this process that talks to dns_host:dns_port"""
+    with _dns_clients_lock:
+        if (dns_host, dns_port) not in _dns_clients:
+            _dns_clients[(dns_host, dns_port)] = DNSClient(dns_host, dns_port)
+        return _dns_clients[(dns_host, dns_port)]
+
+
+def get_resolver_cache(dns_host: str, dns_port: int) -> ResolverCache:
+    return get_dns_client(dns_host, dns_port).cache
+
+
+def invalidate_server_addr(dns_host: str, dns_port: int, uri: str):
+    """Forgets every cached answer for uri, e.g. after the server announced a migration"""
+    get_resolver_cache(dns_host, dns_port).invalidate(uri)
+
+
+def request_server_adrr(dns_host: str, dns_port: int, uri: str, use_cache: bool = True) -> str:
+    return get_dns_client(dns_host, dns_port).request_server_addr(uri, use_cache)
+
+
+def request_server_addrs(dns_host: str, dns_port: int, uris: List[str], use_cache: bool = True) -> Dict[str, str]:
+    return get_dns_client(dns_host, dns_port).request_server_addrs(uris, use_cache)
+
+
+def request_replica_addr(dns_host: str, dns_port: int, my_addr: str, uri: str, use_cache: bool = True) -> str:
+    return get_dns_client(dns_host, dns_port).request_replica_addr(my_addr, uri, use_cache)
 
 
-def send_server_addr(dns_host: str, dns_port: int, server_uri: str, server_addr: str) -> str:
-    msg = pickle.dumps({"name": "update_server", "addr": server_addr, "uri": server_uri})
-
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.connect((dns_host, dns_port))
-
-    s.sendall(msg)
-
-    while True:
-        try:
-            response = s.recv(2048)
-            response: dict = pickle.loads(response)
-
-            if response["name"] == "update_server_response":
-                s.close()
-                return response["addr"], response["active_server"]
-        except ConnectionResetError:
-            pass
-        sleep(0.1)
+def send_server_addr(dns_host: str, dns_port: int, server_uri: str, server_addr: str) -> Tuple[str, bool]:
+    return get_dns_client(dns_host, dns_port).send_server_addr(server_uri, server_addr)
 
 
 def change_server_addr(
     dns_host: str, dns_port: int, server_uri: str, server_addr: str, self_addr: str, callback
-) -> str:
-    msg = pickle.dumps({"name": "set_current_server", "addr": server_addr, "uri": server_uri, "self_addr": self_addr})
-
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.connect((dns_host, dns_port))
-
-    s.sendall(msg)
-
-    while True:
-        try:
-            response = s.recv(2048)
-            response: dict = pickle.loads(response)
-
-            if response["name"] == "set_current_server_response":
-                s.close()
-                break
-        except ConnectionResetError:
-            pass
-        sleep(0.1)
-
-    callback()
+):
+    get_dns_client(dns_host, dns_port).change_server_addr(server_uri, server_addr, self_addr, callback)
 
 
 def request_random_server(dns_host: str, dns_port: int, self_uri: str) -> str:
-    msg = pickle.dumps({"name": "get_random_server", "uri": self_uri})
-    logger.debug(f"Connecting to DNS at {dns_host}:{dns_port}")
-
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.connect((dns_host, dns_port))
-
-    s.sendall(msg)
-
-    while True:
-        try:
-            response = s.recv(2048)
-            response: dict = pickle.loads(response)
-
-            if response["name"] == "random_server_response":
-                s.close()
-                return response["addr"]
-        except ConnectionResetError:
-            pass
-        sleep(0.1)
+    return get_dns_client(dns_host, dns_port).request_random_server(self_uri)
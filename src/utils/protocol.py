@@ -0,0 +1,116 @@
+"""Framed wire protocol used to talk to the name server.
+
+Every message is a frame made of a 6 byte header (2 magic bytes plus the
+payload length as an unsigned 32 bit big endian int) followed by the payload,
+a compact JSON object. A connection can carry any number of frames, so a
+client may pipeline requests and read the responses in the same order.
+
+Resolution queries may also be sent as a single frame per UDP datagram to
+the same port. Those carry an "id" echoed in the response, so a client can
+match answers to retried requests. Answers that don't fit in
+MAX_DATAGRAM_SIZE are replaced by {"name": "tcp_required"}.
+
+Old clients send a single pickled dict instead. Pickles never start with the
+first magic byte, so the server can tell both protocols apart from the first
+byte of a connection.
+"""
+import asyncio
+import json
+import socket
+import struct
+from typing import Iterator, Tuple
+
+MAGIC = b"NS"
+HEADER = struct.Struct("!2sI")
+MAX_FRAME_SIZE = 1 << 20  # 1 MiB
+# Fits in one packet on any usual path MTU, so datagrams aren't fragmented
+MAX_DATAGRAM_SIZE = 1232
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode(msg: dict) -> bytes:
+    return json.dumps(msg, separators=(",", ":")).encode()
+
+
+def decode(payload: bytes) -> dict:
+    try:
+        return json.loads(payload)
+    except ValueError as e:
+        raise ProtocolError(f"Invalid payload: {e}")
+
+
+def pack_frame(msg: dict) -> bytes:
+    payload = encode(msg)
+    return HEADER.pack(MAGIC, len(payload)) + payload
+
+
+def is_framed(first_byte: bytes) -> bool:
+    return first_byte == MAGIC[:1]
+
+
+def _unpack_header(header: bytes) -> int:
+    magic, size = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ProtocolError(f"Invalid frame magic {magic!r}")
+    if size > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame of {size} bytes exceeds the {MAX_FRAME_SIZE} bytes limit")
+    return size
+
+
+def unpack_frame(data: bytes) -> dict:
+    """Decodes a buffer holding exactly one frame, e.g. a datagram"""
+    if len(data) < HEADER.size:
+        raise ProtocolError(f"Truncated frame of {len(data)} bytes")
+    size = _unpack_header(data[: HEADER.size])
+    if len(data) != HEADER.size + size:
+        raise ProtocolError(f"Frame of {len(data)} bytes, expected {HEADER.size + size}")
+    return decode(data[HEADER.size :])
+
+
+def recv_exactly(sock: socket.socket, size: int) -> bytes:
+    """Reads exactly size bytes from sock. Raises ConnectionError if the peer closes first"""
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            raise ConnectionError("Connection closed by peer")
+        buf += chunk
+    return bytes(buf)
+
+
+def recv_frame(sock: socket.socket, prefix: bytes = b"") -> dict:
+    """Reads the next frame from sock. prefix holds header bytes already read"""
+    header = prefix + recv_exactly(sock, HEADER.size - len(prefix))
+    return decode(recv_exactly(sock, _unpack_header(header)))
+
+
+async def read_frame(reader: asyncio.StreamReader, prefix: bytes = b"") -> dict:
+    """Same as recv_frame, for a connection served by an event loop"""
+    header = prefix + await reader.readexactly(HEADER.size - len(prefix))
+    return decode(await reader.readexactly(_unpack_header(header)))
+
+
+def iter_frames(buf) -> Iterator[Tuple[dict, int]]:
+    """Decodes the frames stored back to back in buf (bytes, mmap, ...).
+
+    Yields each message with the offset where its frame ends. Stops at the
+    first incomplete or corrupt frame, so a torn write at the end is ignored.
+    """
+    offset = 0
+    while offset + HEADER.size <= len(buf):
+        try:
+            size = _unpack_header(buf[offset : offset + HEADER.size])
+        except ProtocolError:
+            return
+        end = offset + HEADER.size + size
+        if end > len(buf):
+            return
+        try:
+            msg = decode(buf[offset + HEADER.size : end])
+        except ProtocolError:
+            return
+        yield msg, end
+        offset = end
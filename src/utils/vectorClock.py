@@ -1,33 +1,122 @@
-from collections import defaultdict
-from functools import wraps
+from array import array
+from collections import defaultdict, deque
+from heapq import heappop, heappush
+from itertools import count
 from threading import Lock
-from copy import deepcopy
-from typing import Callable, List
+from time import monotonic, time
+from typing import Callable, Dict, Hashable, Iterable, List, Optional, Union
 
 MESSAGE = "message"
 MESSAGE_COUNT = "message_count"
 SENDER_ID = "sender_id"
+BROADCAST_COUNT = "broadcast_count"
+# Range of MESSAGE_COUNT asked again in a retransmit request
+FIRST_COUNT = "first"
+LAST_COUNT = "last"
 
+# Typecode of the counter arrays, unsigned 32 bit
+COUNTER_TYPE = "I"
+# Seconds between calls to check_gaps, by the server and the clients
+GAP_CHECK_INTERVAL = 0.5
 
-def create_with_vector_locks(lock_names: List[str]):
+
+def encode_deltas(values: Iterable[int]) -> bytes:
+    """
+    Encodes integers as the zigzag varint of the difference with the
+    previous one. Counters of users that joined around the same time are
+    close to each other, so most of them take one or two bytes.
+    """
+    out = bytearray()
+    previous = 0
+    for value in values:
+        delta = value - previous
+        previous = value
+        # Zigzag: small negative deltas stay small
+        n = (delta << 1) if delta >= 0 else ((-delta << 1) - 1)
+        while n >= 0x80:
+            out.append((n & 0x7F) | 0x80)
+            n >>= 7
+        out.append(n)
+    return bytes(out)
+
+
+def decode_deltas(data: bytes) -> array:
+    values = array(COUNTER_TYPE)
+    previous = 0
+    n = shift = 0
+    for byte in data:
+        n |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        previous += (n >> 1) if not n & 1 else -((n + 1) >> 1)
+        values.append(previous)
+        n = shift = 0
+    return values
+
+
+class DeliveryStats:
+    """Time (in seconds) received messages spent delayed, and how gaps were handled"""
+
+    def __init__(self) -> None:
+        self.delayed = 0
+        self.delay_total = 0.0
+        self.delay_max = 0.0
+        self.duplicates = 0
+        self.retransmit_requests = 0
+        self.gaps_skipped = 0
+        self.messages_lost = 0
+
+    def record_delay(self, delay: float):
+        self.delayed += 1
+        self.delay_total += delay
+        if delay > self.delay_max:
+            self.delay_max = delay
+
+    def snapshot(self) -> dict:
+        return {
+            "delayed": self.delayed,
+            "delay_total": self.delay_total,
+            "delay_max": self.delay_max,
+            "delay_avg": self.delay_total / self.delayed if self.delayed else 0.0,
+            "duplicates": self.duplicates,
+            "retransmit_requests": self.retransmit_requests,
+            "gaps_skipped": self.gaps_skipped,
+            "messages_lost": self.messages_lost,
+        }
+
+
+class _Gap:
+    """Missing messages of a sender, see VectorClock.check_gaps"""
+
+    __slots__ = ("opened_at", "requested_at", "requests")
+
+    def __init__(self, now: float) -> None:
+        self.opened_at = now
+        self.requested_at = now
+        self.requests = 0
+
+
+class StripedLock:
     """
-    Decorator that acquires locks with the specified names.
-    Used in VectorClock class.
+    Fixed set of locks, each guarding the keys that hash to it. Threads
+    working on keys of different stripes don't wait for each other.
     """
-    lock_names.sort()
 
-    def with_vector_locks(func):
-        @wraps(func)
-        def wrapper(self, *args, **kwargs):
-            for lock_name in lock_names:
-                self.locks[lock_name].acquire()
-                result = func(self, *args, **kwargs)
-                self.locks[lock_name].release()
-                return result
+    def __init__(self, stripes: int) -> None:
+        self.stripes = [Lock() for _ in range(stripes)]
 
-        return wrapper
+    def __call__(self, key: Hashable) -> Lock:
+        return self.stripes[hash(key) % len(self.stripes)]
 
-    return with_vector_locks
+    def acquire_all(self):
+        # Always in the same order, so two callers can't deadlock
+        for lock in self.stripes:
+            lock.acquire()
+
+    def release_all(self):
+        for lock in reversed(self.stripes):
+            lock.release()
 
 
 class VectorClock:
@@ -36,108 +125,448 @@ class VectorClock:
     message synchronization on a process independent basis. This means
     that messages from a specific client will have their sending
     order preserved, but there is no such guarantee for messages of
-    different clients
+    different clients.
+
+    State is locked per sender (received counters, delayed_messages) and
+    per destination (sent counters), striped over `stripes` locks, so
+    messages of unrelated clients are processed in parallel. Messages of
+    a sender are delivered while holding its stripe, so onDeliverMessage
+    sees them in order. onDeliverMessage may send messages, since sending
+    uses a separate set of stripes.
+
+    Every id is interned to a slot the first time it is seen, and the
+    counters of all ids are kept in two arrays indexed by slot. Ids that
+    are gone (e.g. disconnected users) can be retired, and are forgotten
+    by compact once retired for long enough, freeing their slot for a new
+    id. An id revived before that keeps its counters.
+
+    A message for many destinations can be sent with broadcast_message.
+    Instead of a MESSAGE_COUNT per destination, it carries the number of
+    broadcasts sent so far (BROADCAST_COUNT), the same for everyone. Each
+    destination gets a base from broadcast_base once, and then computes
+    MESSAGE_COUNT = BROADCAST_COUNT - base (see set_broadcast_base).
+
+    A message lost on the way would hold every later message of its sender
+    forever. So once messages of a sender have been delayed for gap_timeout
+    seconds, check_gaps asks for the missing ones again, and the sender
+    answers from the last outbound_size messages it sent (see retransmit).
+    After max_retransmits requests without progress, or if more than
+    max_delayed messages of the sender pile up, the missing messages are
+    given up on and the delayed ones delivered. Duplicates (e.g. a message
+    retransmitted after the original arrived) are dropped.
     """
 
-    def __init__(self, idx: str, onDeliverMessage: Callable[[dict], None]) -> None:
+    def __init__(
+        self,
+        idx: str,
+        onDeliverMessage: Callable[[dict], None],
+        stripes: int = 64,
+        gap_timeout: float = 1.0,
+        max_retransmits: int = 3,
+        max_delayed: int = 1024,
+        outbound_size: int = 1024,
+    ) -> None:
         self.idx = idx
-        # { destination_id: message_count }
-        self.sent_messages = defaultdict(lambda: 0)
+        # { id: slot }
+        self.slots: Dict[str, int] = {}
+        # Slots of forgotten ids, given to new ones first
+        self.free_slots: List[int] = []
+        self.__intern_lock = Lock()
+
+        # { id: time.time() when it was retired }
+        self.retired: Dict[str, float] = {}
 
-        # { sender_id: message_count }
-        self.received_messages = defaultdict(lambda: 0)
+        # slot -> count of messages sent to the id
+        self.sent = array(COUNTER_TYPE)
+
+        # slot -> count of messages received from the id
+        self.received = array(COUNTER_TYPE)
+
+        # Messages sent with broadcast_message
+        self.broadcasts = 0
+
+        # { sender_id: base }, see set_broadcast_base
+        self.broadcast_bases: Dict[str, int] = {}
 
         # Delayed messages
-        self.delayed_messages = []
+        # { sender_id: min-heap of (message_count, arrival, arrived_at, message) }
+        self.delayed_messages = defaultdict(list)
+        # Tie breaker, so duplicated counts never compare the messages
+        self.__arrivals = count()
+
+        # { sender_id: _Gap }, for every sender with delayed messages
+        self.gaps: Dict[str, _Gap] = {}
+        self.gap_timeout = gap_timeout
+        self.max_retransmits = max_retransmits
+        self.max_delayed = max_delayed
+        self.stats = DeliveryStats()
+
+        # Last messages sent, to retransmit them
+        # { destination_id: deque of messages }
+        self.outbound: Dict[str, deque] = {}
+        # Broadcasts, and { destination_id: base } given to each destination
+        self.broadcast_outbound = deque(maxlen=outbound_size)
+        self.dest_bases: Dict[str, int] = {}
+        self.outbound_size = outbound_size
 
         # Locks
-        lock_names = ["sent_messages", "received_messages", "delayed_messages"]
-        self.locks = {x: Lock() for x in lock_names}
+        self.send_locks = StripedLock(stripes)  # by destination_id
+        self.receive_locks = StripedLock(stripes)  # by sender_id
 
         # Callback when message is delivered
         self.onDeliverMessage = onDeliverMessage
 
-    @create_with_vector_locks(["sent_messages"])
+    @property
+    def sent_messages(self) -> Dict[str, int]:
+        """{ destination_id: message_count }, as a copy"""
+        return {idx: self.sent[slot] for idx, slot in list(self.slots.items()) if self.sent[slot]}
+
+    @property
+    def received_messages(self) -> Dict[str, int]:
+        """{ sender_id: message_count }, as a copy"""
+        return {idx: self.received[slot] for idx, slot in list(self.slots.items()) if self.received[slot]}
+
+    def slot(self, idx: str) -> int:
+        """
+        Slot of the counters of idx, interning it if it's new. Must hold a
+        stripe of idx, so compact can't free the slot while it's used
+        """
+        slot = self.slots.get(idx)
+        if slot is None:
+            with self.__intern_lock:
+                slot = self.slots.get(idx)
+                if slot is None:
+                    if self.free_slots:
+                        slot = self.free_slots.pop()
+                    else:
+                        slot = len(self.sent)
+                        self.sent.append(0)
+                        self.received.append(0)
+                    # Published last, so the arrays already have the slot
+                    self.slots[idx] = slot
+        return slot
+
+    def retire(self, idx: str):
+        """
+        Marks idx as gone. Its counters are kept until compact forgets
+        them, so messages still in flight are handled as usual
+        """
+        if idx in self.slots:
+            self.retired.setdefault(idx, time())
+
+    def revive(self, idx: str):
+        """
+        Keeps the counters of a retired idx that came back. Only useful if
+        its peer kept its own clock: a peer starting a new clock should
+        come back with a new id
+        """
+        self.retired.pop(idx, None)
+
+    def compact(self, grace: float) -> int:
+        """
+        Forgets the ids retired more than grace seconds ago, along with
+        any messages from them still delayed (the ones they were waiting
+        for won't come anymore). Returns the number of ids forgotten
+        """
+        now = time()
+        expired = [idx for idx, retired_at in list(self.retired.items()) if now - retired_at >= grace]
+        if not expired:
+            return 0
+
+        self.__acquire_all()
+        try:
+            with self.__intern_lock:
+                forgotten = 0
+                for idx in expired:
+                    # Revived while waiting for the locks
+                    if self.retired.pop(idx, None) is None:
+                        continue
+                    slot = self.slots.pop(idx, None)
+                    if slot is None:
+                        continue
+                    self.sent[slot] = 0
+                    self.received[slot] = 0
+                    self.free_slots.append(slot)
+                    self.delayed_messages.pop(idx, None)
+                    self.gaps.pop(idx, None)
+                    self.broadcast_bases.pop(idx, None)
+                    self.outbound.pop(idx, None)
+                    self.dest_bases.pop(idx, None)
+                    forgotten += 1
+        finally:
+            self.__release_all()
+        return forgotten
+
     def send_message(self, message_txt: str, dest_id: str):
         """
         Public method to send a message. Will execute logic clock algorithm.
         """
-        # Increase count of messages sent to the destination
-        self.sent_messages[dest_id] += 1
+        with self.send_locks(dest_id):
+            slot = self.slot(dest_id)
+            # Increase count of messages sent to the destination
+            self.sent[slot] += 1
+
+            message = {
+                MESSAGE: message_txt,
+                # Include count of messages sent to the destination in message
+                MESSAGE_COUNT: self.sent[slot],
+                SENDER_ID: self.idx,
+            }
+            if dest_id not in self.outbound:
+                self.outbound[dest_id] = deque(maxlen=self.outbound_size)
+            self.outbound[dest_id].append(message)
 
-        message = {
-            MESSAGE: message_txt,
-            # Include count of messages sent to the destination in message
-            MESSAGE_COUNT: self.sent_messages[dest_id],
-            SENDER_ID: self.idx,
-        }
+        return message
+
+    def broadcast_message(self, message_txt: str, dest_ids: Iterable[str]):
+        """
+        Public method to send the same message to several destinations.
+        Advances the counters of all of them in one critical section, and
+        returns a single message for all of them.
+
+        Every destination must have been given its broadcast_base, and be
+        included in every broadcast after that. Otherwise the counts it
+        computes won't match the ones sent to it.
+        """
+        self.send_locks.acquire_all()
+        try:
+            slots = [self.slot(dest_id) for dest_id in dest_ids]
+            self.broadcasts += 1
+            broadcast_count = self.broadcasts
+            sent = self.sent
+            for slot in slots:
+                sent[slot] += 1
+
+            message = {
+                MESSAGE: message_txt,
+                BROADCAST_COUNT: broadcast_count,
+                SENDER_ID: self.idx,
+            }
+            self.broadcast_outbound.append(message)
+        finally:
+            self.send_locks.release_all()
 
         return message
 
+    def broadcast_base(self, dest_id: str) -> int:
+        """
+        Offset between the broadcasts sent so far and the messages sent to
+        dest_id, for its set_broadcast_base
+        """
+        # broadcasts only changes while holding every stripe
+        with self.send_locks(dest_id):
+            base = self.broadcasts - self.sent[self.slot(dest_id)]
+            # To find its broadcasts if it asks for a retransmission
+            self.dest_bases[dest_id] = base
+            return base
+
+    def set_broadcast_base(self, sender_id: str, base: int):
+        """
+        Sets the base given by sender_id's broadcast_base, used to compute
+        the MESSAGE_COUNT of its broadcasts
+        """
+        self.broadcast_bases[sender_id] = base
+
     def receive_message(self, message: dict):
         """
         Public method to receive a message. Will execute logic clock algorithm,
         delaying the delivery of a message if previous messages are missing.
         """
-        if self.__should_delay_message(message):
-            self.delayed_messages.append(message)
+        sender_id = message[SENDER_ID]
+        if BROADCAST_COUNT in message:
+            # Copied, the same message may be shared by every destination
+            message = {**message, MESSAGE_COUNT: message[BROADCAST_COUNT] - self.broadcast_bases.get(sender_id, 0)}
+        with self.receive_locks(sender_id):
+            slot = self.slot(sender_id)
+            if message[MESSAGE_COUNT] <= self.received[slot]:
+                # Already delivered, e.g. retransmitted
+                self.stats.duplicates += 1
+            elif self.__should_delay_message(message, slot):
+                delayed = self.delayed_messages[sender_id]
+                if not delayed:
+                    self.gaps[sender_id] = _Gap(monotonic())
+                heappush(delayed, (message[MESSAGE_COUNT], next(self.__arrivals), monotonic(), message))
+                if len(delayed) > self.max_delayed:
+                    self.__skip_gap(sender_id, slot)
+            else:
+                self.__deliver_message(message, slot)
+                self.__check_delayed_messages(sender_id, slot)
+
+    def check_gaps(self) -> List[dict]:
+        """
+        Public method to be called periodically. Returns the retransmit
+        requests to send to the senders whose messages have been delayed
+        for gap_timeout seconds, as { SENDER_ID, FIRST_COUNT, LAST_COUNT }
+        (see retransmit). Gives up on the gaps that didn't get any answer
+        to max_retransmits requests.
+        """
+        now = monotonic()
+        requests = []
+        for sender_id in list(self.gaps):
+            with self.receive_locks(sender_id):
+                gap = self.gaps.get(sender_id)
+                if gap is None or now - gap.requested_at < self.gap_timeout:
+                    continue
+
+                slot = self.slot(sender_id)
+                if gap.requests >= self.max_retransmits:
+                    self.__skip_gap(sender_id, slot)
+                    continue
+
+                gap.requested_at = now
+                gap.requests += 1
+                self.stats.retransmit_requests += 1
+                requests.append(
+                    {
+                        SENDER_ID: sender_id,
+                        FIRST_COUNT: self.received[slot] + 1,
+                        LAST_COUNT: self.delayed_messages[sender_id][0][0] - 1,
+                    }
+                )
+        return requests
+
+    def retransmit(self, dest_id: str, first: int, last: int) -> List[dict]:
+        """
+        Public method to answer a retransmit request of dest_id. Returns the
+        messages sent to it with MESSAGE_COUNT from first to last that are
+        still among the last outbound_size ones, to be sent again as is
+        """
+        last = min(last, first + self.outbound_size - 1)
+        base = self.dest_bases.get(dest_id)
+        if base is not None:
+            # Its messages were broadcasts
+            sent = list(self.broadcast_outbound)
+            key, first, last = BROADCAST_COUNT, first + base, last + base
         else:
-            self.__deliver_message(message)
-            self.__check_delayed_messages()
+            sent = list(self.outbound.get(dest_id, ()))
+            key = MESSAGE_COUNT
+        if not sent:
+            return []
+
+        # Counts in a ring are consecutive
+        offset = sent[0][key]
+        return [sent[i - offset] for i in range(max(first, offset), last + 1) if i - offset < len(sent)]
 
-    @create_with_vector_locks(["received_messages"])
-    def __should_delay_message(self, message: dict) -> bool:
+    def __should_delay_message(self, message: dict, slot: int) -> bool:
         """
         Checks if a message should be delayed. This should happen if a
         previous message hasn't been received yet.
         """
-        sender_id = message[SENDER_ID]
-        message_count = message[MESSAGE_COUNT]
-
         # If the amount of messages sent by the sender to this client
         # exceeds the messages received from him by more than 1,
         # this means that there are still undelivered messages that
         # predate this one.
-        return message_count - 1 > self.received_messages[sender_id]
+        return message[MESSAGE_COUNT] - 1 > self.received[slot]
 
-    @create_with_vector_locks(["received_messages"])
-    def __deliver_message(self, message: dict):
+    def __deliver_message(self, message: dict, slot: int):
         """
         Executes the delivery of a message via the onDeliverMessage callback.
         Also updates the received message count from the sender.
         """
-        sender_id = message[SENDER_ID]
-        self.received_messages[sender_id] = max(
-            message[MESSAGE_COUNT], self.received_messages[sender_id] + 1
-        )
+        self.received[slot] = max(message[MESSAGE_COUNT], self.received[slot] + 1)
         self.onDeliverMessage(message)
 
-    @create_with_vector_locks(["delayed_messages"])
-    def __check_delayed_messages(self):
+    def __skip_gap(self, sender_id: str, slot: int):
         """
-        Checks if a delayed message should now be delivered. Does this
-        untill no more messages can be delivered.
+        Gives up on the messages of sender_id missing before its first
+        delayed one, and delivers the delayed ones that follow
         """
-        message_delivered = True
-
-        while message_delivered:
-            message_delivered = False
-            for i, message in enumerate(self.delayed_messages):
-                if self.__should_delay_message(message):
-                    continue
-
-                self.delayed_messages.pop(i)
-                self.__deliver_message(message)
-                message_delivered = True
-                break
+        first_delayed = self.delayed_messages[sender_id][0][0]
+        self.stats.gaps_skipped += 1
+        self.stats.messages_lost += first_delayed - 1 - self.received[slot]
+        self.received[slot] = first_delayed - 1
+        self.__check_delayed_messages(sender_id, slot)
 
-    def load_from(self, sent_messages: dict, received_messages: dict):
-        self.sent_messages.update(sent_messages)
-        self.received_messages.update(received_messages)
+    def __check_delayed_messages(self, sender_id: str, slot: int):
+        """
+        Delivers the delayed messages of sender_id that are no longer
+        missing previous ones. Only sender_id's messages can be unblocked
+        by a delivery from sender_id, and they come out of its heap in
+        order, so this stops at the first one that must still wait.
+        """
+        delayed = self.delayed_messages.get(sender_id)
+        delivered = False
+        now = monotonic()
+        while delayed and not self.__should_delay_message(delayed[0][3], slot):
+            message_count, _, arrived_at, message = heappop(delayed)
+            if message_count <= self.received[slot]:
+                self.stats.duplicates += 1
+                continue
+            self.stats.record_delay(now - arrived_at)
+            self.__deliver_message(message, slot)
+            delivered = True
+
+        if sender_id in self.delayed_messages and not delayed:
+            del self.delayed_messages[sender_id]
+            self.gaps.pop(sender_id, None)
+        elif delivered:
+            # Progress, the remaining gap starts now
+            self.gaps[sender_id] = _Gap(now)
+
+    def load_from(self, state: Union[dict, list, tuple], received_messages: Optional[dict] = None):
+        """
+        Loads the counters of a dump. Also accepts the format of older
+        versions, load_from(sent_messages, received_messages) or
+        load_from([sent_messages, received_messages]), with dicts keyed by id
+        """
+        if received_messages is not None:
+            state = [state, received_messages]
+
+        # { id: seconds since it was retired }
+        retired = {}
+        if isinstance(state, dict):
+            ids = state["ids"]
+            sent = decode_deltas(state["sent"] or b"")
+            received = decode_deltas(state["received"] or b"")
+            retired = state.get("retired", {})
+        else:
+            sent_messages, received_messages = state
+            ids = list(dict.fromkeys([*sent_messages, *received_messages]))
+            sent = [sent_messages.get(idx, 0) for idx in ids]
+            received = [received_messages.get(idx, 0) for idx in ids]
+
+        now = time()
+        self.__acquire_all()
+        try:
+            for idx, sent_count, received_count in zip(ids, sent, received):
+                slot = self.slot(idx)
+                self.sent[slot] = sent_count
+                self.received[slot] = received_count
+            for idx, age in retired.items():
+                self.retired[idx] = now - age
+        finally:
+            self.__release_all()
         return self
 
-    def dump(self):
-        return [dict(self.sent_messages), dict(self.received_messages)]
+    def dump(self) -> dict:
+        """
+        Counters of every id, to be loaded with load_from:
+        { ids: [id, ...], sent: bytes, received: bytes, retired: {id: age} },
+        where the counters are in the order of ids and encoded with
+        encode_deltas, and age is the seconds since the id was retired.
+        Without ids the counters are None, as an empty binary attachment
+        never arrives over socket.io's websocket transport
+        """
+        now = time()
+        self.__acquire_all()
+        try:
+            slots = list(self.slots.values())
+            return {
+                "ids": list(self.slots),
+                "sent": encode_deltas(self.sent[slot] for slot in slots) or None,
+                "received": encode_deltas(self.received[slot] for slot in slots) or None,
+                "retired": {idx: now - retired_at for idx, retired_at in self.retired.items()},
+            }
+        finally:
+            self.__release_all()
+
+    def __acquire_all(self):
+        self.receive_locks.acquire_all()
+        self.send_locks.acquire_all()
+
+    def __release_all(self):
+        self.send_locks.release_all()
+        self.receive_locks.release_all()
 
 
 if __name__ == "__main__":